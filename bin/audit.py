@@ -0,0 +1,31 @@
+#!/usr/bin/env python
+"""
+Audit all account balances and completed payments against their entries,
+with one grouped query each; see cc.ripple.audit.
+
+With --incremental, only audit what changed since the last incremental run,
+which is quick enough to run every few minutes.
+
+Prints each mismatch as it is found, and exits with status 1 if there were
+any.
+"""
+
+import sys
+
+from cc.ripple import audit
+
+def run(incremental=False):
+    found = False
+    if incremental:
+        checks = (audit.incremental_mismatches,)
+    else:
+        checks = (audit.account_mismatches, audit.payment_mismatches)
+    for mismatches in checks:
+        for error in mismatches():
+            print error
+            sys.stdout.flush()
+            found = True
+    return int(found)
+
+if __name__ == '__main__':
+    sys.exit(run('--incremental' in sys.argv[1:]))
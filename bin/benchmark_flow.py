@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+"""
+Benchmark the payment engine on generated networks; see
+cc.payment.benchmark.
+
+Prints results as JSON, or writes them to --output.  With --baseline, also
+compares them with the results in that file, prints any regressions to
+stderr, and exits with status 1 if there are any.
+
+Times the graph cache round-trip on the configured default cache, under a
+key prefix of its own, so it is safe to run against a live cache.
+"""
+
+import json
+import optparse
+import sys
+
+from cc.payment import benchmark
+
+def main():
+    parser = optparse.OptionParser(usage="%prog [options]")
+    parser.add_option(
+        '--sizes', default=','.join(str(s) for s in benchmark.DEFAULT_SIZES),
+        help="comma-separated numbers of credit lines [%default]")
+    parser.add_option('--pairs', type='int', default=benchmark.DEFAULT_PAIRS,
+                      help="payer and recipient pairs per size [%default]")
+    parser.add_option('--backends',
+                      help="comma-separated min cost flow backends [configured one]")
+    parser.add_option('--seed', type='int', default=0)
+    parser.add_option('--output', help="write results to this file")
+    parser.add_option('--baseline', help="compare with results in this file")
+    parser.add_option('--tolerance', type='float',
+                      default=benchmark.DEFAULT_TOLERANCE,
+                      help="allowed slowdown as a fraction [%default]")
+    options, args = parser.parse_args()
+    sizes = [int(size) for size in options.sizes.split(',')]
+    backends = options.backends and options.backends.split(',')
+    results = benchmark.run(sizes, options.pairs, backends, options.seed)
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if options.output:
+        with open(options.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print output
+    if options.baseline:
+        with open(options.baseline) as f:
+            baseline = json.load(f)
+        regressions = benchmark.compare(results, baseline, options.tolerance)
+        for size, name, baseline_value, value in regressions:
+            sys.stderr.write("%s credit lines: %s %s ms -> %s ms\n" % (
+                    size, name, baseline_value, value))
+        if regressions:
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
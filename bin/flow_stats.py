@@ -0,0 +1,16 @@
+#!/usr/bin/env python
+"""
+Print flow engine counters as JSON; see cc.payment.stats.
+
+Usage: flow_stats.py [--reset]
+"""
+
+import json
+import sys
+
+from cc.payment import stats
+
+if __name__ == '__main__':
+    print json.dumps(stats.get_counters(), indent=2, sort_keys=True)
+    if '--reset' in sys.argv[1:]:
+        stats.reset_counters()
@@ -0,0 +1,27 @@
+#!/usr/bin/env python
+"""
+Recompute the stored credit reputations of profiles that have logged in
+within the last REPUTATION_PRECOMPUTE_DAYS days, for the reputation template
+tag.  Only pairs that have been shown on a page are stored, and so kept up
+to date.  Run periodically (e.g. nightly from cron).
+
+Usage: precompute_reputations.py [processes]
+"""
+
+import sys
+from datetime import datetime, timedelta
+
+from django.conf import settings
+
+from cc.profile.models import Profile
+import cc.ripple.api as ripple
+
+def run(processes=None):
+    since = datetime.now() - timedelta(
+        days=getattr(settings, 'REPUTATION_PRECOMPUTE_DAYS', 30))
+    askers = Profile.objects.filter(user__last_login__gte=since).only('id')
+    count = ripple.precompute_reputations(askers, processes)
+    print "Stored %d reputations." % count
+
+if __name__ == '__main__':
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else None)
@@ -0,0 +1,28 @@
+#!/usr/bin/env python
+"""
+Perform queued routed payments, and apply journalled credit line changes to
+the cached flow graphs.
+
+Run exactly one of these, instead of bin/update_cached_graphs.py, when the
+PAYMENT_QUEUE and FLOW_GRAPH_JOURNAL settings are on.
+"""
+
+import sys
+import time
+
+from cc.payment.worker import PaymentWorker
+
+POLL_INTERVAL = 1  # Seconds to wait when there are no queued payments.
+BATCH_SIZE = 100
+
+def run():
+    worker = PaymentWorker()
+    while True:
+        if not worker.run_once(BATCH_SIZE):
+            time.sleep(POLL_INTERVAL)
+
+if __name__ == '__main__':
+    try:
+        run()
+    except KeyboardInterrupt:
+        sys.exit(0)
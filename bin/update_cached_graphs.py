@@ -0,0 +1,26 @@
+#!/usr/bin/env python
+"""
+Apply journalled credit line changes to the cached flow graphs.
+
+Run exactly one of these when the FLOW_GRAPH_JOURNAL setting is on, so all
+cached graph writes come from a single process.
+"""
+
+import sys
+import time
+
+from cc.payment import flow
+
+POLL_INTERVAL = 1  # Seconds to wait when there are no new changes.
+BATCH_SIZE = 1000
+
+def run():
+    while True:
+        if not flow.apply_journal(BATCH_SIZE):
+            time.sleep(POLL_INTERVAL)
+
+if __name__ == '__main__':
+    try:
+        run()
+    except KeyboardInterrupt:
+        sys.exit(0)
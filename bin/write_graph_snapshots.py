@@ -0,0 +1,26 @@
+#!/usr/bin/env python
+"""
+Keep memory-mapped snapshots of the payment and reputation flow graphs in
+FLOW_GRAPH_SNAPSHOT_DIR up to date with the cached graphs.  Run one on each
+web server that doesn't run the journal applier (bin/update_cached_graphs.py
+or bin/process_payments.py), which keeps its own server's snapshots up to
+date; worker processes pick up each new snapshot on their next access.
+"""
+
+import sys
+import time
+
+from cc.payment import flow
+
+POLL_INTERVAL = 1  # Seconds between checks for changes.
+
+def run():
+    while True:
+        flow.write_graph_snapshots()
+        time.sleep(POLL_INTERVAL)
+
+if __name__ == '__main__':
+    try:
+        run()
+    except KeyboardInterrupt:
+        sys.exit(0)
@@ -1,8 +1,9 @@
 from decimal import Decimal as D
 from datetime import datetime
 
-from django.db import models
-from django.db.models.signals import post_delete, post_save
+from django.db import models, transaction, IntegrityError
+from django.db.models import F
+from django.db.models.signals import post_delete, post_save, pre_delete
 
 from south.modelsinspector import add_introspection_rules
 
@@ -19,9 +20,9 @@ select sum(balance) from (
 
 TRUSTED_BALANCE_SQL = """
 select sum(trusted_balance) from (
-	select (case when ac.balance * cl.bal_mult <= partner_cl.limit
+	select (case when ac.balance * cl.bal_mult <= partner_cl."limit"
 		then ac.balance * cl.bal_mult
-		else partner_cl.limit end) as trusted_balance
+		else partner_cl."limit" end) as trusted_balance
 	from account_creditline as cl
 	join account_account as ac on cl.account_id = ac.id
 	join account_creditline as partner_cl
@@ -54,22 +55,22 @@ class Node(models.Model):
     def out_creditlines(self):
         return self.creditlines.all()
 
-    def _balance_query(self, sql_template):
-        from django.db import connections
-        cursor = connections['ripple'].cursor()
-        cursor.execute(sql_template, (self.id,))
-        row = cursor.fetchone()
-        return row[0] or D('0')
-    
     def overall_balance(self):
-        return self._balance_query(OVERALL_BALANCE_SQL)
+        return NodeBalance.objects.get_many([self.alias])[self.alias][0]
         
     def trusted_balance(self):
         """
         Return sum of all negative balances and all positive balances within
         credit limits.
         """
-        return self._balance_query(TRUSTED_BALANCE_SQL)
+        return NodeBalance.objects.get_many([self.alias])[self.alias][1]
+
+def _balance_query(sql_template, node_id):
+    from django.db import connections
+    cursor = connections['ripple'].cursor()
+    cursor.execute(sql_template, (node_id,))
+    row = cursor.fetchone()
+    return row[0] or D('0')
     
 class AccountManager(models.Manager):
     def create_account(self, node1, node2):
@@ -187,30 +188,234 @@ class CreditLine(models.Model):
             # manually.
             return
 
+        # The limit may have changed, which bounds the partner's trusted
+        # balance.
+        NodeBalance.objects.invalidate([instance.partner_creditline.node_id])
+
         from cc.payment import flow
 
-        # TODO: Call from single external process -- not threadsafe!
+        # Not threadsafe unless FLOW_GRAPH_JOURNAL is on.
         
         flow.update_creditline_in_cached_graphs(instance)
         
+    @classmethod
+    def pre_delete(cls, sender, instance, **kwargs):
+        # Load nodes and partner while they still exist, so post_delete can
+        # remove the account's edges from the cached flow graphs.
+        try:
+            instance.node, instance.partner
+        except (CreditLine.DoesNotExist, Node.DoesNotExist):
+            pass  # Partner was deleted first, and removed both.
+
     @classmethod
     def post_delete(cls, sender, instance, **kwargs):
+        try:
+            partner_creditline = instance.partner_creditline
+        except CreditLine.DoesNotExist:
+            partner_creditline = None
+
         # Delete partner creditline and account itself.
         try:
             instance.account.delete()
         except Account.DoesNotExist:
             pass
+        NodeBalance.objects.invalidate([instance.node_id])
+
+        if partner_creditline is None:
+            return
 
-        # Remove from cached flow graph.
+        # Remove both credit lines from cached flow graphs.
         from cc.payment import flow
 
-        # TODO: Call from single external process -- not threadsafe!
+        # Not threadsafe unless FLOW_GRAPH_JOURNAL is on.
 
-        # XXX: This is broken - tries to load partner creditline, which
-        #      may already be (is?) deleted.
-        flow.update_creditline_in_cached_graphs(instance)
+        flow.remove_account_from_cached_graphs(instance)
+
+class CreditLineChange(models.Model):
+    """
+    Journal entry recording that a credit line changed and cached flow
+    graphs need updating.  Entries are deleted once they are applied.
+
+    Deleted credit lines can't be reloaded, so their entries hold the
+    aliases of the credit line's node and partner, to remove its edges.
+
+    Only used when the FLOW_GRAPH_JOURNAL setting is on; see
+    cc.payment.flow.apply_journal.
+    """
+    creditline_id = models.PositiveIntegerField()
+    node_alias = models.PositiveIntegerField(null=True)  # Only if deleted.
+    partner_alias = models.PositiveIntegerField(null=True)
+    created_on = models.DateTimeField(auto_now_add=True)
+
+    def __unicode__(self):
+        return u"Change %d to credit line %d" % (self.id, self.creditline_id)
+
+class NodeBalanceManager(models.Manager):
+    def get_many(self, aliases):
+        """
+        Returns dict of node alias: (overall balance, trusted balance) for
+        many nodes, in one query once their balances are stored.  Missing
+        and invalidated balances are computed and stored first.  Aliases
+        with no node have zero balances.
+        """
+        balances = {}
+        stale = {}  # Node ID: (alias, row version, or None if no row).
+        for alias, node_id, overall, trusted, version in self.filter(
+                node__alias__in=aliases).values_list(
+                'node__alias', 'node', 'overall', 'trusted', 'version'):
+            if overall is None:
+                stale[node_id] = (alias, version)
+            else:
+                balances[alias] = (overall, trusted)
+        missing = set(aliases) - set(balances) - set(
+            alias for alias, _ in stale.itervalues())
+        if missing:
+            for node_id, alias in Node.objects.filter(
+                    alias__in=missing).values_list('id', 'alias'):
+                stale[node_id] = (alias, None)
+        if stale:
+            computed = self.refresh(dict(
+                    (node_id, version)
+                    for node_id, (_, version) in stale.iteritems()))
+            for node_id, (alias, _) in stale.iteritems():
+                balances[alias] = computed[node_id]
+        for alias in aliases:
+            balances.setdefault(alias, (D('0'), D('0')))
+        return balances
+
+    def apply_postings(self, postings):
+        """
+        Updates stored balances of the nodes on both sides of each
+        (account_id, amount, new_balance) balance change.  Must be run in
+        the same transaction as the changes.
+
+        Rows are updated in node ID order, so concurrent postings can't
+        deadlock on them.  Each update advances the row's version, so a
+        read that computed balances before the postings committed can't
+        store them over the updated ones.
+        """
+        creditlines = {}
+        for account_id, node_id, bal_mult, limit in (
+                CreditLine.objects.filter(
+                    account__in=[posting[0] for posting in postings])
+                .values_list('account', 'node', 'bal_mult', 'limit')):
+            creditlines.setdefault(account_id, {})[bal_mult] = (node_id, limit)
+        deltas = {}
+        for account_id, amount, new_balance in postings:
+            old_balance = new_balance - amount
+            for bal_mult, (node_id, _) in creditlines[account_id].items():
+                partner_limit = creditlines[account_id][-bal_mult][1]
+                overall, trusted = deltas.get(node_id, (0, 0))
+                deltas[node_id] = (
+                    overall + amount * bal_mult,
+                    trusted + _trusted_balance(
+                        new_balance * bal_mult, partner_limit) -
+                    _trusted_balance(old_balance * bal_mult, partner_limit))
+        missing = []
+        for node_id in sorted(deltas):
+            overall, trusted = deltas[node_id]
+            if not overall and not trusted:
+                continue
+            if not self._add(node_id, overall, trusted):
+                missing.append(node_id)
+        for node_id in missing:
+            if not self._create(node_id, *self._compute(node_id)):
+                # Another transaction stored the row meanwhile, computed
+                # without these postings.
+                self._add(node_id, *deltas[node_id])
+
+    def invalidate(self, node_ids):
+        """
+        Marks the stored balances of nodes to be recomputed when next
+        read, for changes other than postings.  Like postings, this
+        advances the row's version, so a read that computed balances
+        before the change can't store them after it.  Rows are marked
+        rather than deleted, for the same reason.
+        """
+        for node_id in sorted(node_ids):
+            if not self._invalidate(node_id) and not self._create(
+                    node_id, None, None):
+                self._invalidate(node_id)
+
+    def refresh(self, versions):
+        """
+        Recomputes the balances of nodes from all credit lines, and stores
+        them unless they changed meanwhile.  versions is a dict of node
+        ID: version of its stored row as read before, or None if it had
+        no row.  Returns dict of node ID: (overall balance, trusted
+        balance).
+        """
+        balances = {}
+        for node_id in sorted(versions):
+            overall, trusted = balances[node_id] = self._compute(node_id)
+            if versions[node_id] is None:
+                self._create(node_id, overall, trusted)
+            else:
+                self.filter(node=node_id, version=versions[node_id]).update(
+                    overall=overall, trusted=trusted)
+        return balances
+
+    def _compute(self, node_id):
+        return (_balance_query(OVERALL_BALANCE_SQL, node_id),
+                _balance_query(TRUSTED_BALANCE_SQL, node_id))
+
+    def _add(self, node_id, overall, trusted):
+        "Adds to node's stored balances.  Returns False if it has no row."
+        return self.filter(node=node_id).update(
+            overall=F('overall') + overall, trusted=F('trusted') + trusted,
+            version=F('version') + 1) > 0
+
+    def _invalidate(self, node_id):
+        "Marks node's stored balances stale.  Returns False if it has no row."
+        return self.filter(node=node_id).update(
+            overall=None, trusted=None, version=F('version') + 1) > 0
+
+    def _create(self, node_id, overall, trusted):
+        """
+        Stores a row of balances for node, unless another transaction
+        stored one first.  Returns whether it was stored.  The insert is
+        made in a savepoint, so a conflict doesn't abort the transaction.
+        """
+        savepoint = transaction.savepoint(using=self.db)
+        try:
+            self.create(node_id=node_id, overall=overall, trusted=trusted)
+        except IntegrityError:
+            transaction.savepoint_rollback(savepoint, using=self.db)
+            return False
+        transaction.savepoint_commit(savepoint, using=self.db)
+        return True
+
+def _trusted_balance(balance, partner_limit):
+    "A credit line's part of its node's trusted balance, as in SQL."
+    if partner_limit is None:
+        return 0  # Null in TRUSTED_BALANCE_SQL, so not counted.
+    return min(balance, partner_limit)
+
+class NodeBalance(models.Model):
+    """
+    A node's overall and trusted balance, as computed by OVERALL_BALANCE_SQL
+    and TRUSTED_BALANCE_SQL, kept up to date as entries are posted and
+    limits change, so reading them doesn't need a join over all of the
+    node's credit lines.
+
+    Balances are None once invalidated, until they are recomputed.
+    version advances with every change, so recomputed balances are only
+    stored if nothing changed while they were computed.
+    """
+    node = models.OneToOneField(Node, related_name='balances')
+    overall = AmountField(default=D('0'), null=True)
+    trusted = AmountField(default=D('0'), null=True)
+    version = models.PositiveIntegerField(default=0)
+
+    objects = NodeBalanceManager()
+
+    def __unicode__(self):
+        return u"Balances of %s: %s overall, %s trusted" % (
+            self.node, self.overall, self.trusted)
 
 post_save.connect(CreditLine.post_save, CreditLine,
                   dispatch_uid='account.models')
+pre_delete.connect(CreditLine.pre_delete, CreditLine,
+                   dispatch_uid='account.models')
 post_delete.connect(CreditLine.post_delete, CreditLine,
                     dispatch_uid='account.models')
@@ -0,0 +1,138 @@
+"""
+Payment engine benchmarks.
+
+Generates mutual credit networks of various sizes with
+testutil.generate_creditlines, and times building the flow graph, the graph
+cache round-trip, and max flow and min cost flow between random payer and
+recipient pairs.  Results are plain dicts of numbers, so they can be dumped
+as JSON, stored as a baseline, and compared with later runs to catch
+engine regressions; bin/benchmark_flow.py does that.
+
+The cache round-trip goes through the configured default cache's backend,
+but under a key prefix of its own, so the live cached graphs are never
+touched.
+"""
+
+import random
+from decimal import Decimal as D
+
+from django.core.cache import get_cache
+
+from cc.account.models import Node
+from cc.payment import solvers, stats
+from cc.payment.flow import (
+    FlowGraph, NoRoutesError, InsufficientCreditError, graph_from_edges,
+    creditline_edges, set_cached_graph, get_cached_graph, delete_cached_graph)
+from cc.payment.testutil import generate_creditlines
+
+DEFAULT_SIZES = (1000, 10000, 100000)
+DEFAULT_PAIRS = 10
+DEFAULT_TOLERANCE = 0.25
+CACHE_KEY_PREFIX = 'payment_benchmark'
+# Timings under this many ms are too noisy to count as regressions.
+MIN_REGRESSION_MS = 5
+
+def run(sizes=DEFAULT_SIZES, pairs=DEFAULT_PAIRS, backends=None, seed=0):
+    """
+    Benchmarks networks of each number of credit lines in sizes, with
+    pairs payer and recipient pairs that have a route between them, and
+    each min cost flow backend in backends (default just the configured
+    one).  Returns dict of
+    size (as a string, like in JSON): dict of measurement name: value.
+    Timing measurement names end in '_ms'.
+    """
+    if backends is None:
+        backends = [solvers.default_backend_name()]
+    results = {}
+    for size in sizes:
+        random.seed(seed)
+        results[str(size)] = run_size(size, pairs, backends)
+    return results
+
+def run_size(size, pairs, backends):
+    rows = generate_creditlines(size)
+    nodes = set(row[1] for row in rows)
+    result = {'creditlines': len(rows), 'nodes': len(nodes)}
+
+    with stats.Timer() as timer:
+        graph = graph_from_edges(nodes, creditline_edges(rows, False))
+    result['build_graph_ms'] = timer.ms
+    result['edges'] = graph.number_of_edges()
+    del rows
+
+    graph_cache = get_cache('default', KEY_PREFIX=CACHE_KEY_PREFIX)
+    with stats.Timer() as timer:
+        set_cached_graph(graph, False, graph_cache)
+    result['cache_set_ms'] = timer.ms
+    with stats.Timer() as timer:
+        cached = get_cached_graph(False, graph_cache)
+    result['cache_get_ms'] = timer.ms
+    result['cache_ok'] = int(
+        cached is not None and
+        cached.number_of_edges() == graph.number_of_edges())
+    delete_cached_graph(False, graph_cache)
+    del cached
+
+    timings = dict(('min_cost_flow_%s' % backend, []) for backend in backends)
+    timings['max_flow'] = []
+    for flow_graph in _flow_graphs(graph, pairs):
+        with stats.Timer() as timer:
+            amount = flow_graph.max_flow()
+        timings['max_flow'].append(timer.ms)
+        if amount == D('Infinity'):
+            amount = D('1000')
+        else:
+            amount = (amount / 2).quantize(D('0.01'))
+        for backend in backends:
+            with stats.Timer() as timer:
+                try:
+                    flow_graph.min_cost_flow(amount, backend)
+                except (NoRoutesError, InsufficientCreditError):
+                    pass
+            timings['min_cost_flow_%s' % backend].append(timer.ms)
+    result['pairs'] = len(timings['max_flow'])
+    for name, values in timings.iteritems():
+        result['%s_ms' % name] = sum(values)
+        result['%s_max_ms' % name] = max(values) if values else 0
+    return result
+
+def _flow_graphs(graph, count):
+    """
+    Generates FlowGraphs for up to count random payer and recipient pairs
+    that have a route between them with some capacity left, trying at most
+    10 times as many pairs.
+    """
+    nodes = graph.nodes()
+    found = 0
+    for attempt in xrange(count * 10):
+        if found == count:
+            break
+        payer, recipient = random.sample(nodes, 2)
+        flow_graph = FlowGraph(Node(alias=payer), Node(alias=recipient),
+                               graph=graph)
+        if recipient in flow_graph.graph:
+            found += 1
+            yield flow_graph
+
+def compare(results, baseline, tolerance=DEFAULT_TOLERANCE):
+    """
+    Compares results with baseline results from an earlier run.  Returns
+    list of (size, name, baseline value, value) for timings more than
+    tolerance (a fraction) slower than the baseline, and for timings
+    missing from results.  Sizes not in results are skipped, so a subset
+    of the baseline sizes can be run.
+    """
+    regressions = []
+    for size, baseline_result in sorted(baseline.iteritems()):
+        if size not in results:
+            continue
+        for name, baseline_value in sorted(baseline_result.iteritems()):
+            if not name.endswith('_ms'):
+                continue
+            value = results[size].get(name)
+            if value is None:
+                regressions.append((size, name, baseline_value, None))
+            elif (value > baseline_value * (1 + tolerance) and
+                    value - baseline_value >= MIN_REGRESSION_MS):
+                regressions.append((size, name, baseline_value, value))
+    return regressions
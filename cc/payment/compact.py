@@ -0,0 +1,131 @@
+"Compact array-backed flow graphs."
+
+from array import array
+from decimal import Decimal as D
+
+import networkx as nx
+
+from cc.account.models import Node
+
+# Stored in the capacity array in place of infinite capacity.
+INFINITE_CAPACITY = -1
+
+class CompactGraph(object):
+    """
+    Flow graph with integer node indices and one entry per edge in parallel
+    arrays, in compressed sparse row (CSR) form.
+
+    Nodes are numbered 0..n-1; self.nodes maps index to node alias and
+    self.node_index maps alias back to index.  Edges are sorted by tail, so
+    the out-edges of node i are the edge indices in
+    range(out_offsets[i], out_offsets[i + 1]).  in_offsets and in_edges do
+    the same for in-edges, holding edge indices sorted by head.
+
+    Each edge has tail, head, key, capacity, weight and creditline_id, which
+    mirror the networkx flow graph built by cc.payment.flow.build_graph.
+    Infinite capacity is stored as INFINITE_CAPACITY.  Edges without a
+    creditline are stored with creditline_id 0.
+    """
+    def __init__(self, nodes, edges):
+        """
+        Takes an iterable of node aliases, and an iterable of
+        (tail, head, key, capacity, weight, creditline_id) tuples where tail
+        and head are node aliases and capacity may be D('Infinity') or None
+        for infinite capacity.
+        """
+        self.nodes = list(nodes)
+        self.node_index = dict(
+            (alias, i) for i, alias in enumerate(self.nodes))
+        self.tail = array('i')
+        self.head = array('i')
+        self.key = array('B')
+        self.capacity = array('l')
+        self.weight = array('l')
+        self.creditline_id = array('l')
+
+        index = self.node_index
+        edge_list = sorted(
+            (index[u], index[v], key, capacity, weight, creditline_id)
+            for u, v, key, capacity, weight, creditline_id in edges)
+        for u, v, key, capacity, weight, creditline_id in edge_list:
+            if capacity is None or capacity == D('Infinity'):
+                capacity = INFINITE_CAPACITY
+            self.tail.append(u)
+            self.head.append(v)
+            self.key.append(key)
+            self.capacity.append(capacity)
+            self.weight.append(weight)
+            self.creditline_id.append(creditline_id or 0)
+
+        self.out_offsets = _offsets(self.tail, len(self.nodes))
+        self.in_edges = array('i', sorted(
+            xrange(len(self.head)), key=self.head.__getitem__))
+        self.in_offsets = _offsets(
+            (self.head[e] for e in self.in_edges), len(self.nodes))
+
+    def __len__(self):
+        "Number of edges."
+        return len(self.tail)
+
+    def out_edges(self, node):
+        "Indices of edges leaving node index."
+        return xrange(self.out_offsets[node], self.out_offsets[node + 1])
+
+    def in_edge_indices(self, node):
+        "Indices of edges entering node index."
+        return self.in_edges[self.in_offsets[node]:self.in_offsets[node + 1]]
+
+    def edge_capacity(self, edge):
+        "Capacity of edge index, or None if it is infinite."
+        capacity = self.capacity[edge]
+        if capacity == INFINITE_CAPACITY:
+            return None
+        return capacity
+
+    @classmethod
+    def from_graph(cls, graph):
+        "Convert a networkx flow graph as returned by build_graph."
+        edges = ((u, v, key, data.get('capacity'), data['weight'],
+                  data.get('creditline_id'))
+                 for u, v, key, data in graph.edges_iter(keys=True, data=True))
+        return cls(graph.nodes_iter(), edges)
+
+    def edges_iter(self):
+        """
+        Iterate over edges as (tail, head, key, capacity, weight,
+        creditline_id) tuples, the same form the constructor takes.
+        """
+        for e in xrange(len(self)):
+            yield (self.nodes[self.tail[e]], self.nodes[self.head[e]],
+                   self.key[e], self.edge_capacity(e), self.weight[e],
+                   self.creditline_id[e] or None)
+
+    def to_graph(self):
+        "Convert back to a networkx flow graph like build_graph returns."
+        graph = nx.MultiDiGraph()
+        graph.add_nodes_from(self.nodes)
+        for u, v, key, capacity, weight, creditline_id in self.edges_iter():
+            graph.add_edge(u, v, key=key, weight=weight,
+                           creditline_id=creditline_id)
+            if capacity is not None:
+                graph[u][v][key]['capacity'] = capacity
+        return graph
+
+def build_compact_graph(ignore_balances):
+    """
+    Build a CompactGraph of all credit lines straight from the database.
+    Nodes are sorted by alias.
+    """
+    from cc.payment.flow import iter_creditline_edges
+
+    nodes = (n.alias for n in Node.objects.order_by('alias').iterator())
+    return CompactGraph(nodes, iter_creditline_edges(ignore_balances))
+
+def _offsets(sorted_indices, node_count):
+    "CSR offsets array for a sorted sequence of node indices."
+    offsets = array('i', [0] * (node_count + 1))
+    for i in sorted_indices:
+        offsets[i + 1] += 1
+    for i in xrange(node_count):
+        offsets[i + 1] += offsets[i]
+    return offsets
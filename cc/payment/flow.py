@@ -1,17 +1,46 @@
 "Network flow computations."
 
+import multiprocessing
+import time
+
 import networkx as nx
 from decimal import Decimal as D
 
 from django.conf import settings
 from django.core.cache import cache
+from django.db import connections
 
-from cc.account.models import CreditLine, Node
+from cc.account.models import CreditLine, CreditLineChange, Node
 from cc.ripple import SCALE  # Number of decimal places in amounts.
-from cc.payment.mincost import min_cost_flow
+from cc.payment import solvers, stats
+from cc.payment.compact import CompactGraph, build_compact_graph
+from cc.payment.maxflow import max_flow, max_flow_cut
+from cc.payment.mincost import MinCostFlowSession
+from cc.payment.snapshot import (
+    GraphSnapshot, get_snapshot, snapshot_path, write_snapshot)
 
 COST_SCALE_FACTOR = 1000000
 
+GRAPH_VERSION_CACHE_KEY = 'flow_graph_version'
+JOURNAL_SEQ_CACHE_KEY = 'flow_graph_journal_seq'
+
+# Nodes per shard of the cached node -> component index; see ComponentIndex.
+COMPONENT_INDEX_SHARD_SIZE = 1000
+
+# Every credit line with its partner's alias, and its balance and limit
+# scaled to ints.
+CREDITLINE_EDGES_SQL = """
+select cl.id, node.alias, partner.alias,
+	cast(round(ac.balance * cl.bal_mult * %(multiplier)d) as bigint),
+	cast(round(cl."limit" * %(multiplier)d) as bigint)
+from account_creditline as cl
+join account_account as ac on cl.account_id = ac.id
+join account_creditline as partner_cl
+	on partner_cl.account_id = cl.account_id and partner_cl.id != cl.id
+join account_node as node on cl.node_id = node.id
+join account_node as partner on partner_cl.node_id = partner.id
+""" % {'multiplier': 10**SCALE}
+
 class PaymentError(Exception):
     "Base class for all payment exceptions."
     pass
@@ -24,44 +53,119 @@ class InsufficientCreditError(PaymentError):
     "Not enough max flow between payer and recipient to make payment."
     pass
 
+class InsufficientMultiCreditError(InsufficientCreditError):
+    """
+    Not enough flow to pay several recipients at once.  max_amounts is a
+    dict of recipient alias: max amount the payer could pay that recipient
+    alone.
+    """
+    def __init__(self, max_amounts):
+        self.max_amounts = max_amounts
+        super(InsufficientMultiCreditError, self).__init__(
+            "Insufficient credit to pay all of %s." %
+            ', '.join(str(alias) for alias in sorted(max_amounts)))
+
+class LimitExceededError(PaymentError):
+    """
+    Posting a routed payment would exceed account limits, because another
+    transaction changed the balances since the route was computed.
+    """
+    def __init__(self, account_ids):
+        self.account_ids = account_ids
+        super(LimitExceededError, self).__init__(
+            "Limit exceeded on account(s) %s." %
+            ', '.join(str(account_id) for account_id in account_ids))
+
 class FlowGraph(object):
-    def __init__(self, payer, recipient, ignore_balances=False):
-        "Takes payer and recipient nodes."
+    def __init__(self, payer, recipient, ignore_balances=False,
+                 max_hops=None, graph=None):
+        """
+        Takes payer and recipient nodes.  The graph is pruned to nodes on
+        some payer -> recipient route no longer than max_hops, which
+        defaults to the PAYMENT_MAX_HOPS setting (None for no limit).
+
+        If graph is given, it is pruned from that full flow graph, which is
+        not modified.  Otherwise, if there is an up to date graph snapshot
+        (see FLOW_GRAPH_SNAPSHOT_DIR setting) containing payer and
+        recipient, the graph is read from that instead of the cache.
+        """
         self.payer = payer
         self.recipient = recipient
-        self.graph = get_graph(self.payer, ignore_balances)
+        if max_hops is None:
+            max_hops = default_max_hops()
+        if graph is not None:
+            # Copy, so demands set on nodes don't end up in graph.
+            self.graph = prune_graph(
+                graph, payer.alias, recipient.alias, max_hops).copy()
+            return
+        self.graph = None
+        snapshot = fresh_snapshot(ignore_balances)
+        if (snapshot is not None and
+                snapshot.index(recipient.alias) is not None):
+            self.graph = snapshot.subgraph(
+                payer.alias, recipient.alias, max_hops)
+        if self.graph is None:
+            self.graph = prune_graph(
+                get_graph(self.payer, ignore_balances),
+                payer.alias, recipient.alias, max_hops)
         
-    def min_cost_flow(self, amount):
+    def min_cost_flow(self, amount, backend=None):
         """
         Determine minimum cost route for given amount between payer and
-        recipient.
+        recipient.  backend names a solver in cc.payment.solvers.BACKENDS;
+        defaults to the PAYMENT_FLOW_BACKEND setting.
         
         Raises NoRoutesError if there is no route from payer to recipient.
         Raises InsufficientCreditError if the network cannot support the
         specified flow amount.
         """
-        self._set_endpoint_demand(amount)
-        if self.recipient.alias not in self.graph.nodes():
+        solve = solvers.get_backend(backend)
+        if self.recipient.alias not in self.graph:
             raise NoRoutesError()
+        self._set_endpoint_demand(amount)
+        solver_stats = {}
+        failed = False
         try:
-            _, flow_dict = min_cost_flow(self.graph)
+            with stats.Timer() as timer:
+                _, edge_flows = solve(self.graph, stats=solver_stats)
         except nx.NetworkXUnfeasible:
+            failed = True
             raise InsufficientCreditError()
         else:
-            amounts = creditline_amounts(flow_dict, self.graph)
+            amounts = creditline_amounts(edge_flows, self.graph)
             return amounts
+        finally:
+            stats.record(
+                'min_cost_flow', payer=self.payer.alias,
+                recipient=self.recipient.alias, amount=str(amount),
+                backend=backend or solvers.default_backend_name(),
+                failed=int(failed), solve_ms=timer.ms,
+                nodes=self.graph.number_of_nodes(),
+                edges=self.graph.number_of_edges(), **solver_stats)
 
     def max_flow(self):
-        if (self.recipient.alias not in self.graph.nodes() or
-            self.payer.alias not in self.graph.nodes()):
-            return 0
-        try:
-            amount = nx.max_flow(
-                unmulti(self.graph), self.payer.alias, self.recipient.alias)
-        except nx.NetworkXUnbounded:
-            return D('Infinity')
-        else:
-            return unscale_flow_amount(amount)
+        solver_stats = {}
+        with stats.Timer() as timer:
+            amount = max_flow_amount(
+                self.graph, self.payer.alias, self.recipient.alias,
+                stats=solver_stats)
+        stats.record(
+            'max_flow', payer=self.payer.alias,
+            recipient=self.recipient.alias, amount=str(amount),
+            solve_ms=timer.ms, nodes=self.graph.number_of_nodes(),
+            edges=self.graph.number_of_edges(), **solver_stats)
+        return amount
+
+    def update_creditlines(self, creditlines, ignore_balances=False):
+        """
+        Updates creditlines in this flow graph, so a payment can be routed
+        again after they change, without reloading the whole graph.
+        """
+        for creditline in creditlines:
+            if (creditline.node.alias in self.graph and
+                    creditline.partner.alias in self.graph):
+                update_creditline_in_graph(
+                    self.graph, creditline, ignore_balances)
             
     def _set_endpoint_demand(self, amount):
         "Add payer and recipient nodes with corresponding demands values."
@@ -69,6 +173,344 @@ class FlowGraph(object):
         self.graph.node[self.recipient.alias]['demand'] = (
             scale_flow_amount(amount))
 
+class MultiFlowGraph(object):
+    """
+    Flow graph for paying several recipients from one payer at once, with a
+    single min cost flow solve.  Like FlowGraph, but pruned to nodes on
+    some route from payer to any of recipients.
+    """
+    def __init__(self, payer, recipients, max_hops=None):
+        "Takes payer node, and a list of distinct recipient nodes."
+        self.payer = payer
+        self.recipients = recipients
+        if max_hops is None:
+            max_hops = default_max_hops()
+        self.max_hops = max_hops
+        self.graph = prune_graph_many(
+            get_graph(payer, ignore_balances=False), payer.alias,
+            [recipient.alias for recipient in recipients], max_hops).copy()
+
+    def min_cost_flows(self, amounts, backend=None):
+        """
+        Determines the minimum cost routes for paying each recipient in
+        amounts, a dict of recipient alias: amount, all at once.  Returns a
+        dict of recipient alias: list of (creditline_id, amount), like
+        FlowGraph.min_cost_flow returns, for each recipient.
+
+        Raises InsufficientMultiCreditError, with the max amount each
+        recipient could be paid alone, if they can't all be paid.
+        """
+        solve = solvers.get_backend(backend)
+        demands = dict((alias, scale_flow_amount(amount))
+                       for alias, amount in amounts.iteritems())
+        solver_stats = {}
+        failed = False
+        timer = None
+        try:
+            if any(alias not in self.graph for alias in demands):
+                raise nx.NetworkXUnfeasible()
+            for alias, demand in demands.iteritems():
+                self.graph.node[alias]['demand'] = demand
+            self.graph.node[self.payer.alias]['demand'] = -sum(
+                demands.itervalues())
+            with stats.Timer() as timer:
+                _, edge_flows = solve(self.graph, stats=solver_stats)
+        except nx.NetworkXUnfeasible:
+            failed = True
+            raise InsufficientMultiCreditError(dict(
+                    (alias, pruned_max_flow_amount(
+                            self.graph, self.payer.alias, alias,
+                            self.max_hops))
+                    for alias in amounts))
+        else:
+            routes = decompose_flow(edge_flows, self.payer.alias, demands)
+            return dict((alias, creditline_amounts(route, self.graph))
+                        for alias, route in routes.iteritems())
+        finally:
+            for alias in demands.keys() + [self.payer.alias]:
+                if alias in self.graph:
+                    self.graph.node[alias].pop('demand', None)
+            stats.record(
+                'min_cost_flow', payer=self.payer.alias,
+                recipients=len(amounts), amount=str(sum(amounts.values())),
+                backend=backend or solvers.default_backend_name(),
+                failed=int(failed), solve_ms=timer and timer.ms,
+                nodes=self.graph.number_of_nodes(),
+                edges=self.graph.number_of_edges(), **solver_stats)
+
+    def update_creditlines(self, creditlines, ignore_balances=False):
+        "Same as FlowGraph.update_creditlines."
+        for creditline in creditlines:
+            if (creditline.node.alias in self.graph and
+                    creditline.partner.alias in self.graph):
+                update_creditline_in_graph(
+                    self.graph, creditline, ignore_balances)
+
+def decompose_flow(edge_flows, source, demands):
+    """
+    Splits a flow from source to several targets into one flow per target.
+    Takes sparse edge_flows of (u, v, key): flow, as solver backends return,
+    and demands, a dict of target: amount of flow it receives.  Returns a
+    dict of target: edge_flows for that target alone.
+
+    Each target's flow is made of paths from source along edges that still
+    have flow left, so the per-target flows add up to the original one.
+    """
+    remaining = dict(edge_flows)
+    out_edges = {}
+    for u, v, key in edge_flows:
+        out_edges.setdefault(u, []).append((u, v, key))
+    routes = {}
+    for target, demand in demands.iteritems():
+        route = routes[target] = {}
+        while demand > 0:
+            path = _flow_path(out_edges, remaining, source, target)
+            flow = min([demand] + [remaining[edge] for edge in path])
+            for edge in path:
+                remaining[edge] -= flow
+                route[edge] = route.get(edge, 0) + flow
+            demand -= flow
+    return routes
+
+def _flow_path(out_edges, remaining, source, target):
+    """
+    Breadth-first search for a path of edges with remaining flow from
+    source to target.  Returns the list of edges.
+    """
+    pred = {source: None}
+    frontier = [source]
+    while frontier and target not in pred:
+        next_frontier = []
+        for node in frontier:
+            for edge in out_edges.get(node, ()):
+                neighbor = edge[1]
+                if neighbor not in pred and remaining[edge] > 0:
+                    pred[neighbor] = edge
+                    next_frontier.append(neighbor)
+        frontier = next_frontier
+    if target not in pred:
+        raise ValueError("Flow does not reach %s." % target)
+    path = []
+    node = target
+    while pred[node] is not None:
+        path.append(pred[node])
+        node = pred[node][0]
+    path.reverse()
+    return path
+
+class SolverSession(object):
+    """
+    Full payment flow graph kept prepared for routing many payments in a
+    row, as cc.payment.worker.PaymentWorker does.  Routes are solved with a
+    MinCostFlowSession over the whole graph, so no per-payment pruning,
+    copying or validation is needed.
+
+    All credit line changes must be applied through update_creditlines, to
+    keep the graph and the solver's state in step.
+    """
+    def __init__(self, graph):
+        self.graph = graph
+        self.solver = MinCostFlowSession(graph)
+
+    def min_cost_flow(self, payer, recipient, amount):
+        """
+        Same as FlowGraph(payer, recipient).min_cost_flow(amount).  If the
+        PAYMENT_MAX_HOPS setting is on, the graph is pruned for this
+        payment as FlowGraph does, since the solver session can't limit
+        route length.
+        """
+        if payer.alias not in self.graph:
+            raise NoRoutesError()
+        if default_max_hops() is not None:
+            return FlowGraph(payer, recipient, graph=self.graph).min_cost_flow(
+                amount)
+        solver_stats = {}
+        failed = False
+        try:
+            with stats.Timer() as timer:
+                _, edge_flows = self.solver.solve(
+                    payer.alias, recipient.alias, scale_flow_amount(amount),
+                    stats=solver_stats)
+        except nx.NetworkXNoPath:
+            failed = True
+            raise NoRoutesError()
+        except nx.NetworkXUnfeasible:
+            failed = True
+            raise InsufficientCreditError()
+        else:
+            return creditline_amounts(edge_flows, self.graph)
+        finally:
+            stats.record(
+                'min_cost_flow', payer=payer.alias, recipient=recipient.alias,
+                amount=str(amount), backend='session', failed=int(failed),
+                solve_ms=timer.ms, **solver_stats)
+
+    def update_creditlines(self, creditlines, removals=()):
+        """
+        Updates changed creditlines in the graph and the solver session,
+        and removes deleted credit lines given as (creditline_id, node
+        alias, partner alias) removals.
+        """
+        pairs = set()
+        for creditline in creditlines:
+            update_creditline_in_graph(self.graph, creditline, False)
+            pairs.add((creditline.node.alias, creditline.partner.alias))
+        for creditline_id, src, dest in removals:
+            remove_creditline_from_graph(self.graph, creditline_id, src, dest)
+            pairs.add((src, dest))
+        self.solver.update_edges(pairs)
+
+def max_flows(payers, recipient, ignore_balances=False, processes=None,
+              dependencies=False):
+    """
+    Returns list of max flow amounts from each of payers to recipient.
+
+    Loads the flow graph only once for all payers, or uses the graph
+    snapshot if there is an up to date one.  If processes is given, the
+    flows are computed in a pool of that many worker processes, which each
+    get a copy of the graph when they start.
+
+    If dependencies is True, returns a list of (amount, dependencies) tuples
+    like max_flow_dependencies instead, computed from the cached graph.
+    """
+    max_hops = default_max_hops()
+    if dependencies:
+        graph = get_graph(recipient, ignore_balances)
+    else:
+        graph = fresh_snapshot(ignore_balances)
+        if graph is None or graph.index(recipient.alias) is None:
+            graph = get_graph(recipient, ignore_balances)
+    args = [(payer.alias, recipient.alias, max_hops) for payer in payers]
+    if dependencies:
+        # Payers outside recipient's component depend on their own one.
+        outside = dict(
+            (payer.alias, max_flow_dependencies(
+                    get_graph(payer, ignore_balances), payer.alias,
+                    recipient.alias, max_hops))
+            for payer in payers if payer.alias not in graph)
+        args = [arg for arg in args if arg[0] not in outside]
+    results = _map_over_graph(
+        max_flow_dependencies if dependencies else pruned_max_flow_amount,
+        graph, args, processes)
+    if dependencies:
+        results = dict(zip([arg[0] for arg in args], results))
+        results.update(outside)
+        results = [results[payer.alias] for payer in payers]
+    return results
+
+def pair_max_flows(graph, pairs, processes=None, dependencies=False):
+    """
+    Returns list of max flow amounts for each (payer, recipient) pair of
+    aliases over graph, across a pool of processes if given.
+
+    If dependencies is True, returns a list of (amount, dependencies) tuples
+    like max_flow_dependencies instead, so graph must be a whole component.
+    """
+    max_hops = default_max_hops()
+    return _map_over_graph(
+        max_flow_dependencies if dependencies else pruned_max_flow_amount,
+        graph,
+        [(payer, recipient, max_hops) for payer, recipient in pairs],
+        processes)
+
+def component_graphs(ignore_balances):
+    """
+    Generates a graph for each weakly connected component of a flow graph
+    built fresh from the database.
+    """
+    graph = build_graph(ignore_balances)
+    for nodes in nx.weakly_connected_components(graph):
+        yield graph.subgraph(nodes)
+
+def pruned_max_flow_amount(graph, payer, recipient, max_hops=None):
+    """
+    Prunes graph for payer and recipient aliases, then returns max flow.
+    graph may also be a GraphSnapshot, whose arrays the max flow is then
+    computed on directly.
+    """
+    if isinstance(graph, GraphSnapshot):
+        try:
+            return unscale_flow_amount(
+                graph.max_flow(payer, recipient, max_hops))
+        except nx.NetworkXUnbounded:
+            return D('Infinity')
+    elif payer not in graph:
+        return 0
+    else:
+        graph = prune_graph(graph, payer, recipient, max_hops)
+    return max_flow_amount(graph, payer, recipient)
+
+def max_flow_amount(graph, payer, recipient, stats=None):
+    """
+    Returns max flow between payer and recipient aliases as a decimal.
+    Stores solver counts in stats dict if given; see maxflow.max_flow.
+    """
+    if recipient not in graph or payer not in graph:
+        return 0
+    try:
+        amount = max_flow(graph, payer, recipient, stats=stats)
+    except nx.NetworkXUnbounded:
+        return D('Infinity')
+    else:
+        return unscale_flow_amount(amount)
+
+def max_flow_dependencies(graph, payer, recipient, max_hops=None):
+    """
+    Returns (max flow amount, dependencies) between payer and recipient
+    aliases over graph, which must be the whole component containing payer.
+    Dependencies is a set of node aliases such that the max flow can't
+    change unless the credit lines owned by one of those nodes change: the
+    source side of a minimum cut, and the nodes the flow passes through.
+
+    With max_hops, the dependencies are every node reachable from payer,
+    since raising a limit anywhere there could shorten a route.
+    """
+    if payer not in graph:
+        return 0, set([payer])
+    forward = _hop_distances(graph.succ, [payer], None)
+    if max_hops is not None or recipient not in forward:
+        return (pruned_max_flow_amount(graph, payer, recipient, max_hops),
+                set(forward))
+    pruned = prune_graph(graph, payer, recipient)
+    try:
+        amount, source_side, flow_nodes = max_flow_cut(
+            pruned, payer, recipient)
+    except nx.NetworkXUnbounded:
+        return D('Infinity'), set(pruned)
+    # Nodes reachable from payer that were pruned for not reaching recipient
+    # are on the source side too.
+    source_side.update(node for node in forward if node not in pruned)
+    return unscale_flow_amount(amount), source_side | flow_nodes
+
+def _map_over_graph(function, graph, args, processes=None):
+    """
+    Returns [function(graph, *arg) for arg in args].  If processes is given,
+    computes them in a pool of that many worker processes, which each get a
+    copy of graph when they start.  Function must be module level.
+    """
+    if not processes:
+        return [function(graph, *arg) for arg in args]
+    pool = multiprocessing.Pool(processes, _init_pool_graph, (graph,))
+    try:
+        return pool.map(_pool_apply, [(function, arg) for arg in args])
+    finally:
+        pool.close()
+        pool.join()
+
+# Flow graph for worker processes.
+_pool_graph = None
+
+def _init_pool_graph(graph):
+    global _pool_graph
+    _pool_graph = graph
+
+def _pool_apply(args):
+    function, arg = args
+    return function(_pool_graph, *arg)
+
+def default_max_hops():
+    return getattr(settings, 'PAYMENT_MAX_HOPS', None)
+
 def get_graph(seed_node, ignore_balances=False, rebuild_graph=False):
     """
     Get flow graph for performing payment computations.
@@ -96,69 +538,725 @@ def get_graph(seed_node, ignore_balances=False, rebuild_graph=False):
     amount.
 
     Flow graph nodes are node aliases.
+
+    Each weakly connected component of the full graph is cached separately,
+    along with a sharded index of which component each node is in (see
+    ComponentIndex), so only the seed node's component and index shard are
+    loaded.
+
+    A seed node with no credit lines gets a graph of just itself, without
+    building the full graph.
+
+    If the FLOW_GRAPH_JOURNAL setting is on, the returned graph's
+    graph.graph['journal_seq'] holds the journal sequence number it was read
+    at; see journal_lag.
     """
-    graph = None
-    rebuilt = False
+    journal_seq = None
+    if using_journal():
+        # Read before component, so component is at least this fresh.
+        journal_seq = get_journal_seq()
+    component = None
     if not rebuild_graph:
+        component_id = get_cached_component_id(
+            seed_node.alias, ignore_balances)
+        if component_id is not None:
+            component = cache.get(component_cache_key(
+                    ignore_balances, component_id))
+    cache_hit = component is not None
+    timer = None
+    if component is None and not CreditLine.objects.filter(
+            node__alias=seed_node.alias).exists():
+        # Seed node has no credit lines (yet), so it is on its own.
+        component = nx.MultiDiGraph()
+        component.add_node(seed_node.alias)
+    elif component is None:
+        # Seed node or its component not in cache - rebuild.
+        with stats.Timer() as timer:
+            graph = build_graph(ignore_balances)
+            if using_journal():
+                # Only the journal applier writes the cached graphs, so
+                # leave it a note to rebuild them.
+                cache.set(rebuild_cache_key(ignore_balances), True, None)
+            else:
+                set_cached_graph(graph, ignore_balances)
+        component = weak_component(graph, seed_node.alias)
+    component.graph['journal_seq'] = journal_seq
+    stats.record(
+        'get_graph', seed=seed_node.alias,
+        ignore_balances=ignore_balances, cache_hit=int(cache_hit),
+        cache_miss=int(not cache_hit), rebuild_ms=timer and timer.ms,
+        nodes=component.number_of_nodes(),
+        edges=component.number_of_edges())
+    return component
+
+def weak_component(graph, node):
+    "Returns the weakly connected component of graph containing node alias."
+    for nodes in nx.weakly_connected_components(graph):
+        if node in nodes:
+            return graph.subgraph(nodes)
+    return graph.subgraph([node])
+
+def prune_graph(graph, payer, recipient, max_hops=None):
+    """
+    Returns the subgraph of graph containing only nodes that are reachable
+    from payer and can reach recipient, following edges with nonzero
+    capacity.  Other nodes cannot be on any route, so they only slow down
+    flow computations.  If max_hops is given, also drops nodes that are
+    only on routes longer than max_hops edges.
+
+    Takes payer and recipient node aliases.  If recipient cannot be reached,
+    the result contains only payer, or nothing if payer is not in graph,
+    such as a new node with no accounts.
+    """
+    if payer not in graph:
+        return graph.subgraph([])
+    forward = _hop_distances(graph.succ, [payer], max_hops)
+    if recipient not in forward:
+        return graph.subgraph([payer])
+    backward = _hop_distances(graph.pred, [recipient], max_hops)
+    nodes = [node for node, hops in forward.iteritems()
+             if node in backward and (
+                max_hops is None or hops + backward[node] <= max_hops)]
+    return graph.subgraph(nodes)
+
+def prune_graph_many(graph, payer, recipients, max_hops=None):
+    """
+    Same as prune_graph, but keeps nodes on routes from payer to any of
+    recipients.
+    """
+    if payer not in graph:
+        return graph.subgraph([])
+    if max_hops is not None:
+        # Each node's route length depends on the recipient.
+        nodes = set([payer])
+        for recipient in recipients:
+            nodes.update(prune_graph(graph, payer, recipient, max_hops))
+        return graph.subgraph(nodes)
+    forward = _hop_distances(graph.succ, [payer], None)
+    backward = _hop_distances(
+        graph.pred, [r for r in recipients if r in forward], None)
+    return graph.subgraph(
+        [payer] + [node for node in forward if node in backward])
+
+def _hop_distances(adjacency, starts, max_hops):
+    """
+    Breadth-first search from starts across adjacency dict (graph.succ or
+    graph.pred) over edges with nonzero capacity.  Returns dict of node:
+    hops from the nearest start, stopping at max_hops.
+    """
+    hops = dict((start, 0) for start in starts)
+    frontier = list(starts)
+    distance = 0
+    while frontier and (max_hops is None or distance < max_hops):
+        distance += 1
+        next_frontier = []
+        for node in frontier:
+            for neighbor, edge_dict in adjacency[node].iteritems():
+                if neighbor in hops:
+                    continue
+                if any(data.get('capacity') != 0
+                       for data in edge_dict.itervalues()):
+                    hops[neighbor] = distance
+                    next_frontier.append(neighbor)
+        frontier = next_frontier
+    return hops
+
+def write_graph_snapshots():
+    """
+    Writes snapshots of both payment and reputation graphs to
+    FLOW_GRAPH_SNAPSHOT_DIR, from the cached graphs, or the database if
+    they are not cached, unless the existing snapshots are up to date.
+    Returns the number of snapshots written.
+    """
+    if snapshot_path(cache_key(False)) is None:
+        return 0
+    # Read before the graphs, so they are at least this fresh.
+    seq = snapshot_seq()
+    written = 0
+    for ignore_balances in (False, True):
+        name = cache_key(ignore_balances)
+        snapshot = get_snapshot(name)
+        if snapshot is not None and snapshot.seq >= seq:
+            continue
         graph = get_cached_graph(ignore_balances)
-    if not graph:
-        graph = build_graph(ignore_balances)
-        set_cached_graph(graph, ignore_balances)
-        rebuilt = True
-    # Get subgraph component containing seed_node.
-    for component in nx.weakly_connected_component_subgraphs(graph):
-        if seed_node.alias in component:
-            return component
-    # Seed node not in cached graph - rebuild and try again.
-    if not rebuilt:
-        return get_graph(seed_node, ignore_balances, rebuild_graph=True)
-    # Something's not coded right...
-    assert(False)  # Should never get here.
-
-def get_cached_graph(ignore_balances):
-    return cache.get(cache_key(ignore_balances))
-
-def set_cached_graph(graph, ignore_balances):
-    cache.set(cache_key(ignore_balances), graph)
+        if graph is None:
+            compact = build_compact_graph(ignore_balances)
+        else:
+            compact = CompactGraph.from_graph(graph)
+        write_snapshot(compact, snapshot_path(name), seq)
+        written += 1
+    return written
+
+def fresh_snapshot(ignore_balances):
+    """
+    Returns the graph snapshot, if there is one and it is as fresh as the
+    cached graph.
+    """
+    snapshot = get_snapshot(cache_key(ignore_balances))
+    if snapshot is not None and snapshot.seq >= snapshot_seq():
+        return snapshot
+    return None
+
+def snapshot_seq():
+    """
+    Number that goes up as the cached graphs change, stored in snapshots
+    written from them, so stale snapshots can be told: the journal seq
+    with the FLOW_GRAPH_JOURNAL setting on, and otherwise the graph
+    version.
+    """
+    if using_journal():
+        return get_journal_seq()
+    return graph_version()
+
+def get_cached_graph(ignore_balances, graph_cache=cache):
+    """
+    Reassembles the full cached graph from its components.  Returns None if
+    the graph or any of its components is not cached.
+
+    graph_cache is the cache to use, here and in the other cached graph
+    functions that take it; it is only ever changed for benchmarks.
+    """
+    index = get_cached_component_index(ignore_balances, graph_cache)
+    if index is None:
+        return None
+    keys = [component_cache_key(ignore_balances, component_id)
+            for component_id in set(index.itervalues())]
+    components = graph_cache.get_many(keys)
+    if len(components) != len(keys):
+        return None
+    graph = nx.MultiDiGraph()
+    for component in components.itervalues():
+        graph.add_nodes_from(component.nodes_iter(data=True))
+        graph.add_edges_from(component.edges_iter(keys=True, data=True))
+    return graph
+
+def set_cached_graph(graph, ignore_balances, graph_cache=cache):
+    """
+    Caches each weakly connected component of graph, and the index of node
+    alias: component ID.  Returns the index.
+    """
+    index = {}
+    components = {}
+    for nodes in nx.weakly_connected_components(graph):
+        component_id = min(nodes)
+        for node in nodes:
+            index[node] = component_id
+        components[component_cache_key(ignore_balances, component_id)] = (
+            graph.subgraph(nodes))
+    graph_cache.set_many(components)
+    set_cached_component_index(index, ignore_balances, graph_cache)
+    return index
+
+def delete_cached_graph(ignore_balances, graph_cache=cache):
+    "Deletes the cached graph's components and index."
+    shard_count = graph_cache.get(component_index_cache_key(ignore_balances))
+    if shard_count is None:
+        return
+    keys = [component_index_shard_cache_key(ignore_balances, shard)
+            for shard in xrange(shard_count)]
+    for shard in graph_cache.get_many(keys).itervalues():
+        keys.extend(component_cache_key(ignore_balances, component_id)
+                    for component_id in set(shard.itervalues()))
+    graph_cache.delete(component_index_cache_key(ignore_balances))
+    graph_cache.delete_many(keys)
+
+class ComponentIndex(object):
+    """
+    The cached index of node alias: ID of the cached component the node is
+    in.  It is split into shards of about COMPONENT_INDEX_SHARD_SIZE nodes
+    by alias, each cached separately, so looking up one node only loads
+    its shard.  The shard count is cached under component_index_cache_key,
+    which is only there while the whole index is.
+
+    Shards are loaded as they are needed.  A shard missing from the cache
+    raises KeyError, like a missing component does in _join_components.
+    """
+    def __init__(self, ignore_balances):
+        self.ignore_balances = ignore_balances
+        self.shard_count = cache.get(component_index_cache_key(
+                ignore_balances))
+        self.shards = {}
+        self.changed = set()
+
+    def is_cached(self):
+        return self.shard_count is not None
+
+    def get(self, alias):
+        return self._shard(alias).get(alias)
+
+    def __setitem__(self, alias, component_id):
+        self._shard(alias)[alias] = component_id
+        self.changed.add(alias % self.shard_count)
+
+    def save(self):
+        "Writes changed shards back to the cache."
+        cache.set_many(dict(
+                (component_index_shard_cache_key(self.ignore_balances, shard),
+                 self.shards[shard]) for shard in self.changed))
+        self.changed = set()
+
+    def _shard(self, alias):
+        shard = alias % self.shard_count
+        if shard not in self.shards:
+            self.shards[shard] = cache.get(component_index_shard_cache_key(
+                    self.ignore_balances, shard))
+            if self.shards[shard] is None:
+                del self.shards[shard]
+                raise KeyError(shard)
+        return self.shards[shard]
+
+def get_cached_component_id(alias, ignore_balances):
+    """
+    Returns the ID of the cached component containing node alias, or None
+    if it is not in the cached index.
+    """
+    index = ComponentIndex(ignore_balances)
+    if not index.is_cached():
+        return None
+    try:
+        return index.get(alias)
+    except KeyError:
+        return None
+
+def get_cached_component_index(ignore_balances, graph_cache=cache):
+    """
+    Returns the whole cached index as a dict of node alias: component ID,
+    or None if it is not cached.
+    """
+    shard_count = graph_cache.get(component_index_cache_key(ignore_balances))
+    if shard_count is None:
+        return None
+    keys = [component_index_shard_cache_key(ignore_balances, shard)
+            for shard in xrange(shard_count)]
+    shards = graph_cache.get_many(keys)
+    if len(shards) != len(keys):
+        return None
+    index = {}
+    for shard in shards.itervalues():
+        index.update(shard)
+    return index
+
+def set_cached_component_index(index, ignore_balances, graph_cache=cache):
+    shard_count = max(1, -(-len(index) // COMPONENT_INDEX_SHARD_SIZE))
+    shards = dict((component_index_shard_cache_key(ignore_balances, shard), {})
+                  for shard in xrange(shard_count))
+    for alias, component_id in index.iteritems():
+        shards[component_index_shard_cache_key(
+                ignore_balances, alias % shard_count)][alias] = component_id
+    graph_cache.set_many(shards)
+    # Last, so the index only shows as cached once all shards are.
+    graph_cache.set(component_index_cache_key(ignore_balances), shard_count)
 
 def cache_key(ignore_balances):
     return 'reputation_graph' if ignore_balances else 'payment_graph'
 
+def rebuild_cache_key(ignore_balances):
+    return '%s_rebuild' % cache_key(ignore_balances)
+
+def component_index_cache_key(ignore_balances):
+    return '%s_components' % cache_key(ignore_balances)
+
+def component_index_shard_cache_key(ignore_balances, shard):
+    return '%s_index_%s' % (cache_key(ignore_balances), shard)
+
+def component_cache_key(ignore_balances, component_id):
+    return '%s_component_%s' % (cache_key(ignore_balances), component_id)
+
+def get_journal_seq():
+    """
+    Number of journalled changes applied to the cached graphs so far, which
+    only goes up.  Unlike journal entry ids, it follows the order changes
+    were applied in, whatever order their transactions committed in.
+    """
+    return _get_counter(JOURNAL_SEQ_CACHE_KEY)
+
+def _advance_journal_seq(count):
+    cache.add(JOURNAL_SEQ_CACHE_KEY, _initial_version(), None)
+    cache.incr(JOURNAL_SEQ_CACHE_KEY, count)
+
+def node_version_cache_key(ignore_balances, alias):
+    return '%s_node_version_%s' % (cache_key(ignore_balances), alias)
+
+def graph_version():
+    """
+    Number that changes whenever any credit line changes, both when the
+    change is made and when it is applied to the cached graphs, so results
+    computed from the flow graphs can be checked for staleness.
+    """
+    return _get_counter(GRAPH_VERSION_CACHE_KEY)
+
+def _bump_graph_version():
+    cache.add(GRAPH_VERSION_CACHE_KEY, _initial_version(), None)
+    cache.incr(GRAPH_VERSION_CACHE_KEY)
+
+def _get_counter(key):
+    """
+    Returns the value of a cached counter that only goes up, starting it
+    from _initial_version if it is not cached.
+    """
+    value = cache.get(key)
+    if value is None:
+        cache.add(key, _initial_version(), None)
+        value = cache.get(key)
+    return value
+
+def get_node_versions(aliases, ignore_balances):
+    """
+    Returns dict of alias: version for nodes, where a node's version changes
+    whenever the edges of credit lines it owns change in the cached graph.
+    A max flow that only depends on some nodes' credit lines (see
+    max_flow_dependencies) is still valid while their versions are
+    unchanged.
+    """
+    keys = dict((node_version_cache_key(ignore_balances, alias), alias)
+                for alias in aliases)
+    versions = cache.get_many(keys.keys())
+    missing = [key for key in keys if key not in versions]
+    if missing:
+        for key in missing:
+            cache.add(key, _initial_version(), None)
+        versions.update(cache.get_many(missing))
+    return dict((keys[key], version) for key, version in versions.items())
+
+def _bump_node_versions(aliases, ignore_balances):
+    for alias in aliases:
+        key = node_version_cache_key(ignore_balances, alias)
+        cache.add(key, _initial_version(), None)
+        cache.incr(key)
+
+def _initial_version():
+    """
+    Start cached counters (node versions, the graph version and the journal
+    seq) from the time in microseconds, so a counter that was evicted from
+    the cache doesn't restart from a value it has already had.  Otherwise
+    snapshots and results stamped with an old value would look fresh again.
+    """
+    return int(time.time() * 1000000)
+
+def journal_lag(graph):
+    """
+    Returns the number of journalled changes that may be missing from a
+    graph returned by get_graph: those applied to the cached graphs since
+    it was read, and those still waiting in the journal.
+    """
+    applied = get_journal_seq() - (graph.graph.get('journal_seq') or 0)
+    return max(applied, 0) + CreditLineChange.objects.count()
+
+def using_journal():
+    return getattr(settings, 'FLOW_GRAPH_JOURNAL', False)
+
 def update_creditline_in_cached_graphs(creditline):
+    "Updates creditline in both payment and reputation graphs."
+    update_creditlines_in_cached_graphs([creditline])
+
+def update_creditlines_in_cached_graphs(creditlines):
     """
-    Updates creditline in both payment and reputation graphs.
-    *** Not threadsafe! ***
+    Updates creditlines in both payment and reputation graphs.
+
+    If the FLOW_GRAPH_JOURNAL setting is on, the changes are only recorded
+    in the CreditLineChange journal, and bin/update_cached_graphs.py applies
+    them.  Otherwise they are applied right away.
+    *** Not threadsafe without the journal! ***
     """
-    # Update in both cached graphs.
-    for ignore_balances in (False, True):
-        graph = get_cached_graph(ignore_balances)
-        if not graph:
-            continue
+    _bump_graph_version()
+    if using_journal():
+        CreditLineChange.objects.bulk_create(
+            [CreditLineChange(creditline_id=creditline.id)
+             for creditline in creditlines if creditline.id])
+        return
+    # Reload records to get absolute freshest data possible.
+    fresh = dict((creditline.id, creditline) for creditline in
+                 load_creditlines(CreditLine.objects.filter(pk__in=[
+                    creditline.id for creditline in creditlines
+                    if creditline.id])))
+    reloaded = []
+    for creditline in creditlines:
         if creditline.id:
-            # Reload record to get absolute freshest data possible.
-            try:
-                creditline = CreditLine.objects.get(pk=creditline.id)
-            except CreditLine.DoesNotExist:
-                creditline.id = None
-        update_creditline_in_graph(graph, creditline, ignore_balances)
-        set_cached_graph(graph, ignore_balances)
+            if creditline.id not in fresh:
+                continue  # Deleted; see remove_account_from_cached_graphs.
+            creditline = fresh[creditline.id]
+        reloaded.append(creditline)
+    for ignore_balances in (False, True):
+        _update_cached_graph(reloaded, ignore_balances)
+
+def load_creditlines(creditlines):
+    """
+    Returns a list of the credit lines in queryset creditlines, with the
+    account, node, partner credit line and partner node of each loaded, so
+    updating their graph edges doesn't query for them one at a time.  Takes
+    one query, or two if some partner credit lines aren't in creditlines.
+    """
+    creditlines = list(creditlines.select_related('account', 'node'))
+    by_account = {}
+    for creditline in creditlines:
+        by_account.setdefault(creditline.account_id, {})[
+            creditline.node_id] = creditline
+    missing = [account_id for account_id, pair in by_account.iteritems()
+               if len(pair) < 2]
+    if missing:
+        for partner in CreditLine.objects.select_related('node').filter(
+                account__in=missing):
+            by_account[partner.account_id].setdefault(
+                partner.node_id, partner)
+    for creditline in creditlines:
+        for node_id, partner in by_account[creditline.account_id].iteritems():
+            if node_id != creditline.node_id:
+                # Where the cached partner_creditline property keeps it.
+                creditline._cached_partner_creditline = partner
+    return creditlines
+
+def remove_account_from_cached_graphs(creditline):
+    """
+    Removes deleted creditline and its partner credit line, the whole
+    account, from both payment and reputation graphs.  The credit line's
+    node and partner credit line must have been loaded before they were
+    deleted, since they can't be afterwards.
+
+    Journalled like update_creditlines_in_cached_graphs, with the node
+    aliases, so the journal applier doesn't have to reload anything.
+    """
+    _bump_graph_version()
+    partner_creditline = creditline.partner_creditline
+    src, dest = creditline.node.alias, partner_creditline.node.alias
+    removals = [(creditline.id, src, dest),
+                (partner_creditline.id, dest, src)]
+    if using_journal():
+        CreditLineChange.objects.bulk_create(
+            [CreditLineChange(creditline_id=cl_id, node_alias=node_alias,
+                              partner_alias=partner_alias)
+             for cl_id, node_alias, partner_alias in removals])
+        return
+    for ignore_balances in (False, True):
+        _update_cached_graph([], ignore_balances, removals)
+
+def apply_journal(batch_size=1000, session=None):
+    """
+    Applies up to batch_size journalled credit line changes to both cached
+    graphs, and removes them from the journal.  Returns the number of
+    changes applied.
+
+    Must only be run from one process at a time, which is then the only one
+    writing the cached graphs: if either graph is not cached, or get_graph
+    had to rebuild it because a node or component was missing from the
+    cache, it is rebuilt here first.  Since only the entries applied are
+    deleted, every entry left in the journal is still to be applied,
+    including ones whose transactions committed after entries with higher
+    ids were applied.
+
+    If session is given, every change in the batch is also applied to that
+    SolverSession, such as the one kept in memory by
+    cc.payment.worker.PaymentWorker.
+
+    Each credit line is reloaded once per batch, so repeated changes to it
+    cost no extra work.  Changes to credit lines that have since been
+    deleted are skipped, since the deletion is journalled too.
+
+    Afterwards, graph snapshots are rewritten if they are configured and
+    have fallen behind.
+    """
+    for ignore_balances in (False, True):
+        if (cache.get(rebuild_cache_key(ignore_balances)) or
+                not ComponentIndex(ignore_balances).is_cached()):
+            # Cleared first, so a miss during the rebuild asks for another.
+            cache.delete(rebuild_cache_key(ignore_balances))
+            set_cached_graph(build_graph(ignore_balances), ignore_balances)
+    changes = list(CreditLineChange.objects.order_by('pk')[:batch_size])
+    if changes:
+        _apply_changes(changes, session)
+    write_graph_snapshots()
+    return len(changes)
+
+def _apply_changes(changes, session):
+    "Applies and deletes CreditLineChange entries; see apply_journal."
+    removals = [(change.creditline_id, change.node_alias,
+                 change.partner_alias)
+                for change in changes if change.node_alias is not None]
+    creditlines = load_creditlines(CreditLine.objects.filter(pk__in=set(
+                change.creditline_id for change in changes
+                if change.node_alias is None)))
+    if session is not None:
+        session.update_creditlines(creditlines, removals)
+    for ignore_balances in (False, True):
+        # If a component was evicted meanwhile, the graph is rebuilt on the
+        # next run.
+        _update_cached_graph(creditlines, ignore_balances, removals)
+    _advance_journal_seq(len(changes))
+    CreditLineChange.objects.filter(
+        pk__in=[change.id for change in changes]).delete()
+
+def _update_cached_graph(creditlines, ignore_balances, removals=()):
+    """
+    Updates creditlines in one cached graph, and removes deleted credit
+    lines given as (creditline_id, node alias, partner alias) removals,
+    loading and writing each affected component only once.  Returns False
+    if the graph is not cached.
+
+    Afterwards bumps the node versions of the owners of credit lines whose
+    edges changed (all of them, if the graph is not cached), then the graph
+    version.
+    """
+    changed_nodes = set(creditline.node.alias for creditline in creditlines)
+    changed_nodes.update(src for _, src, _ in removals)
+    try:
+        return _update_cached_components(
+            creditlines, ignore_balances, removals, changed_nodes)
+    finally:
+        _bump_node_versions(changed_nodes, ignore_balances)
+        _bump_graph_version()
+
+def _update_cached_components(creditlines, ignore_balances, removals,
+                              changed_nodes):
+    """
+    Does the work of _update_cached_graph.  If the graph is cached,
+    changed_nodes is narrowed down to the owners of credit lines whose
+    edges actually changed.
+    """
+    index = ComponentIndex(ignore_balances)
+    if not index.is_cached():
+        return False
+    components = {}  # Component ID: component graph, or None if merged away.
+    index_changed = False
+    edges_changed = set()
+    try:
+        for creditline in creditlines:
+            src, dest = creditline.node.alias, creditline.partner.alias
+            component_id, changed = _join_components(
+                index, components, src, dest, ignore_balances)
+            index_changed = index_changed or changed
+            component = components[component_id]
+            old_edges = dict(component.succ.get(src, {}).get(dest, {}))
+            update_creditline_in_graph(component, creditline, ignore_balances)
+            if component.succ[src].get(dest, {}) != old_edges:
+                edges_changed.add(src)
+        for creditline_id, src, dest in removals:
+            component_id, changed = _join_components(
+                index, components, src, dest, ignore_balances)
+            index_changed = index_changed or changed
+            if remove_creditline_from_graph(
+                    components[component_id], creditline_id, src, dest):
+                edges_changed.add(src)
+    except KeyError:
+        # Component was evicted; rebuild everything on next get_graph.
+        cache.delete(component_index_cache_key(ignore_balances))
+        return False
+    updated = {}
+    for component_id, component in components.items():
+        key = component_cache_key(ignore_balances, component_id)
+        if component is None:
+            cache.delete(key)
+        else:
+            updated[key] = component
+    cache.set_many(updated)
+    if index_changed:
+        index.save()
+    changed_nodes.intersection_update(edges_changed)
+    return True
+
+def _join_components(index, components, src, dest, ignore_balances):
+    """
+    Makes sure nodes src and dest are in the same component, merging their
+    components if necessary.  Components are loaded from the cache into the
+    components dict as needed; merged-away ones are set to None there.
+    Returns (component_id, whether index changed).  Raises KeyError if a
+    component is missing from the cache.
+
+    Components are only ever merged, union-find style, with the smaller
+    one's nodes relabelled in the index.  Components are not split when
+    credit lines go away; a component that is no longer connected is still
+    fine to route over, since FlowGraph prunes it first.
+    """
+    def load(component_id):
+        if component_id not in components:
+            component = cache.get(
+                component_cache_key(ignore_balances, component_id))
+            if component is None:
+                raise KeyError(component_id)
+            components[component_id] = component
+        return components[component_id]
+
+    src_id = index.get(src)
+    dest_id = index.get(dest)
+    if src_id is None and dest_id is None:
+        component_id = min(src, dest)
+        components[component_id] = nx.MultiDiGraph()
+    elif src_id is None or dest_id is None or src_id == dest_id:
+        component_id = src_id if src_id is not None else dest_id
+        load(component_id)
+    else:
+        # Merge smaller component into larger.
+        if len(load(src_id)) < len(load(dest_id)):
+            src_id, dest_id = dest_id, src_id
+        component_id, component, other = (
+            src_id, components[src_id], components[dest_id])
+        component.add_nodes_from(other.nodes_iter(data=True))
+        component.add_edges_from(other.edges_iter(keys=True, data=True))
+        for node in other:
+            index[node] = component_id
+        components[dest_id] = None
+    components[component_id].add_nodes_from((src, dest))
+    if src_id != component_id or dest_id != component_id:
+        index[src] = index[dest] = component_id
+        return component_id, True
+    return component_id, False
 
 def build_graph(ignore_balances):
+    return graph_from_edges((n.alias for n in Node.objects.iterator()),
+                            iter_creditline_edges(ignore_balances))
+
+def graph_from_edges(nodes, edges):
+    """
+    Builds a flow graph from node aliases, and (src, dest, key, capacity,
+    weight, creditline_id) edges as generated by iter_creditline_edges.
+    """
     graph = nx.MultiDiGraph()
-    graph.add_nodes_from((n.alias for n in Node.objects.iterator()))
-    creditlines = CreditLine.objects.select_related(depth=1).iterator()
+    graph.add_nodes_from(nodes)
+    for src, dest, key, capacity, weight, creditline_id in edges:
+        graph.add_edge(src, dest, key=key, weight=weight,
+                       creditline_id=creditline_id)
+        # Infinite capacity is indicated by not adding a capacity.
+        if capacity != D('Infinity'):
+            graph[src][dest][key]['capacity'] = capacity
+    return graph
+
+def iter_creditline_edges(ignore_balances, chunk_size=1000):
+    """
+    Generates (src, dest, key, capacity, weight, creditline_id) for every
+    flow graph edge of every credit line, from a single query that joins
+    each credit line to its account and partner, and scales amounts to ints
+    in the database.  Rows are fetched chunk_size at a time.
+    """
+    cursor = connections['ripple'].cursor()
+    cursor.execute(CREDITLINE_EDGES_SQL)
+    while True:
+        rows = cursor.fetchmany(chunk_size)
+        if not rows:
+            break
+        for edge in creditline_edges(rows, ignore_balances):
+            yield edge
+
+def creditline_edges(rows, ignore_balances):
+    """
+    Generates flow graph edges from (creditline_id, src, dest, balance,
+    limit) rows, with balance and limit scaled, as CREDITLINE_EDGES_SQL
+    returns them.
+    """
+    for creditline_id, src, dest, balance, limit in rows:
+        chunks = scaled_edge_data(balance, limit, ignore_balances)
+        for key, (capacity, weight) in enumerate(chunks):
+            yield src, dest, key, capacity, weight, creditline_id
+
+def update_creditlines_in_graph(graph, creditlines, ignore_balances=False):
     for creditline in creditlines:
         update_creditline_in_graph(graph, creditline, ignore_balances)
-    return graph
 
 def update_creditline_in_graph(graph, creditline, ignore_balances):
     src = creditline.node.alias
     dest = creditline.partner.alias
-    graph.remove_edges_from([(src, dest)])
-    if ignore_balances:
-        chunks = [(scale_flow_amount(creditline.limit), 0)]
-    else:
-        chunks = edge_data(creditline)
+    if graph.has_edge(src, dest):
+        # Remove all parallel edges, not just one.
+        graph.remove_edges_from(
+            [(src, dest, key) for key in graph[src][dest].keys()])
+    chunks = creditline_chunks(creditline, ignore_balances)
     for i, chunk in enumerate(chunks):
         capacity, weight = chunk
         graph.add_edge(src, dest, key=i, weight=weight,
@@ -167,6 +1265,25 @@ def update_creditline_in_graph(graph, creditline, ignore_balances):
         if capacity != D('Infinity'):
             graph[src][dest][i]['capacity'] = capacity
 
+def remove_creditline_from_graph(graph, creditline_id, src, dest):
+    """
+    Removes the src -> dest edges of a deleted credit line from graph.
+    Returns whether there were any.
+    """
+    keys = [key for key, data in graph.succ.get(src, {}).get(dest, {}).items()
+            if data.get('creditline_id') == creditline_id]
+    graph.remove_edges_from([(src, dest, key) for key in keys])
+    return bool(keys)
+
+def creditline_chunks(creditline, ignore_balances):
+    "Returns scaled (capacity, weight) chunks for creditline's graph edges."
+    if ignore_balances:
+        limit = creditline.limit
+        if limit is not None:
+            limit = scale_flow_amount(limit)
+        return scaled_edge_data(None, limit, ignore_balances=True)
+    return edge_data(creditline)
+
 def edge_data(creditline):
     """
     Assigns a cost to using this creditline in a payment.  Cashing in existing
@@ -181,48 +1298,50 @@ def edge_data(creditline):
     remaining *after* the payment, but that is not known yet, and the naive min
     cost demand flow algorithm used can't factor that in.)
     """
-    if creditline.limit is None:
+    limit = creditline.limit
+    if limit is not None:
+        limit = scale_flow_amount(limit)
+    return scaled_edge_data(scale_flow_amount(creditline.balance), limit)
+
+def scaled_edge_data(balance, limit, ignore_balances=False):
+    """
+    Computes edge_data, or the reputation graph's single chunk if
+    ignore_balances, from balance and limit already scaled to ints with
+    scale_flow_amount.  limit is None for no limit.  Uses only integer
+    arithmetic, so the same weights come out whether computed one credit
+    line at a time or in bulk by build_graph.
+    """
+    if limit is None:
         # No cost if no limit -- treat as if balance is always 0.
-        data = ((D('Infinity'), 0),)  # Capacity is infinite.
+        return [(D('Infinity'), 0)]  # Capacity is infinite.
+    if ignore_balances:
+        return [(limit, 0)]
+    if balance > 0:
+        # Return two chunks: one to get to zero balance, one for remainder.
+        # Give positive cost only to issuing in new IOUs.
+        return [(balance, 0), (limit, COST_SCALE_FACTOR)]
+    # No positive balance to cash in.
+    capacity = balance + limit
+    if limit != 0:
+        cost = COST_SCALE_FACTOR * (limit + balance) // limit
     else:
-        if creditline.balance > 0:
-            # Return two chunks: one to get to zero balance, one for remainder.
-            # Give positive cost only to issuing in new IOUs.
-            data = ((creditline.balance, 0), (creditline.limit, 1))
-        else:
-            # No positive balance to cash in.
-            capacity = creditline.balance + creditline.limit
-            if creditline.limit != 0:
-                cost = 1.0 + (float(creditline.balance / creditline.limit))
-            else:
-                cost = 0
-            data = ((capacity, cost),)
-    return scale_edge_data(data)
-
-def scale_edge_data(edge_data):
-    "Scale capacities and costs to ints."
-    new_data = []
-    for capacity, cost in edge_data:
-        new_data.append((scale_flow_amount(capacity),
-                         int(cost * COST_SCALE_FACTOR)))
-    return new_data
+        cost = 0
+    return [(capacity, cost)]
 
-def creditline_amounts(flow_dict, graph):
+def creditline_amounts(edge_flows, graph):
     """
     Returns a list of (creditline_id, amount) tuples that represent the
-    flow of a payment. Takes a flow_dict from min_cost_flow.
+    flow of a payment.  Takes the sparse edge_flows dict of (src, dest,
+    key): flow returned by a solver backend, so only edges on the route are
+    looked at.
     """
     amount_dict = {}  # Index by creditline.
-    for src_node, node_flow_dict in flow_dict.items():
-        for dest_node, edge_dict in node_flow_dict.items():
-            creditline_id = graph[src_node][dest_node][0].get('creditline_id')
-            for amount in edge_dict.values():
-                amount = unscale_flow_amount(amount)
-                if amount == 0:  # Ignore zero amounts.
-                    continue
-                amount_dict.setdefault(creditline_id, 0)
-                amount_dict[creditline_id] += amount
-    return amount_dict.items()
+    for (src_node, dest_node, key), flow in edge_flows.iteritems():
+        creditline_id = graph[src_node][dest_node][key].get('creditline_id')
+        amount_dict.setdefault(creditline_id, 0)
+        amount_dict[creditline_id] += flow
+    return [(cl_id, unscale_flow_amount(amount))
+            for cl_id, amount in amount_dict.iteritems() if amount]
 
 def scale_flow_amount(amount):
     "Convert amount decimal to int for min cost flow algorithm."
@@ -0,0 +1,273 @@
+"Max flow on multigraph flow graphs."
+
+from collections import deque
+
+import networkx as nx
+
+from cc.payment.compact import INFINITE_CAPACITY
+
+INFINITY = float('inf')
+
+def max_flow(G, source, sink, capacity='capacity', stats=None):
+    """
+    Returns the value of a maximum flow from source to sink, using Dinic's
+    algorithm.
+
+    Works directly on a MultiDiGraph such as the one built by
+    cc.payment.flow.build_graph: parallel edges are merged by adding their
+    capacities, and edges without a capacity attribute are infinite.
+    Raises NetworkXUnbounded if source and sink are joined by a path of
+    infinite capacity edges, as nx.max_flow does.
+
+    If stats dict is given, the number of augmenting paths and of residual
+    graph edges are stored in it as 'augmentations' and 'residual_edges'.
+    """
+    residual = _residual_capacities(G, capacity)
+    flow = _max_flow(residual, source, sink, stats=stats)
+    if stats is not None:
+        stats['residual_edges'] = sum(
+            len(adj) for adj in residual.itervalues())
+    return flow
+
+def max_flow_cut(G, source, sink, capacity='capacity'):
+    """
+    Like max_flow, but returns (flow value, source side, flow nodes), where
+    source side is the set of nodes on the source side of a minimum cut, and
+    flow nodes is the set of nodes the flow leaves from.
+
+    Raising the capacity of an edge from outside the source side, or lowering
+    the capacity of an edge from outside flow nodes, can't change the flow
+    value.
+    """
+    residual = _residual_capacities(G, capacity)
+    flow_nodes = set()
+    flow = _max_flow(residual, source, sink, flow_nodes)
+    source_side = set([source])
+    stack = [source]
+    while stack:
+        u = stack.pop()
+        for v, cap in residual[u].iteritems():
+            if v not in source_side and cap > 0:
+                source_side.add(v)
+                stack.append(v)
+    return flow, source_side, flow_nodes
+
+def compact_max_flow(graph, source, sink, nodes=None, stats=None):
+    """
+    Like max_flow, but runs over the CSR arrays of a
+    cc.payment.compact.CompactGraph or cc.payment.snapshot.GraphSnapshot
+    directly, without building a networkx graph or residual dicts.  Takes
+    node indices.  If nodes is given, only edges between node indices in
+    that set are used.
+
+    The residual graph is kept as a dict of edge index: flow, and each
+    node's arcs are its out-edges forwards and its in-edges backwards,
+    read from the arrays as the search reaches the node.
+    """
+    flows = {}
+    adjacency = {}
+
+    def arcs(u):
+        "(edge index, direction, other end) for each of u's edges."
+        if u not in adjacency:
+            adjacency[u] = u_arcs = []
+            for e in xrange(graph.out_offsets[u], graph.out_offsets[u + 1]):
+                v = graph.head[e]
+                if v != u and (nodes is None or v in nodes):
+                    u_arcs.append((e, 1, v))
+            for i in xrange(graph.in_offsets[u], graph.in_offsets[u + 1]):
+                e = graph.in_edges[i]
+                v = graph.tail[e]
+                if v != u and (nodes is None or v in nodes):
+                    u_arcs.append((e, -1, v))
+        return adjacency[u]
+
+    def residual(e, direction):
+        if direction < 0:
+            return flows.get(e, 0)
+        if graph.capacity[e] == INFINITE_CAPACITY:
+            return INFINITY
+        return graph.capacity[e] - flows.get(e, 0)
+
+    seen = set([source])
+    stack = [source]
+    while stack:
+        u = stack.pop()
+        if u == sink:
+            raise nx.NetworkXUnbounded(
+                "Infinite capacity path, flow unbounded above.")
+        for e, direction, v in arcs(u):
+            if (v not in seen and direction > 0 and
+                    graph.capacity[e] == INFINITE_CAPACITY):
+                seen.add(v)
+                stack.append(v)
+
+    if stats is not None:
+        stats['augmentations'] = 0
+    total = 0
+    while True:
+        level = {source: 0}
+        queue = deque([source])
+        while queue:
+            u = queue.popleft()
+            if u == sink:
+                break
+            for e, direction, v in arcs(u):
+                if v not in level and residual(e, direction) > 0:
+                    level[v] = level[u] + 1
+                    queue.append(v)
+        if sink not in level:
+            break
+        # Blocking flow, as in _blocking_flow, keeping the arcs of the
+        # path alongside its nodes.
+        sink_level = level[sink]
+        level_arcs = {}
+        path = [source]
+        path_arcs = []
+        while path:
+            u = path[-1]
+            if u == sink:
+                flow = min(residual(e, direction)
+                           for e, direction, _ in path_arcs)
+                for e, direction, _ in path_arcs:
+                    flows[e] = flows.get(e, 0) + flow * direction
+                total += flow
+                if stats is not None:
+                    stats['augmentations'] += 1
+                # Back up to just before the first saturated arc.
+                for i, (e, direction, _) in enumerate(path_arcs):
+                    if residual(e, direction) == 0:
+                        del path[i + 1:]
+                        del path_arcs[i:]
+                        break
+                continue
+            if u not in level_arcs:
+                level_arcs[u] = [
+                    arc for arc in arcs(u) if level[u] < sink_level and
+                    level.get(arc[2]) == level[u] + 1]
+            u_arcs = level_arcs[u]
+            while u_arcs and residual(*u_arcs[-1][:2]) <= 0:
+                u_arcs.pop()
+            if u_arcs:
+                path_arcs.append(u_arcs[-1])
+                path.append(u_arcs[-1][2])
+            else:
+                # Dead end: prune u from the level graph.
+                path.pop()
+                if path:
+                    path_arcs.pop()
+                    level_arcs[path[-1]].pop()
+    if stats is not None:
+        stats['residual_edges'] = sum(
+            len(u_arcs) for u_arcs in adjacency.itervalues())
+    return total
+
+def _max_flow(residual, source, sink, flow_nodes=None, stats=None):
+    """
+    Dinic's algorithm on residual capacities, which are left as the final
+    residual graph.  Adds nodes flow leaves from to flow_nodes set if given.
+    Counts augmenting paths in stats if given.
+    """
+    if _has_path(residual, source, sink, lambda cap: cap == INFINITY):
+        raise nx.NetworkXUnbounded(
+            "Infinite capacity path, flow unbounded above.")
+    if stats is not None:
+        stats['augmentations'] = 0
+    flow = 0
+    while True:
+        level = _levels(residual, source, sink)
+        if sink not in level:
+            break
+        flow += _blocking_flow(
+            residual, level, source, sink, flow_nodes, stats)
+    return flow
+
+def _residual_capacities(G, capacity):
+    """
+    Returns dict of dicts of residual capacities, with parallel edges merged
+    and a zero capacity reverse entry for every edge.
+    """
+    residual = dict((node, {}) for node in G)
+    for u, v, data in G.edges_iter(data=True):
+        if u == v:
+            continue
+        edge_capacity = data.get(capacity, INFINITY)
+        residual[u][v] = residual[u].get(v, 0) + edge_capacity
+        residual[v].setdefault(u, 0)
+    return residual
+
+def _has_path(residual, source, sink, usable):
+    "Whether sink can be reached from source over edges whose cap is usable."
+    seen = set([source])
+    stack = [source]
+    while stack:
+        u = stack.pop()
+        if u == sink:
+            return True
+        for v, cap in residual[u].iteritems():
+            if v not in seen and usable(cap):
+                seen.add(v)
+                stack.append(v)
+    return False
+
+def _levels(residual, source, sink):
+    "Breadth-first distances from source over edges with capacity left."
+    level = {source: 0}
+    queue = deque([source])
+    while queue:
+        u = queue.popleft()
+        if u == sink:
+            break
+        for v, cap in residual[u].iteritems():
+            if cap > 0 and v not in level:
+                level[v] = level[u] + 1
+                queue.append(v)
+    return level
+
+def _blocking_flow(residual, level, source, sink, flow_nodes=None,
+                   stats=None):
+    """
+    Saturate all shortest paths in the level graph, and return the total
+    flow pushed.  Iterative depth-first search, since routes can be too deep
+    for recursion.  Adds nodes flow leaves from to flow_nodes, and counts
+    augmenting paths in stats, if given.
+    """
+    sink_level = level[sink]
+    # Level graph edges left to try from each node.
+    arcs = dict(
+        (u, [v for v, cap in residual[u].iteritems()
+             if cap > 0 and level.get(v) == level[u] + 1])
+        for u in level if level[u] < sink_level)
+    total = 0
+    path = [source]
+    while path:
+        u = path[-1]
+        if u == sink:
+            flow = min(residual[path[i]][path[i + 1]]
+                       for i in xrange(len(path) - 1))
+            for i in xrange(len(path) - 1):
+                a, b = path[i], path[i + 1]
+                residual[a][b] -= flow
+                residual[b][a] += flow
+            total += flow
+            if flow_nodes is not None:
+                flow_nodes.update(path[:-1])
+            if stats is not None:
+                stats['augmentations'] += 1
+            # Back up to just before the first saturated edge.
+            for i in xrange(len(path) - 1):
+                if residual[path[i]][path[i + 1]] == 0:
+                    del path[i + 1:]
+                    break
+            continue
+        u_arcs = arcs.get(u)
+        while u_arcs and residual[u][u_arcs[-1]] <= 0:
+            u_arcs.pop()
+        if u_arcs:
+            path.append(u_arcs[-1])
+        else:
+            # Dead end: prune u from the level graph.
+            path.pop()
+            if path:
+                arcs[path[-1]].pop()
+    return total
@@ -1,25 +1,34 @@
+import heapq
+
 import networkx as nx
 from networkx.utils import generate_unique_node
 
-def min_cost_flow(G, demand='demand', capacity='capacity', weight='weight'):
+SHORTEST_PATH_METHODS = ('bellman_ford', 'dijkstra')
+
+def min_cost_flow(G, demand='demand', capacity='capacity', weight='weight',
+                  method='bellman_ford', stats=None, sparse=False):
     """
     Uses successive shortest path algorithm:
     http://community.topcoder.com/tc?module=Static&d1=tutorials&d2=minimumCostFlow2
-    """
-    if not G.is_directed():
-        raise nx.NetworkXError("Undirected graph not supported (yet).")
-    if not nx.is_connected(G.to_undirected()):
-        raise nx.NetworkXError("Not connected graph not supported (yet).")
-    demand_sum = sum(d[demand] for v, d in G.nodes_iter(data=True)
-                     if demand in d)
-    if demand_sum != 0:
-        raise nx.NetworkXUnfeasible("Sum of the demands should be 0.")
 
-    H = nx.MultiDiGraph(G)
+    method selects how augmenting paths are found.  'bellman_ford' runs a
+    full Bellman-Ford pass over the residual graph for every path.
+    'dijkstra' runs Bellman-Ford once to get initial node potentials
+    (Johnson's technique), then uses Dijkstra on reduced costs, which stay
+    nonnegative as long as potentials are updated after each search.
 
-    for u, v, key in H.edges_iter(keys=True):
-        if not isinstance(key, (int, long)):
-            raise nx.NetworkXError("Edge keys must be integers.")
+    If stats dict is given, the number of augmenting paths and of residual
+    graph edges are stored in it as 'augmentations' and 'residual_edges'.
+
+    Returns (flow_cost, flow_dict), where flow_dict[u][v][key] is the flow
+    on every edge.  If sparse is True, returns (flow_cost, edge_flows)
+    instead, where edge_flows is a dict of (u, v, key): flow for only the
+    edges with nonzero flow, which is much smaller than a flow_dict for a
+    few paths through a big graph.
+    """
+    if method not in SHORTEST_PATH_METHODS:
+        raise ValueError("Unknown shortest path method: %s" % method)
+    H = _flow_graph_copy(G, demand)
     
     # Add source and sink nodes.
     source = generate_unique_node()
@@ -32,17 +41,26 @@ def min_cost_flow(G, demand='demand', capacity='capacity', weight='weight'):
             else:
                 H.add_edge(source, node, capacity=-node_demand, weight=0)
 
-    # TODO: Transform R weights to be nonnegative at each iteration,
-    # using bellman-ford shortest-path length source -> n as the potential
-    # for each node.  Then can use dijskstra_path instead of bellman_ford.
-
     flow_cost = 0
+    augmentations = 0
+    edge_flows = {}
+    potential = None  # Node potentials, for dijkstra method only.
     search = source in H.nodes()  # No source => no demand => no flow.
-    while search:
+    if search:
         R = _residual_graph(H, capacity=capacity, weight=weight)
+        if stats is not None:
+            stats['residual_edges'] = R.number_of_edges()
+    while search:
         try:
-            #path = nx.dijkstra_path(R, source, sink, weight=weight)
-            path = _bellman_ford_path(R, source, sink, weight=weight)
+            if method == 'dijkstra' and potential is not None:
+                path = _dijkstra_path(R, source, sink, potential, weight=weight)
+            elif method == 'dijkstra':
+                # First search: Bellman-Ford copes with negative weights, and
+                # its distances become the initial potentials.
+                path, potential = _bellman_ford_path(
+                    R, source, sink, weight=weight, return_dist=True)
+            else:
+                path = _bellman_ford_path(R, source, sink, weight=weight)
         except nx.NetworkXNoPath:
             # Check that demands have been satisfied.
             for node, edge_dict in H[source].items():
@@ -55,15 +73,247 @@ def min_cost_flow(G, demand='demand', capacity='capacity', weight='weight'):
 
         new_flow, path_edges = _max_path_flow(
             R, path, capacity=capacity, weight=weight)
-        new_cost =  _augment_flow(H, path_edges, new_flow, R)
+        new_cost = _augment_flow(
+            H, path_edges, new_flow, R, capacity=capacity, weight=weight,
+            edge_flows=edge_flows)
         flow_cost += new_cost
+        augmentations += 1
 
     if search:
         H.remove_node(source)
         H.remove_node(sink)
+    if stats is not None:
+        stats['augmentations'] = augmentations
+    if sparse:
+        return flow_cost, _nonzero_flows(
+            edge_flows, exclude=(source, sink))
     flow_dict = _create_flow_dict(H)
     return flow_cost, flow_dict
         
+def capacity_scaling_min_cost_flow(G, demand='demand', capacity='capacity',
+                                   weight='weight', stats=None, sparse=False):
+    """
+    Capacity scaling variant of the successive shortest path algorithm
+    (Ahuja, Magnanti & Orlin, Network Flows, section 10.2).
+
+    Flow is sent in units of delta from nodes with at least delta excess to
+    nodes with at least delta deficit, along shortest paths that use only
+    residual edges with capacity of at least delta.  delta starts at the
+    largest power of two not above total supply and is halved each phase, so
+    the number of augmentations grows with the log of the payment amount
+    rather than with the number of distinct paths it is split across.
+
+    Takes and returns the same arguments and (flow_cost, flow_dict) as
+    min_cost_flow, including edges with no capacity attribute being
+    infinite, stats and sparse.  Negative cycles raise NetworkXUnbounded.
+    """
+    H = _flow_graph_copy(G, demand)
+    excess = dict((node, -data.get(demand, 0))
+                  for node, data in H.nodes_iter(data=True))
+    R = _residual_graph(H, capacity=capacity, weight=weight)
+    augmentations = 0
+    edge_flows = {}
+    potential = _initial_potentials(R, weight)
+    supply = sum(e for e in excess.itervalues() if e > 0)
+
+    flow_cost = 0
+    delta = 1
+    while delta * 2 <= supply:
+        delta *= 2
+    while supply and delta >= 1:
+        flow_cost += _saturate_negative_edges(
+            H, R, excess, potential, delta, capacity, weight, edge_flows)
+        for node in [n for n, e in excess.iteritems() if e >= delta]:
+            while excess[node] >= delta:
+                try:
+                    path_edges = _scaling_path(
+                        R, node, excess, potential, delta, capacity, weight)
+                except nx.NetworkXNoPath:
+                    break
+                flow_cost += _augment_flow(
+                    H, path_edges, delta, R, capacity=capacity, weight=weight,
+                    edge_flows=edge_flows)
+                excess[node] -= delta
+                excess[path_edges[-1][1]] += delta
+                augmentations += 1
+        delta //= 2
+    if stats is not None:
+        stats['residual_edges'] = R.number_of_edges()
+        stats['augmentations'] = augmentations
+    if any(excess.itervalues()):
+        raise nx.NetworkXUnfeasible("No flow satisfying all demands.")
+    if sparse:
+        return flow_cost, _nonzero_flows(edge_flows)
+    return flow_cost, _create_flow_dict(H)
+
+class MinCostFlowSession(object):
+    """
+    Prepared state for solving many single source, single target min cost
+    flow problems over the same graph, such as a stream of payments.
+
+    The graph is validated, and its residual graph and node potentials are
+    built, once.  Each solve then uses the successive shortest path
+    algorithm with Dijkstra, like min_cost_flow with method='dijkstra', but
+    without copying the graph or adding source and sink nodes, and undoes
+    its changes to the residual graph and potentials afterwards, so it only
+    costs as much as the paths it searches.
+
+    G must be a MultiDiGraph with integer edge keys, and edges with no
+    capacity attribute have infinite capacity.  The session never modifies
+    G, and doesn't notice when it changes; call update_edges after changing
+    edges of G.
+    """
+    def __init__(self, G, capacity='capacity', weight='weight'):
+        if not G.is_directed() or not G.is_multigraph():
+            raise nx.NetworkXError("Only MultiDiGraphs are supported.")
+        for u, v, key in G.edges_iter(keys=True):
+            if not isinstance(key, (int, long)):
+                raise nx.NetworkXError("Edge keys must be integers.")
+        self.G = G
+        self.capacity = capacity
+        self.weight = weight
+        self.R = _residual_graph(G, capacity=capacity, weight=weight)
+        self.potential = _initial_potentials(self.R, weight)
+        self._zero_potentials = not any(self.potential.itervalues())
+        # Residual edge and node potential values before the current solve.
+        self._saved_edges = {}
+        self._saved_potentials = {}
+
+    def solve(self, source, target, amount, stats=None):
+        """
+        Sends amount from source to target at minimum cost.  Returns
+        (flow_cost, edge_flows) like min_cost_flow with sparse=True, and
+        fills in stats the same way.
+
+        Raises NetworkXNoPath if there is no path from source to target at
+        all, and NetworkXUnfeasible if the paths can't carry amount.
+        """
+        if source not in self.R or target not in self.R:
+            raise nx.NetworkXNoPath(
+                "Node %s not reachable from %s." % (target, source))
+        flow_cost = 0
+        augmentations = 0
+        edge_flows = {}
+        remaining = amount
+        try:
+            while remaining > 0:
+                try:
+                    path = _dijkstra_path(
+                        self.R, source, target, self.potential, self.weight,
+                        changed=self._saved_potentials)
+                except nx.NetworkXNoPath:
+                    if not augmentations:
+                        raise
+                    raise nx.NetworkXUnfeasible(
+                        "No flow satisfying all demands.")
+                path_capacity, path_edges = _max_path_flow(
+                    self.R, path, capacity=self.capacity, weight=self.weight)
+                flow = min(path_capacity, remaining)
+                flow_cost += self._augment(path_edges, flow, edge_flows)
+                remaining -= flow
+                augmentations += 1
+            if stats is not None:
+                stats['augmentations'] = augmentations
+                stats['residual_edges'] = self.R.number_of_edges()
+        finally:
+            self._reset()
+        return flow_cost, _nonzero_flows(edge_flows)
+
+    def update_edges(self, pairs):
+        """
+        Rebuilds the residual edges for each (u, v) in pairs from G's
+        current u -> v edges, after they have been changed.  Node potentials
+        are recomputed from scratch only if there are negative weights.
+        """
+        R = self.R
+        negative = False
+        for u, v in pairs:
+            for node in (u, v):
+                if node not in R:
+                    R.add_node(node)
+                    self.potential[node] = 0
+            if R.has_edge(u, v):
+                # Between solves, only forward residual edges exist.
+                R.remove_edges_from([(u, v, key) for key in R[u][v].keys()])
+            if not self.G.has_edge(u, v):
+                continue
+            for key, data in self.G[u][v].iteritems():
+                if not isinstance(key, (int, long)):
+                    raise nx.NetworkXError("Edge keys must be integers.")
+                edge_capacity = data.get(self.capacity)
+                if edge_capacity == 0:
+                    continue
+                edge_weight = data.get(self.weight, 0)
+                negative = negative or edge_weight < 0
+                R.add_edge(u, v, key=(key, False), orig_key=key,
+                           **{self.capacity: edge_capacity,
+                              self.weight: edge_weight})
+        if negative or not self._zero_potentials:
+            self.potential = _initial_potentials(R, self.weight)
+            self._zero_potentials = not any(self.potential.itervalues())
+
+    def _augment(self, flow_edges, flow, edge_flows):
+        """
+        Pushes flow across residual flow_edges, saving the residual edges
+        it changes first, and adds it to edge_flows.  Returns the cost.
+        """
+        R = self.R
+        cost = 0
+        for u, v, residual_key, is_reversed in flow_edges:
+            key = residual_key[0]
+            self._save_edge(u, v, residual_key)
+            self._save_edge(v, u, (key, not is_reversed))
+            cost += flow * R[u][v][residual_key][self.weight]
+            if not is_reversed:
+                edge, edge_flow = (u, v, key), flow
+            else:
+                edge, edge_flow = (v, u, key), -flow
+            edge_flows[edge] = edge_flows.get(edge, 0) + edge_flow
+            _update_residual_edges(R, u, v, residual_key, flow, None,
+                                   self.capacity, self.weight)
+        return cost
+
+    def _save_edge(self, u, v, residual_key):
+        edge = (u, v, residual_key)
+        if edge not in self._saved_edges:
+            if self.R.has_edge(u, v, key=residual_key):
+                self._saved_edges[edge] = dict(self.R[u][v][residual_key])
+            else:
+                self._saved_edges[edge] = None
+
+    def _reset(self):
+        "Restores the residual graph and potentials saved during a solve."
+        R = self.R
+        for (u, v, residual_key), data in self._saved_edges.iteritems():
+            if data is None:
+                if R.has_edge(u, v, key=residual_key):
+                    R.remove_edge(u, v, key=residual_key)
+            elif R.has_edge(u, v, key=residual_key):
+                R[u][v][residual_key].update(data)
+            else:
+                R.add_edge(u, v, key=residual_key, **data)
+        self._saved_edges.clear()
+        self.potential.update(self._saved_potentials)
+        self._saved_potentials.clear()
+
+def _flow_graph_copy(G, demand):
+    "Checks that G is a valid flow problem, and returns a multigraph copy."
+    if not G.is_directed():
+        raise nx.NetworkXError("Undirected graph not supported (yet).")
+    if not nx.is_connected(G.to_undirected()):
+        raise nx.NetworkXError("Not connected graph not supported (yet).")
+    demand_sum = sum(d[demand] for v, d in G.nodes_iter(data=True)
+                     if demand in d)
+    if demand_sum != 0:
+        raise nx.NetworkXUnfeasible("Sum of the demands should be 0.")
+
+    H = nx.MultiDiGraph(G)
+
+    for u, v, key in H.edges_iter(keys=True):
+        if not isinstance(key, (int, long)):
+            raise nx.NetworkXError("Edge keys must be integers.")
+    return H
+
 def _residual_graph(G, capacity, weight):
     """
     Create a residual flow graph with the same nodes as G and edges as follows:
@@ -81,9 +331,14 @@ def _residual_graph(G, capacity, weight):
     Each edge of the residual graph stores the key of the corresponding edge in
     the original flow graph in the orig_key attribute, and edges that represent
     potentially reversed flows have an 'is_reversed' attribute set to True.
-    
+    Residual edges are keyed by (orig_key, is_reversed), so the partner of
+    any residual edge can be found directly.
+
+    The residual graph is built once per solve, and then kept up to date by
+    _augment_flow, which only touches the edges along each augmenting path.
     """
     R = nx.MultiDiGraph()
+    R.add_nodes_from(G)
     for u, v, key, data in G.edges_iter(keys=True, data=True):
         flow = data.get('flow', 0)
         edge_weight = data.get(weight, 0)
@@ -98,23 +353,172 @@ def _residual_graph(G, capacity, weight):
             edge_attrs = {capacity: new_capacity,
                           weight: edge_weight,
                           'orig_key': key}
-            R.add_edge(u, v, **edge_attrs)
+            R.add_edge(u, v, key=(key, False), **edge_attrs)
         if flow > 0:
             edge_attrs = {capacity: flow,
                           weight: -edge_weight,
                           'orig_key': key,
                           'is_reversed': True}
-            R.add_edge(v, u, **edge_attrs)
+            R.add_edge(v, u, key=(key, True), **edge_attrs)
     return R
-    
 
-# TODO: Remove this once we're using dijkstra to find shortest paths.
-def _bellman_ford_path(G, source, target, weight):
-    "Returns shortest path using bellman_ford algorithm."
+def _bellman_ford_path(G, source, target, weight, return_dist=False):
+    """
+    Returns shortest path using bellman_ford algorithm.  If return_dist is
+    True, also returns the dict of distances from source to each reachable
+    node.
+    """
     pred, dist = nx.bellman_ford(G, source, weight)
     if target not in pred:
         raise nx.NetworkXNoPath(
             "Node %s not reachable from %s." % (source, target))
+    path = _build_path(pred, source, target)
+    if return_dist:
+        return path, dist
+    return path
+
+def _dijkstra_path(G, source, target, potential, weight, changed=None):
+    """
+    Returns shortest path using Dijkstra's algorithm on weights reduced by
+    node potentials, and updates potential in place so reduced weights
+    remain nonnegative in the next residual graph.
+
+    Reduced weight of edge (u, v) is weight + potential[u] - potential[v].
+    potential must contain every node reachable from source (the initial
+    Bellman-Ford distances do).  Search stops as soon as target is settled;
+    afterwards every node's potential is raised by the lesser of its
+    distance and the distance to target, which keeps all reduced weights
+    nonnegative and makes them zero along the path.  Since lowering all
+    potentials by the same amount doesn't change reduced weights, that is
+    done by raising only settled nodes' potentials, by their distance less
+    the distance to target, so the update costs no more than the search.
+
+    If changed dict is given, the original potential of each node updated
+    is saved in it, unless it is there already.
+    """
+    dist = {}  # Settled nodes.
+    pred = {source: None}
+    seen = {source: 0}
+    heap = [(0, source)]
+    while heap:
+        d, u = heapq.heappop(heap)
+        if u in dist:
+            continue
+        dist[u] = d
+        if u == target:
+            break
+        u_potential = potential[u]
+        for v, edge_dict in G[u].iteritems():
+            if v in dist:
+                continue
+            edge_weight = min(data[weight] for data in edge_dict.itervalues())
+            vd = d + edge_weight + u_potential - potential[v]
+            if v not in seen or vd < seen[v]:
+                seen[v] = vd
+                pred[v] = u
+                heapq.heappush(heap, (vd, v))
+    if target not in dist:
+        raise nx.NetworkXNoPath(
+            "Node %s not reachable from %s." % (source, target))
+    target_dist = dist[target]
+    for node, node_dist in dist.iteritems():
+        if changed is not None and node not in changed:
+            changed[node] = potential[node]
+        potential[node] += node_dist - target_dist
+    return _build_path(pred, source, target)
+
+def _initial_potentials(R, weight):
+    """
+    Returns node potentials that make every edge of R have nonnegative
+    reduced weight: zero if no weights are negative, otherwise shortest path
+    lengths from a temporary root joined to every node.
+    """
+    if all(data[weight] >= 0 for u, v, data in R.edges_iter(data=True)):
+        return dict((node, 0) for node in R)
+    root = generate_unique_node()
+    R.add_edges_from((root, node, {weight: 0}) for node in R.nodes())
+    try:
+        _, dist = nx.bellman_ford(R, root, weight)
+    finally:
+        R.remove_node(root)
+    del dist[root]
+    return dist
+
+def _saturate_negative_edges(G, R, excess, potential, delta, capacity,
+                             weight, edge_flows=None):
+    """
+    Push all remaining capacity across finite residual edges with at least
+    delta capacity and negative reduced weight, so Dijkstra can be used in
+    the next capacity scaling phase.  Updates node excesses, and returns
+    the cost of the pushed flow.
+
+    Infinite edges never need saturating: they take part in every phase,
+    so potential updates keep their reduced weights nonnegative.
+    """
+    cost = 0
+    for u, v, key, data in list(R.edges_iter(keys=True, data=True)):
+        flow = data[capacity]
+        if flow is None or flow < delta:
+            continue
+        if data[weight] + potential[u] - potential[v] >= 0:
+            continue
+        cost += _augment_flow(G, [(u, v, key, data.get('is_reversed', False))],
+                              flow, R, capacity=capacity, weight=weight,
+                              edge_flows=edge_flows)
+        excess[u] -= flow
+        excess[v] += flow
+    return cost
+
+def _scaling_path(G, source, excess, potential, delta, capacity, weight):
+    """
+    Returns edges of a shortest path from source to a node with at least
+    delta deficit, using only edges with at least delta capacity, in the
+    same form as _max_path_flow.  Updates potential in place as
+    _dijkstra_path does.
+    """
+    dist = {}  # Settled nodes.
+    pred = {}  # Node: (pred node, edge key, is_reversed).
+    seen = {source: 0}
+    heap = [(0, source)]
+    target = None
+    while heap:
+        d, u = heapq.heappop(heap)
+        if u in dist:
+            continue
+        dist[u] = d
+        if excess[u] <= -delta:
+            target = u
+            break
+        u_potential = potential[u]
+        for v, edge_dict in G[u].iteritems():
+            if v in dist:
+                continue
+            for key, data in edge_dict.iteritems():
+                edge_capacity = data[capacity]
+                if edge_capacity is not None and edge_capacity < delta:
+                    continue
+                vd = d + data[weight] + u_potential - potential[v]
+                if v not in seen or vd < seen[v]:
+                    seen[v] = vd
+                    pred[v] = (u, key, data.get('is_reversed', False))
+                    heapq.heappush(heap, (vd, v))
+    if target is None:
+        raise nx.NetworkXNoPath(
+            "No node with deficit reachable from %s." % source)
+    target_dist = dist[target]
+    for node in potential:
+        potential[node] += dist.get(node, target_dist)
+    flow_edges = []
+    v = target
+    while v != source:
+        u, key, is_reversed = pred[v]
+        flow_edges.append((u, v, key, is_reversed))
+        v = u
+    flow_edges.reverse()
+    return flow_edges
+
+def _build_path(pred, source, target):
+    "Builds path from source to target out of predecessor dict."
     # Since predecessors are given, build path backwards, then reverse.
     path = []
     curr = target
@@ -158,8 +562,12 @@ def _min_weight_edge(edge_dict, weight):
             min_weight_edge = (key, data)
     return min_weight_edge
         
-def _augment_flow(G, flow_edges, flow, R):
-    "Add flow across flow_edges to G."
+def _augment_flow(G, flow_edges, flow, R, capacity, weight, edge_flows=None):
+    """
+    Add flow across flow_edges to G, and update residual graph R to match.
+    If edge_flows dict is given, the new flow on each edge of G is also
+    stored in it, by (u, v, key).
+    """
     cost = 0
     for u, v, residual_key, is_reversed in flow_edges:
         key = R[u][v][residual_key]['orig_key']
@@ -170,9 +578,54 @@ def _augment_flow(G, flow_edges, flow, R):
             data = G[v][u][key]
             edge_flow = -flow
         data['flow'] = data.get('flow', 0) + edge_flow
-        cost += edge_flow * data.get('weight', 0)
+        if edge_flows is not None:
+            if not is_reversed:
+                edge_flows[u, v, key] = data['flow']
+            else:
+                edge_flows[v, u, key] = data['flow']
+        cost += edge_flow * data.get(weight, 0)
+        _update_residual_edges(
+            R, u, v, residual_key, flow, data, capacity, weight)
     return cost
 
+def _update_residual_edges(R, u, v, residual_key, flow, data, capacity,
+                           weight):
+    """
+    Push flow across residual edge (u, v, residual_key), whose original edge
+    has attributes data.  Removes the residual edge if it is used up, and
+    adds or grows its partner edge in the opposite direction.
+    """
+    residual_data = R[u][v][residual_key]
+    remaining = residual_data[capacity]
+    if remaining is not None:  # Infinite capacity never runs out.
+        remaining -= flow
+        if remaining > 0:
+            residual_data[capacity] = remaining
+        else:
+            R.remove_edge(u, v, key=residual_key)
+    key, is_reversed = residual_key
+    partner_key = (key, not is_reversed)
+    if R.has_edge(v, u, key=partner_key):
+        partner_data = R[v][u][partner_key]
+        if partner_data[capacity] is not None:
+            partner_data[capacity] += flow
+    else:
+        edge_attrs = {capacity: flow,
+                      weight: -residual_data[weight],
+                      'orig_key': key}
+        if not is_reversed:
+            edge_attrs['is_reversed'] = True
+        R.add_edge(v, u, key=partner_key, **edge_attrs)
+
+def _nonzero_flows(edge_flows, exclude=()):
+    """
+    Returns edge_flows without zero flows, or edges to or from nodes in
+    exclude.
+    """
+    return dict(((u, v, key), flow)
+                for (u, v, key), flow in edge_flows.iteritems()
+                if flow and u not in exclude and v not in exclude)
+
 def _create_flow_dict(G):
     "Creates the flow dict of dicts of dicts for graph G."
     H = nx.MultiDiGraph(G)
@@ -1,11 +1,17 @@
 from datetime import datetime
+from decimal import Decimal as D
+import json
 
-from django.db import models, transaction
+from django.conf import settings
+from django.db import models, transaction, connections, IntegrityError
 from django.db.models import F
 
-from cc.account.models import AmountField, Node, CreditLine, Account
+from cc.account.models import (
+    AmountField, Node, CreditLine, Account, NodeBalance)
 from cc.payment.flow import (
-    FlowGraph, PaymentError, update_creditline_in_cached_graphs)
+    FlowGraph, MultiFlowGraph, PaymentError, LimitExceededError,
+    update_creditlines_in_cached_graphs, component_graphs, pair_max_flows,
+    get_node_versions, load_creditlines)
 
 
 STATUS_CHOICES = (
@@ -14,6 +20,98 @@ STATUS_CHOICES = (
     ('failed', 'Failed'),
 )
 
+# Applies limit-checked balance changes to many accounts at once, and
+# returns the ids and new balances of the accounts updated.  Takes the
+# %s-placeholder rows of a (account id, amount, limit) values list.  Only
+# used on PostgreSQL, but SQLite 3.35 and up runs it too, for testing.
+POST_ENTRIES_SQL = """
+update account_account
+set balance = account_account.balance + v.amount
+from (select column1 as id, column2 as amount, column3 as "limit"
+	from (values %s) as postings) as v
+where account_account.id = v.id and (v."limit" is null
+	or (v.amount > 0 and account_account.balance <= v."limit" - v.amount)
+	or (v.amount <= 0 and account_account.balance >= -v."limit" - v.amount))
+returning account_account.id, account_account.balance
+"""
+POST_ENTRIES_ROW_SQL = (
+    "(cast(%s as integer), cast(%s as numeric), cast(%s as numeric))")
+
+
+class PaymentManager(models.Manager):
+    def queued(self):
+        """
+        Pending payments waiting for the payment worker, oldest first.
+        Queued payments are the only ones without an attempt date.
+        """
+        return self.filter(
+            status='pending', last_attempted_at__isnull=True).order_by('id')
+
+    def claim(self, payment):
+        """
+        Marks queued payment as being attempted.  Returns False if some other
+        process got to it first.
+        """
+        payment.last_attempted_at = datetime.now()
+        return self.filter(
+            pk=payment.id, status='pending', last_attempted_at__isnull=True
+            ).update(last_attempted_at=payment.last_attempted_at) == 1
+
+    def attempt_many(self, payments):
+        """
+        Performs payments from one payer to several distinct recipients
+        together, routed with a single min cost flow solve.  Either all of
+        them are completed, or all of them fail.
+
+        Limit collisions with other payments are retried as in
+        Payment.attempt.  If the payer can't pay all recipients at once,
+        the payments are marked failed and InsufficientMultiCreditError is
+        raised, with the max amount each recipient could be paid alone.
+        """
+        if not payments:
+            return
+        payment_ids = [payment.id for payment in payments]
+        now = datetime.now()
+        self.filter(pk__in=payment_ids).update(last_attempted_at=now)
+        changed_account_ids = []
+        retries = getattr(settings, 'PAYMENT_MAX_RETRIES', 3)
+        try:
+            flow_graph = MultiFlowGraph(
+                payments[0].payer, [payment.recipient for payment in payments])
+            amounts = dict((payment.recipient.alias, payment.amount)
+                           for payment in payments)
+            while True:
+                routes = flow_graph.min_cost_flows(amounts)
+                try:
+                    self._post_many(payments, routes, changed_account_ids)
+                except LimitExceededError as exc:
+                    if retries <= 0:
+                        raise
+                    retries -= 1
+                    creditlines = load_creditlines(
+                        CreditLine.objects.filter(account__in=exc.account_ids))
+                    update_creditlines_in_cached_graphs(creditlines)
+                    flow_graph.update_creditlines(creditlines)
+                else:
+                    break
+        except BaseException:
+            self.filter(pk__in=payment_ids).update(status='failed')
+            for payment in payments:
+                payment.status = 'failed'
+            raise
+        finally:
+            # Update cached graphs.
+            if changed_account_ids:
+                update_creditlines_in_cached_graphs(load_creditlines(
+                        CreditLine.objects.filter(
+                            account__in=changed_account_ids)))
+
+    @transaction.commit_on_success(using='ripple')
+    def _post_many(self, payments, routes, changed_account_ids):
+        "Posts all payments' routes in one transaction."
+        for payment in payments:
+            payment._post_entries(
+                routes[payment.recipient.alias], changed_account_ids)
 
 class Payment(models.Model):
     payer = models.ForeignKey(Node, related_name='sent_payments')
@@ -26,35 +124,66 @@ class Payment(models.Model):
     status = models.CharField(
         max_length=16, choices=STATUS_CHOICES, default='pending')
 
+    objects = PaymentManager()
+
     def __unicode__(self):
         return u"%s payment from %s to %s" % (
             self.amount, self.payer, self.recipient)
 
-    def attempt(self):
+    def attempt(self, session=None, flow_links=None):
         """
         Try to perform this payment.
+
+        If another transaction changes balances along the route so that
+        limits would be exceeded, the conflicting credit lines are refreshed
+        in the flow graph, and the payment is routed again, up to
+        PAYMENT_MAX_RETRIES times.
+
+        If session is given, the payment is routed with that
+        cc.payment.flow.SolverSession instead of over the cached graph, and
+        changed credit lines are updated in it as well as in the cached
+        graphs.
+
+        If flow_links is given, it is tried as the route first, instead of
+        computing one.  It is a list of (creditline_id, amount) like
+        FlowGraph.min_cost_flow returns, such as the route of a quote.
         """
         self.last_attempted_at = datetime.now()
         # Write attempted date now so if something happens we can see this
         # payment was interrupted.
         self.save()
-        changed_accounts = []
+        changed_account_ids = []
+        retries = getattr(settings, 'PAYMENT_MAX_RETRIES', 3)
         try:
-            flow_graph = FlowGraph(self.payer, self.recipient)
-            flow_links = flow_graph.min_cost_flow(self.amount)
-            with transaction.commit_on_success(using='ripple'):
-                for creditline_id, amount in flow_links:
-                    creditline = CreditLine.objects.get(pk=creditline_id)
-                    Entry.objects.create_entry(
-                        self, creditline.account, -amount * creditline.bal_mult,
-                        creditline.limit)
-                    changed_accounts.append(creditline.account)
-                self.status = 'completed'
-                self.save()
+            flow_graph = None
+            while True:
+                if flow_links is None and session is not None:
+                    flow_links = session.min_cost_flow(
+                        self.payer, self.recipient, self.amount)
+                elif flow_links is None:
+                    if flow_graph is None:
+                        flow_graph = FlowGraph(self.payer, self.recipient)
+                    flow_links = flow_graph.min_cost_flow(self.amount)
+                try:
+                    self._post(flow_links, changed_account_ids)
+                except LimitExceededError as exc:
+                    if retries <= 0:
+                        raise
+                    retries -= 1
+                    flow_links = None
+                    creditlines = load_creditlines(
+                        CreditLine.objects.filter(account__in=exc.account_ids))
+                    update_creditlines_in_cached_graphs(creditlines)
+                    if session is not None:
+                        session.update_creditlines(creditlines)
+                    if flow_graph is not None:
+                        flow_graph.update_creditlines(creditlines)
+                else:
+                    break
         except BaseException as exc:
 
-            # TODO: Handle collisions better here so we can retry or give the
-            # user an informative error message, rather than the server error page.
+            # TODO: Give the user an informative error message, rather than
+            # the server error page.
             
             self.status = 'failed'
             self.save()
@@ -62,16 +191,47 @@ class Payment(models.Model):
                 raise
 
         # Update cached graphs.
-        for account in changed_accounts:
-            for creditline in (account.pos_creditline, account.neg_creditline):
-                update_creditline_in_cached_graphs(creditline)
+        if changed_account_ids:
+            creditlines = load_creditlines(
+                CreditLine.objects.filter(account__in=changed_account_ids))
+            update_creditlines_in_cached_graphs(creditlines)
+            if session is not None:
+                session.update_creditlines(creditlines)
 
     @transaction.commit_on_success(using='ripple')
+    def _post(self, flow_links, changed_account_ids):
+        self._post_entries(flow_links, changed_account_ids)
+
+    def _post_entries(self, flow_links, changed_account_ids):
+        """
+        Post entries for flow_links, and mark this payment completed.
+        Appends the IDs of accounts posted to to changed_account_ids.
+        Must be run inside a transaction.
+        """
+        postings = Entry.objects.postings(flow_links)
+        changed_account_ids.extend(
+            account_id for account_id, _, _ in postings
+            if account_id not in changed_account_ids)
+        Entry.objects.create_entries(self, postings)
+        self.status = 'completed'
+        self.save()
+
     def as_entry(self):
         """
         Performs this payment as a direct entry between payer and recipient.
         Creates account between them if one does not exist.
+
+        The account's new balance is updated in the cached graphs like a
+        routed payment's, so with FLOW_GRAPH_JOURNAL on it is journalled,
+        and the payment worker applies it to its session too.
         """
+        account = self._post_entry()
+        update_creditlines_in_cached_graphs(load_creditlines(
+                CreditLine.objects.filter(account=account)))
+
+    @transaction.commit_on_success(using='ripple')
+    def _post_entry(self):
+        "Posts the direct entry for as_entry.  Returns the account."
         account = Account.objects.get_or_create_account(
             self.payer, self.recipient)
         self.last_attempted_at = datetime.now()
@@ -80,23 +240,13 @@ class Payment(models.Model):
             self, account, -self.amount * payer_creditline.bal_mult, limit=None)
         self.status = 'completed'
         self.save()
+        return account
 
 class EntryManager(models.Manager):
     def create_entry(self, payment, account, amount, limit):
         "Updates account balance, and creates corresponding Entry."
-        bal_upd_query = Account.objects.filter(pk=account.id)
-        if limit is not None:
-            # Put a limit check in update query so this is safe even
-            # with concurrent transactions.
-
-            # TODO: Test with concurrent transactions.
-            
-            if amount > 0:  # Test against positive account limit.
-                bal_upd_query = bal_upd_query.filter(
-                    balance__lte=limit - amount)
-            else:  # Test against negative account limit.
-                bal_upd_query = bal_upd_query.filter(
-                    balance__gte=-limit - amount)
+        bal_upd_query = _limit_checked(
+            Account.objects.filter(pk=account.id), amount, limit)
         rows = bal_upd_query.update(balance=F('balance') + amount)
         if rows != 1:
             raise PaymentError("Limit exceeded on account %d." % account.id)
@@ -107,6 +257,101 @@ class EntryManager(models.Manager):
         new_balance = account.balance
         self.create(payment=payment, account=account, amount=amount,
                     new_balance=new_balance)
+        NodeBalance.objects.apply_postings([(account.id, amount, new_balance)])
+
+    def postings(self, flow_links):
+        """
+        Turns the (creditline_id, amount) flow of a payment into a list of
+        (account_id, amount, limit) balance changes, sorted by account id.
+        Loads the credit lines of all accounts involved in one query.  Flow
+        both ways over an account is netted, and checked against the limit
+        of the net direction.
+        """
+        creditline_ids = [creditline_id for creditline_id, _ in flow_links]
+        account_ids = CreditLine.objects.filter(
+            pk__in=creditline_ids).values('account')
+        creditlines = {}
+        limits = {}
+        for creditline in CreditLine.objects.filter(account__in=account_ids):
+            creditlines[creditline.id] = creditline
+            limits[(creditline.account_id, creditline.bal_mult)] = (
+                creditline.limit)
+        amounts = {}
+        for creditline_id, amount in flow_links:
+            creditline = creditlines[creditline_id]
+            amounts.setdefault(creditline.account_id, 0)
+            amounts[creditline.account_id] -= amount * creditline.bal_mult
+        postings = []
+        for account_id, amount in sorted(amounts.items()):
+            # Negative amounts are checked against the positive credit line.
+            bal_mult = 1 if amount <= 0 else -1
+            postings.append((account_id, amount, limits[(account_id, bal_mult)]))
+        return postings
+
+    def create_entries(self, payment, postings):
+        """
+        Applies (account_id, amount, limit) postings from postings(), and
+        bulk creates the corresponding entries, and updates the stored
+        balances of the nodes involved.  Raises LimitExceededError if any
+        account limit would be exceeded.  Must be run in a transaction,
+        which is rolled back on error.
+
+        On PostgreSQL, all balances are updated in a single statement that
+        returns the new balances.
+        """
+        if not postings:
+            return
+        if connections['ripple'].vendor == 'postgresql':
+            new_balances = self._post_all(postings)
+        else:
+            new_balances = self._post_each(postings)
+        exceeded = [account_id for account_id, _, _ in postings
+                    if account_id not in new_balances]
+        if exceeded:
+            raise LimitExceededError(exceeded)
+        self.bulk_create([
+            Entry(payment=payment, account_id=account_id, amount=amount,
+                  new_balance=new_balances[account_id])
+            for account_id, amount, _ in postings])
+        NodeBalance.objects.apply_postings([
+                (account_id, amount, new_balances[account_id])
+                for account_id, amount, _ in postings])
+
+    def _post_all(self, postings):
+        "Update all balances in one statement.  Returns new balances by id."
+        cursor = connections['ripple'].cursor()
+        cursor.execute(
+            POST_ENTRIES_SQL % ', '.join([POST_ENTRIES_ROW_SQL] * len(postings)),
+            [value for posting in postings for value in posting])
+        return dict(cursor.fetchall())
+
+    def _post_each(self, postings):
+        "Update balances one statement at a time.  Returns new balances by id."
+        posted = []
+        for account_id, amount, limit in postings:
+            bal_upd_query = _limit_checked(
+                Account.objects.filter(pk=account_id), amount, limit)
+            if bal_upd_query.update(balance=F('balance') + amount) != 1:
+                break  # The transaction will be rolled back.
+            posted.append(account_id)
+        return dict(Account.objects.filter(pk__in=posted).values_list(
+                'id', 'balance'))
+
+def _limit_checked(bal_upd_query, amount, limit):
+    """
+    Restricts balance update query to accounts where applying amount stays
+    within limit.  Putting the limit check in the update query makes this
+    safe even with concurrent transactions.
+    """
+    if limit is None:
+        return bal_upd_query
+
+    # TODO: Test with concurrent transactions.
+
+    if amount > 0:  # Test against positive account limit.
+        return bal_upd_query.filter(balance__lte=limit - amount)
+    else:  # Test against negative account limit.
+        return bal_upd_query.filter(balance__gte=-limit - amount)
 
 class Entry(models.Model):
     "An entry on an account for a payment."
@@ -127,3 +372,144 @@ class Entry(models.Model):
     def date(self):
         return self.payment.last_attempted_at
 
+
+class ReputationManager(models.Manager):
+    def get_many(self, targets, asker):
+        """
+        Returns dict of target alias: (stored reputation, dependencies),
+        where dependencies is a dict of node alias: node version the
+        reputation was computed at (see cc.payment.flow.get_node_versions).
+        Takes aliases.
+        """
+        return dict((target, (value, _decode_dependencies(dependencies)))
+                    for target, value, dependencies in
+                    self.filter(asker=asker, target__in=targets).values_list(
+                        'target', 'value', 'dependencies'))
+
+    def record(self, asker, values):
+        """
+        Stores reputations computed live for a page, so precompute keeps
+        them up to date from then on.  Takes asker alias, and dict of target
+        alias: (value, dependencies) like get_many returns.  Infinite
+        values aren't stored.  If another request stores the same pairs
+        first, its values are kept.
+        """
+        try:
+            self._replace(asker, values)
+        except IntegrityError:
+            pass
+
+    def precompute(self, askers, processes=None):
+        """
+        Recomputes the stored reputations of each of askers, replacing
+        them.  Takes asker aliases.  Returns the number of reputations
+        stored.
+
+        Only pairs already stored are recomputed: those shown on a page
+        since, which record stores, as computing every target in an
+        asker's component would take a max flow per node per asker.  Each
+        reputation graph component is loaded once, and its flows are
+        computed across a pool of processes if given.  Each asker's
+        reputations are then replaced in a transaction of their own.
+
+        Each reputation is stored with the versions of the nodes it depends
+        on, like live reputations are cached, so it is only used while
+        those nodes' credit lines are unchanged.
+        """
+        targets = {}
+        for asker, target in self.filter(asker__in=set(askers)).values_list(
+                'asker', 'target'):
+            targets.setdefault(asker, []).append(target)
+        count = 0
+        for graph in component_graphs(ignore_balances=True):
+            pairs = [(target, asker) for asker in targets if asker in graph
+                     for target in targets[asker]
+                     if target in graph and target != asker]
+            if not pairs:
+                continue
+            # Read before computing, so a change made meanwhile leaves the
+            # results stale.
+            versions = get_node_versions(graph.nodes(), ignore_balances=True)
+            results = pair_max_flows(graph, pairs, processes,
+                                     dependencies=True)
+            by_asker = {}
+            for (target, asker), (amount, dependencies) in zip(
+                    pairs, results):
+                by_asker.setdefault(asker, {})[target] = (
+                    amount, dict((alias, versions[alias])
+                                 for alias in dependencies))
+            for asker, values in sorted(by_asker.iteritems()):
+                count += self._replace(asker, values)
+        return count
+
+    @transaction.commit_on_success(using='ripple')
+    def _replace(self, asker, values):
+        """
+        Replaces asker's stored reputations with dict of target alias:
+        (value, dependencies).  Returns the number stored.
+        """
+        now = datetime.now()
+        self.filter(asker=asker, target__in=values.keys()).delete()
+        # Infinite reputations can't be stored; they are computed live.
+        reputations = [
+            Reputation(target=target, asker=asker, value=value,
+                       computed_at=now,
+                       dependencies=_encode_dependencies(dependencies))
+            for target, (value, dependencies) in values.iteritems()
+            if value != D('Infinity')]
+        self.bulk_create(reputations)
+        return len(reputations)
+
+def _encode_dependencies(dependencies):
+    return json.dumps(dependencies)
+
+def _decode_dependencies(text):
+    return dict((int(alias), version)
+                for alias, version in json.loads(text).iteritems())
+
+class Reputation(models.Model):
+    """
+    Credit reputation of target from asker's point of view, stored when it
+    is first shown and kept up to date by bin/precompute_reputations.py.
+    Read before computing reputations live, unless it is stale.  Targets
+    and askers are node aliases.
+    """
+    target = models.PositiveIntegerField()
+    asker = models.PositiveIntegerField()
+    value = AmountField()
+    computed_at = models.DateTimeField()
+    # JSON object of node alias: node version the value depends on.
+    dependencies = models.TextField()
+
+    objects = ReputationManager()
+
+    class Meta:
+        unique_together = ('asker', 'target')
+
+    def __unicode__(self):
+        return u"Reputation of %d to %d: %s" % (
+            self.target, self.asker, self.value)
+
+class AuditWatermark(models.Model):
+    """
+    How far the incremental audit has got; see
+    cc.ripple.audit.incremental_mismatches.  value is the last ID checked
+    of whatever name says, such as 'entry'.
+    """
+    name = models.CharField(max_length=32, unique=True)
+    value = models.PositiveIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __unicode__(self):
+        return u"Audited %s watermark %d" % (self.name, self.value)
+
+class AuditedBalance(models.Model):
+    """
+    Sum of an account's entries up to the entry watermark, as last verified
+    by the incremental audit.
+    """
+    account = models.OneToOneField(Account, related_name='audited_balance')
+    balance = AmountField()
+
+    def __unicode__(self):
+        return u"Audited balance of %s: %s" % (self.account, self.balance)
@@ -0,0 +1,249 @@
+"""
+Read-only flow graph snapshots shared between processes through mmap.
+
+A snapshot is a CompactGraph written to a binary file, which every worker
+process on the machine maps into memory instead of unpickling its own copy
+of the cached graph.  Snapshot files are replaced atomically, and workers
+notice the new file and map it on their next access.
+
+Each snapshot records the seq of the cached graphs it was written from (see
+flow.snapshot_seq), so readers can tell when it has fallen behind them.
+
+File format, all in native byte order:
+
+  header: magic, format version, snapshot version, seq, node count,
+          edge count
+  int64[n]    node aliases, sorted
+  int32[n+1]  out_offsets
+  int32[n+1]  in_offsets
+  int32[m]    in_edges
+  int32[m]    tail
+  int32[m]    head
+  uint8[m]    key
+  int64[m]    capacity (INFINITE_CAPACITY for infinite)
+  int64[m]    weight
+  int64[m]    creditline_id
+
+Each array starts on an 8-byte boundary.
+"""
+
+from bisect import bisect_left
+import ctypes
+import mmap
+import os
+import struct
+import tempfile
+
+from django.conf import settings
+import networkx as nx
+
+from cc.payment.compact import CompactGraph, INFINITE_CAPACITY
+from cc.payment.maxflow import compact_max_flow
+
+MAGIC = 'CCGRAPH\0'
+FORMAT_VERSION = 2
+HEADER = struct.Struct('=8sIqqII')
+
+# (attribute, ctypes type, length in terms of node count n and edge count m)
+FIELDS = (
+    ('nodes', ctypes.c_int64, lambda n, m: n),
+    ('out_offsets', ctypes.c_int32, lambda n, m: n + 1),
+    ('in_offsets', ctypes.c_int32, lambda n, m: n + 1),
+    ('in_edges', ctypes.c_int32, lambda n, m: m),
+    ('tail', ctypes.c_int32, lambda n, m: m),
+    ('head', ctypes.c_int32, lambda n, m: m),
+    ('key', ctypes.c_uint8, lambda n, m: m),
+    ('capacity', ctypes.c_int64, lambda n, m: m),
+    ('weight', ctypes.c_int64, lambda n, m: m),
+    ('creditline_id', ctypes.c_int64, lambda n, m: m),
+)
+
+class SnapshotError(Exception):
+    pass
+
+def write_snapshot(compact, path, seq=0):
+    """
+    Write CompactGraph compact, as of seq, to a snapshot file at path,
+    replacing any existing one atomically.  The new snapshot's version is
+    one more than the old one's.  Returns the new version.
+    """
+    if list(compact.nodes) != sorted(compact.nodes):
+        compact = CompactGraph(sorted(compact.nodes), compact.edges_iter())
+    try:
+        version = read_header(path)[2] + 1
+    except (IOError, OSError, SnapshotError):
+        version = 1
+    n, m = len(compact.nodes), len(compact)
+    directory = os.path.dirname(path) or '.'
+    fd, tmp_path = tempfile.mkstemp(dir=directory)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(HEADER.pack(MAGIC, FORMAT_VERSION, version, seq, n, m))
+            for name, ctype, length in FIELDS:
+                _pad(f)
+                data = (ctype * length(n, m))(*getattr(compact, name))
+                f.write(buffer(data))
+        os.chmod(tmp_path, 0644)
+        os.rename(tmp_path, path)
+    except:
+        os.unlink(tmp_path)
+        raise
+    return version
+
+def read_header(path):
+    with open(path, 'rb') as f:
+        header = f.read(HEADER.size)
+    if len(header) != HEADER.size:
+        raise SnapshotError("Truncated snapshot %s." % path)
+    fields = HEADER.unpack(header)
+    if fields[0] != MAGIC or fields[1] != FORMAT_VERSION:
+        raise SnapshotError("Not a version %d snapshot: %s." % (
+                FORMAT_VERSION, path))
+    return fields
+
+def _pad(f):
+    "Pad file to an 8-byte boundary."
+    f.write('\0' * (-f.tell() % 8))
+
+class GraphSnapshot(object):
+    """
+    Memory-mapped snapshot, with the same array attributes as CompactGraph.
+    Arrays are views on the mapped file, so nothing is copied, and pages are
+    shared with every other process mapping the same file.
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self.inode = os.fstat(f.fileno()).st_ino
+            # Private copy-on-write mapping, which ctypes can view; pages
+            # stay shared since they are never written.
+            self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+        _, _, self.version, self.seq, n, m = read_header(path)
+        offset = HEADER.size
+        for name, ctype, length in FIELDS:
+            offset += -offset % 8
+            array_type = ctype * length(n, m)
+            setattr(self, name, array_type.from_buffer(self.mmap, offset))
+            offset += ctypes.sizeof(array_type)
+
+    def __len__(self):
+        "Number of edges."
+        return len(self.tail)
+
+    def index(self, alias):
+        "Node index for alias, or None if not in snapshot."
+        i = bisect_left(self.nodes, alias)
+        if i < len(self.nodes) and self.nodes[i] == alias:
+            return i
+        return None
+
+    def subgraph(self, payer, recipient, max_hops=None):
+        """
+        Returns a networkx flow graph containing only the nodes on payer ->
+        recipient routes, like flow.prune_graph(flow.get_graph(...)) does,
+        or None if payer is not in the snapshot.  Takes node aliases.
+        """
+        payer_index = self.index(payer)
+        if payer_index is None:
+            return None
+        graph = nx.MultiDiGraph()
+        nodes = self._route_nodes(
+            payer_index, self.index(recipient), max_hops)
+        if nodes is None:
+            graph.add_node(payer)
+            return graph
+        graph.add_nodes_from(self.nodes[i] for i in nodes)
+        for i in nodes:
+            for e in xrange(self.out_offsets[i], self.out_offsets[i + 1]):
+                if self.head[e] not in nodes:
+                    continue
+                data = {'weight': self.weight[e],
+                        'creditline_id': self.creditline_id[e] or None}
+                if self.capacity[e] != INFINITE_CAPACITY:
+                    data['capacity'] = self.capacity[e]
+                graph.add_edge(self.nodes[i], self.nodes[self.head[e]],
+                               key=self.key[e], **data)
+        return graph
+
+    def max_flow(self, payer, recipient, max_hops=None, stats=None):
+        """
+        Returns the scaled max flow from payer to recipient aliases over
+        the same nodes subgraph would keep, computed on the mapped arrays
+        with maxflow.compact_max_flow, without building a networkx graph.
+        Raises NetworkXUnbounded for an infinite capacity route.
+        """
+        payer_index = self.index(payer)
+        if payer_index is None:
+            return 0
+        recipient_index = self.index(recipient)
+        nodes = self._route_nodes(payer_index, recipient_index, max_hops)
+        if nodes is None:
+            return 0
+        return compact_max_flow(
+            self, payer_index, recipient_index, nodes, stats)
+
+    def _route_nodes(self, payer_index, recipient_index, max_hops):
+        """
+        Set of indices of the nodes on payer -> recipient routes no longer
+        than max_hops, or None if there are none.
+        """
+        forward = self._hop_distances(
+            payer_index, self.out_offsets, None, self.head, max_hops)
+        if recipient_index not in forward:
+            return None
+        backward = self._hop_distances(
+            recipient_index, self.in_offsets, self.in_edges, self.tail,
+            max_hops)
+        return set(i for i, hops in forward.iteritems()
+                   if i in backward and (
+                       max_hops is None or hops + backward[i] <= max_hops))
+
+    def _hop_distances(self, start, offsets, edge_order, other_end, max_hops):
+        """
+        Breadth-first search like flow._hop_distances, over out-edges
+        (edge_order None) or in-edges (edge_order in_edges).  Works on node
+        indices.
+        """
+        hops = {start: 0}
+        frontier = [start]
+        distance = 0
+        while frontier and (max_hops is None or distance < max_hops):
+            distance += 1
+            next_frontier = []
+            for node in frontier:
+                for i in xrange(offsets[node], offsets[node + 1]):
+                    e = edge_order[i] if edge_order is not None else i
+                    neighbor = other_end[e]
+                    if neighbor not in hops and self.capacity[e] != 0:
+                        hops[neighbor] = distance
+                        next_frontier.append(neighbor)
+            frontier = next_frontier
+        return hops
+
+# Snapshots mapped by this process, by file path.
+_snapshots = {}
+
+def snapshot_path(name):
+    "Path of named snapshot, or None if snapshots are not configured."
+    directory = getattr(settings, 'FLOW_GRAPH_SNAPSHOT_DIR', None)
+    if not directory:
+        return None
+    return os.path.join(directory, '%s.snapshot' % name)
+
+def get_snapshot(name):
+    """
+    Returns the current GraphSnapshot of that name, mapping it if this
+    process hasn't yet, or if the file has been replaced since.  Returns
+    None if snapshots aren't configured or there is no snapshot yet.
+    """
+    path = snapshot_path(name)
+    if path is None:
+        return None
+    try:
+        inode = os.stat(path).st_ino
+    except OSError:
+        return None
+    snapshot = _snapshots.get(path)
+    if snapshot is None or snapshot.inode != inode:
+        snapshot = _snapshots[path] = GraphSnapshot(path)
+    return snapshot
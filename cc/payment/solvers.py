@@ -0,0 +1,69 @@
+"""
+Min cost flow solver backends.
+
+Each backend takes a networkx flow graph in the form built by
+cc.payment.flow.build_graph, with demands set on the payer and recipient,
+and returns (flow_cost, edge_flows) where edge_flows is a dict of
+(u, v, key): flow for the edges with nonzero flow only, so the result is the
+size of the route rather than of the graph.  Edges without a capacity
+attribute have infinite capacity, and parallel edges are the chunks of a
+single credit line.  Backends also take
+an optional stats dict to store solver counts in; see
+cc.payment.mincost.min_cost_flow.
+
+Backends are looked up by name in BACKENDS.  The default comes from the
+PAYMENT_FLOW_BACKEND setting.
+"""
+
+from django.conf import settings
+import networkx as nx
+
+from cc.payment.mincost import min_cost_flow, capacity_scaling_min_cost_flow
+
+DEFAULT_BACKEND = 'successive_shortest_path'
+
+def successive_shortest_path(G, stats=None):
+    return min_cost_flow(G, method='dijkstra', stats=stats, sparse=True)
+
+def capacity_scaling(G, stats=None):
+    return capacity_scaling_min_cost_flow(G, stats=stats, sparse=True)
+
+def network_simplex(G, stats=None):
+    """
+    Solve with networkx's network simplex, which only takes simple digraphs,
+    by splitting each edge with an intermediate node.  Only stores the size
+    of the split graph in stats, as 'residual_edges'.
+    """
+    H = nx.DiGraph()
+    H.add_nodes_from(G.nodes_iter(data=True))
+    for u, v, key, data in G.edges_iter(keys=True, data=True):
+        middle = (u, v, key)
+        H.add_edge(u, middle, **data)
+        H.add_edge(middle, v)
+    if stats is not None:
+        stats['residual_edges'] = H.number_of_edges()
+    flow_cost, split_flow_dict = nx.network_simplex(H)
+    edge_flows = {}
+    for u, v, key in G.edges_iter(keys=True):
+        flow = split_flow_dict[u][(u, v, key)]
+        if flow:
+            edge_flows[u, v, key] = flow
+    return flow_cost, edge_flows
+
+BACKENDS = {
+    'successive_shortest_path': successive_shortest_path,
+    'capacity_scaling': capacity_scaling,
+    'network_simplex': network_simplex,
+}
+
+def default_backend_name():
+    return getattr(settings, 'PAYMENT_FLOW_BACKEND', DEFAULT_BACKEND)
+
+def get_backend(name=None):
+    "Returns solver function for backend name, or the configured default."
+    if name is None:
+        name = default_backend_name()
+    try:
+        return BACKENDS[name]
+    except KeyError:
+        raise ValueError("Unknown min cost flow backend: %s" % name)
@@ -0,0 +1,93 @@
+"""
+Flow engine instrumentation.
+
+Each get_graph, min cost flow and max flow computation is recorded as a log
+record on the 'cc.payment.flow' logger, with the measurements as a dict in
+the record's flow_stats attribute, so they can be routed to a structured
+log handler with the LOGGING setting.  Computations slower than
+FLOW_STATS_SLOW_MS are logged as warnings, so the payer and recipient
+pairs that make the solvers blow up stand out.
+
+Numeric measurements are also added up in counters kept in the cache,
+shared by all processes, which get_counters returns for a stats view, and
+bin/flow_stats.py dumps.
+
+Recording is off by default, since updating the counters costs a cache
+round trip per measurement on the hot paths being measured.  Turn on the
+FLOW_STATS setting while investigating.
+"""
+
+import logging
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+logger = logging.getLogger('cc.payment.flow')
+
+# Event: numeric measurements added up in counters.  Every event also
+# counts how many times it happened, as 'count'.
+EVENTS = {
+    'get_graph': ('cache_hit', 'cache_miss', 'rebuild_ms', 'nodes', 'edges'),
+    'min_cost_flow': ('failed', 'solve_ms', 'nodes', 'edges',
+                      'augmentations', 'residual_edges'),
+    'max_flow': ('solve_ms', 'nodes', 'edges', 'augmentations',
+                 'residual_edges'),
+}
+
+class Timer(object):
+    "Context manager measuring elapsed time in ms, as its ms attribute."
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.ms = int((time.time() - self.start) * 1000)
+
+def record(event, **measurements):
+    """
+    Logs event with measurements, and adds the ones listed for it in
+    EVENTS to the counters.  The 'solve_ms' or 'rebuild_ms' measurement is
+    compared to FLOW_STATS_SLOW_MS.  Does nothing unless the FLOW_STATS
+    setting is on.
+    """
+    if not getattr(settings, 'FLOW_STATS', False):
+        return
+    elapsed = measurements.get('solve_ms', measurements.get('rebuild_ms', 0))
+    slow = elapsed >= getattr(settings, 'FLOW_STATS_SLOW_MS', 1000)
+    logger.log(logging.WARNING if slow else logging.DEBUG,
+               "%s %s", event, _format(measurements),
+               extra={'flow_event': event, 'flow_stats': measurements})
+    increments = {'count': 1}
+    for name in EVENTS[event]:
+        if measurements.get(name):
+            increments[name] = int(measurements[name])
+    for name, delta in increments.iteritems():
+        key = counter_cache_key(event, name)
+        cache.add(key, 0, None)
+        try:
+            cache.incr(key, delta)
+        except ValueError:
+            pass  # Evicted in between; lose this one.
+
+def get_counters():
+    "Returns dict of event: dict of measurement name: total."
+    keys = dict(((event, name), counter_cache_key(event, name))
+                for event, names in EVENTS.iteritems()
+                for name in ('count',) + names)
+    values = cache.get_many(keys.values())
+    counters = dict((event, {}) for event in EVENTS)
+    for (event, name), key in keys.iteritems():
+        counters[event][name] = values.get(key, 0)
+    return counters
+
+def reset_counters():
+    cache.delete_many([counter_cache_key(event, name)
+                       for event, names in EVENTS.iteritems()
+                       for name in ('count',) + names])
+
+def counter_cache_key(event, name):
+    return 'flow_stats_%s_%s' % (event, name)
+
+def _format(measurements):
+    return ' '.join('%s=%s' % item for item in sorted(measurements.items()))
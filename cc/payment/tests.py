@@ -1,16 +1,37 @@
+from datetime import datetime, timedelta
 from decimal import Decimal as D
 import random
+import shutil
+import sqlite3
+import tempfile
 
+from django.core.cache import cache, get_cache
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connections
 from django.test import TestCase
+from django.test.utils import override_settings
+from django.utils.unittest import skipUnless
 import networkx as nx
 
 from cc.ripple.tests import BasicTest, RippleTest
-from cc.payment.models import Payment
+from cc.payment.models import (
+    Payment, Entry, Reputation, AuditWatermark, AuditedBalance)
 from cc.ripple import audit
-from cc.account.models import Node, Account, CreditLine
-from cc.payment.mincost import min_cost_flow
-from cc.payment.testutil import generate_edges
-from cc.payment.flow import unmulti
+from cc.account.models import (
+    Node, Account, CreditLine, CreditLineChange, NodeBalance, OVERALL_BALANCE_SQL,
+    TRUSTED_BALANCE_SQL, _balance_query)
+from cc.payment.mincost import (
+    min_cost_flow, capacity_scaling_min_cost_flow, MinCostFlowSession)
+from cc.payment import solvers, stats
+from cc.payment.testutil import generate_edges, generate_creditlines
+from cc.payment.flow import (
+    unmulti, build_graph, prune_graph, max_flows, FlowGraph, get_graph,
+    get_cached_graph, get_cached_component_index, apply_journal, journal_lag)
+from cc.payment.compact import CompactGraph, build_compact_graph
+from cc.payment.maxflow import max_flow, max_flow_cut, compact_max_flow
+from cc.payment.snapshot import get_snapshot, snapshot_path, write_snapshot
+from cc.payment.worker import PaymentWorker
+from cc.payment import flow, benchmark
 
 class OneHopPaymentTest(BasicTest):
     def test_entry(self):
@@ -93,7 +114,7 @@ class OneHopPaymentTest(BasicTest):
         self._creditline_payment(self.node2_creditline, D('4'), succeed=True)
         self.assertEquals(self.node1_creditline.balance, D('-3.7'))
 
-class SimpleMultiHopPaymentTest(RippleTest):
+class SimpleMultiHopTest(RippleTest):
     multi_db = True
 
     def setUp(self):
@@ -110,7 +131,8 @@ class SimpleMultiHopPaymentTest(RippleTest):
         self._set_limit(self.cl12, D('5'))
         self._set_limit(self.cl21, D('10'))
         self._set_limit(self.cl23, D('7'))
-        
+
+class SimpleMultiHopPaymentTest(SimpleMultiHopTest):
     def test_payment(self):
         self._payment(self.n1, self.n3, 1, succeed=True)
 
@@ -127,6 +149,870 @@ class SimpleMultiHopPaymentTest(RippleTest):
         self._payment(self.n1, self.n3, 10, succeed=False)
         self._payment(self.n2, self.n1, 5, succeed=True)
 
+class PostingTest(SimpleMultiHopTest):
+    def test_postings(self):
+        postings = Entry.objects.postings(
+            [(self.cl12.id, D('3')), (self.cl23.id, D('3'))])
+        self.assertEquals(postings, [(self.a12.id, D('-3'), D('5')),
+                                     (self.a23.id, D('-3'), D('7'))])
+
+    def test_netting(self):
+        postings = Entry.objects.postings(
+            [(self.cl12.id, D('1')), (self.cl21.id, D('3'))])
+        self.assertEquals(postings, [(self.a12.id, D('2'), D('10'))])
+
+    @skipUnless(connections['ripple'].vendor == 'postgresql' or (
+            connections['ripple'].vendor == 'sqlite' and
+            sqlite3.sqlite_version_info >= (3, 35)),
+                "Needs UPDATE ... FROM ... RETURNING.")
+    def test_post_all(self):
+        "The single statement PostgreSQL posts with checks limits."
+        new_balances = Entry.objects._post_all(
+            [(self.a12.id, D('-3'), D('5')), (self.a23.id, D('-8'), D('7'))])
+        self.assertEquals(new_balances.keys(), [self.a12.id])
+        self.assertEquals(D(str(new_balances[self.a12.id])), D('-3'))
+        self.assertEquals(Account.objects.get(pk=self.a12.id).balance,
+                          D('-3'))
+        self.assertEquals(Account.objects.get(pk=self.a23.id).balance,
+                          D('0'))
+        new_balances = Entry.objects._post_all(
+            [(self.a12.id, D('1'), D('10')), (self.a23.id, D('-7'), D('7'))])
+        self.assertEquals(sorted(new_balances), [self.a12.id, self.a23.id])
+        self.assertEquals(Account.objects.get(pk=self.a12.id).balance,
+                          D('-2'))
+        self.assertEquals(Account.objects.get(pk=self.a23.id).balance,
+                          D('-7'))
+
+    def test_entries(self):
+        self._payment(self.n1, self.n3, 3, succeed=True)
+        self._payment(self.n1, self.n3, 1, succeed=True)
+        payment = Payment.objects.order_by('-id')[0]
+        entries = sorted((entry.account_id, entry.amount, entry.new_balance)
+                         for entry in payment.entries.all())
+        self.assertEquals(entries, [(self.a12.id, D('-1'), D('-4')),
+                                    (self.a23.id, D('-1'), D('-4'))])
+
+class MultiPaymentTest(SimpleMultiHopTest):
+    def _payments(self, amounts):
+        return [Payment.objects.create(
+                payer=self.n1, recipient=recipient, amount=amount)
+                for recipient, amount in amounts]
+
+    def test_pay_many(self):
+        payments = self._payments([(self.n2, 2), (self.n3, 3)])
+        Payment.objects.attempt_many(payments)
+        self.reload()
+        self.assertEquals(self.a12.balance, D('-5'))
+        self.assertEquals(self.a23.balance, D('-3'))
+        for payment in payments:
+            self.assertEquals(Payment.objects.get(pk=payment.id).status,
+                              'completed')
+        self.assertEquals(
+            [entry.amount for entry in payments[0].entries.all()], [D('-2')])
+        self.failUnless(audit.all_accounts_check())
+        self.failUnless(audit.all_payments_check())
+
+    def test_empty(self):
+        from cc.ripple import api
+        Payment.objects.attempt_many([])
+        self.assertEquals(api.pay_many(ProfileStandIn(1), [], 'memo'), [])
+        self.assertEquals(Payment.objects.count(), 0)
+
+    def test_insufficient(self):
+        payments = self._payments([(self.n2, 3), (self.n3, 3)])
+        try:
+            Payment.objects.attempt_many(payments)
+        except flow.InsufficientMultiCreditError as exc:
+            self.assertEquals(exc.max_amounts, {2: D('5'), 3: D('5')})
+        else:
+            self.fail("Payments should not fit.")
+        self.reload()
+        self.assertEquals(self.a12.balance, D('0'))
+        self.assertEquals(
+            set(Payment.objects.values_list('status', flat=True)),
+            set(['failed']))
+
+    def test_decompose_flow(self):
+        edge_flows = {(1, 2, 0): 5, (1, 2, 1): 2, (2, 3, 0): 4}
+        routes = flow.decompose_flow(edge_flows, 1, {2: 3, 3: 4})
+        self.assertEquals(sum(routes[3].values()), 8)
+        self.assertEquals(routes[3][2, 3, 0], 4)
+        totals = {}
+        for route in routes.values():
+            for edge, amount in route.items():
+                totals[edge] = totals.get(edge, 0) + amount
+        self.assertEquals(totals, edge_flows)
+
+class BulkAuditTest(SimpleMultiHopTest):
+    def test_clean(self):
+        self._payment(self.n1, self.n3, 3, succeed=True)
+        self._payment(self.n3, self.n2, 1, succeed=True)
+        self.failUnless(audit.all_accounts_check(bulk=True))
+        self.failUnless(audit.all_payments_check(bulk=True))
+        self.assertEquals(list(audit.account_mismatches()), [])
+        self.assertEquals(list(audit.payment_mismatches()), [])
+
+    def test_account_mismatch(self):
+        self._payment(self.n1, self.n3, 3, succeed=True)
+        Account.objects.filter(pk=self.a23.id).update(balance=D('-2'))
+        errors = list(audit.account_mismatches())
+        self.assertEquals(len(errors), 1)
+        self.failUnless(("Account %s " % self.a23.id) in str(errors[0]))
+        self.assertRaises(audit.AuditError, audit.all_accounts_check,
+                          bulk=True)
+
+    def test_payment_mismatch(self):
+        self._payment(self.n1, self.n3, 3, succeed=True)
+        payment = Payment.objects.get()
+        payment.entries.filter(account=self.a23).update(amount=D('-2'))
+        errors = [str(error) for error in audit.payment_mismatches()]
+        self.assertEquals(len(errors), 2)
+        self.failUnless("intermediary's" in errors[0])
+        self.failUnless("recipient did not" in errors[1])
+        self.assertRaises(audit.AuditError, audit.all_payments_check,
+                          bulk=True)
+
+class IncrementalAuditTest(SimpleMultiHopTest):
+    def _errors(self):
+        return [str(error) for error in audit.incremental_mismatches()]
+
+    def test_watermark(self):
+        self._payment(self.n1, self.n3, 3, succeed=True)
+        self.assertEquals(self._errors(), [])
+        self.assertEquals(audit.get_watermark(audit.ENTRY_WATERMARK),
+                          Entry.objects.order_by('-id')[0].id)
+        self.assertEquals(
+            AuditedBalance.objects.get(account=self.a23).balance, D('-3'))
+        self._payment(self.n3, self.n2, 1, succeed=True)
+        self.assertEquals(self._errors(), [])
+        self.assertEquals(
+            AuditedBalance.objects.get(account=self.a23).balance, D('-2'))
+
+    @override_settings(AUDIT_RECHECK_WINDOW=timedelta(0))
+    def test_only_new_payments(self):
+        self._payment(self.n1, self.n3, 3, succeed=True)
+        self.assertEquals(self._errors(), [])
+        # Old payments aren't checked again.
+        Payment.objects.update(amount=D('4'))
+        self.assertEquals(self._errors(), [])
+        payment = Payment.objects.create(
+            payer=self.n1, recipient=self.n2, amount=D('1'))
+        payment.attempt()
+        Payment.objects.filter(pk=payment.id).update(amount=D('2'))
+        errors = self._errors()
+        self.assertEquals(len(errors), 2)
+        self.failUnless(all(("Payment %s:" % payment.id) in error
+                            for error in errors))
+
+    def test_balance_change(self):
+        self._payment(self.n1, self.n3, 3, succeed=True)
+        self.assertEquals(self._errors(), [])
+        Account.objects.filter(pk=self.a23.id).update(balance=D('-2'))
+        errors = self._errors()
+        self.assertEquals(len(errors), 1)
+        self.failUnless(("Account %s " % self.a23.id) in errors[0])
+        # Still reported until fixed.
+        self.assertEquals(len(self._errors()), 1)
+        Account.objects.filter(pk=self.a23.id).update(balance=D('-3'))
+        self.assertEquals(self._errors(), [])
+
+    def test_late_entry(self):
+        "Entries committed below the watermark cause no false alarms."
+        self._payment(self.n1, self.n3, 3, succeed=True)
+        self.assertEquals(self._errors(), [])
+        self._payment(self.n1, self.n3, 1, succeed=True)
+        AuditWatermark.objects.update(
+            value=Entry.objects.order_by('-id')[0].id)
+        self.assertEquals(self._errors(), [])
+
+    def test_late_payment(self):
+        "Payments committed below the watermark are checked."
+        self._payment(self.n1, self.n3, 3, succeed=True)
+        self.assertEquals(self._errors(), [])
+        payment = Payment.objects.create(
+            payer=self.n1, recipient=self.n2, amount=D('1'))
+        payment.attempt()
+        Payment.objects.filter(pk=payment.id).update(amount=D('2'))
+        AuditWatermark.objects.update(
+            value=Entry.objects.order_by('-id')[0].id)
+        errors = self._errors()
+        self.assertEquals(len(errors), 2)
+        self.failUnless(all(("Payment %s:" % payment.id) in error
+                            for error in errors))
+        # Not once it was attempted before the recheck window.
+        Payment.objects.filter(pk=payment.id).update(
+            last_attempted_at=datetime.now() - timedelta(hours=1))
+        self.assertEquals(self._errors(), [])
+
+class NodeBalanceTest(SimpleMultiHopTest):
+    def _check(self):
+        "Stored balances match the ones computed from credit lines."
+        nodes = [self.n1, self.n2, self.n3]
+        balances = NodeBalance.objects.get_many([n.alias for n in nodes])
+        for node in nodes:
+            self.assertEquals(
+                balances[node.alias],
+                (_balance_query(OVERALL_BALANCE_SQL, node.id),
+                 _balance_query(TRUSTED_BALANCE_SQL, node.id)))
+
+    def test_postings(self):
+        self._check()
+        self._payment(self.n1, self.n3, 3, succeed=True)
+        self._check()
+        self.assertEquals(self.n3.overall_balance(), D('3'))
+        self._set_limit(self.cl32, None)
+        self._payment(self.n3, self.n1, 5, succeed=True)
+        self._check()
+        Payment.objects.create(
+            payer=self.n2, recipient=self.n3, amount=D('1')).as_entry()
+        self._check()
+
+    def test_limit_change(self):
+        self._payment(self.n1, self.n3, 4, succeed=True)
+        self._check()
+        self._set_limit(self.cl23, D('2'))
+        self.assertEquals(self.n3.trusted_balance(), D('2'))
+        self._check()
+
+    def test_missing_node(self):
+        self.assertEquals(NodeBalance.objects.get_many([99]),
+                          {99: (D('0'), D('0'))})
+
+    def test_invalidated_during_refresh(self):
+        "Balances computed before a change aren't stored after it."
+        self._payment(self.n1, self.n3, 4, succeed=True)
+        self._check()
+        version = NodeBalance.objects.get(node=self.n3).version
+        NodeBalance.objects.invalidate([self.n3.id])
+        row = NodeBalance.objects.get(node=self.n3)
+        self.assertEquals((row.overall, row.trusted), (None, None))
+        self.assertEquals(row.version, version + 1)
+        NodeBalance.objects.refresh({self.n3.id: version})
+        self.assertEquals(NodeBalance.objects.get(node=self.n3).overall, None)
+        self._check()
+        self.failIfEqual(NodeBalance.objects.get(node=self.n3).overall, None)
+
+    def test_created_during_refresh(self):
+        "A row stored by another transaction first is kept."
+        self._check()
+        NodeBalance.objects.filter(node=self.n1).update(overall=D('7'))
+        balances = NodeBalance.objects.refresh({self.n1.id: None})
+        self.assertEquals(balances[self.n1.id], (D('0'), D('0')))
+        self.assertEquals(
+            NodeBalance.objects.get(node=self.n1).overall, D('7'))
+
+    def test_postings_to_stale(self):
+        self._check()
+        NodeBalance.objects.invalidate([self.n1.id, self.n2.id])
+        self._payment(self.n1, self.n3, 3, succeed=True)
+        self.assertEquals(NodeBalance.objects.get(node=self.n1).overall, None)
+        self._check()
+
+class PresolvedRouteTest(SimpleMultiHopTest):
+    def test_graph_version(self):
+        version = flow.graph_version()
+        self._payment(self.n1, self.n3, 1, succeed=True)
+        self.assertNotEquals(flow.graph_version(), version)
+
+    def test_attempt_with_route(self):
+        route = FlowGraph(self.n1, self.n3).min_cost_flow(D('2'))
+        payment = Payment.objects.create(
+            payer=self.n1, recipient=self.n3, amount=D('2'))
+        payment.attempt(flow_links=route)
+        self.reload()
+        self.assertEquals(payment.status, 'completed')
+        self.assertEquals(self.a23.balance, D('-2'))
+        self.failUnless(audit.all_payments_check())
+
+class ReputationPrecomputeTest(SimpleMultiHopTest):
+    def _values(self, targets, asker):
+        return dict((target, value) for target, (value, _) in
+                    Reputation.objects.get_many(targets, asker).items())
+
+    def _show(self, targets, asker):
+        "Computes reputations live, as a page showing them would."
+        from cc.ripple import api
+        return api.credit_reputation_many(
+            [ProfileStandIn(target.alias) for target in targets],
+            ProfileStandIn(asker.alias))
+
+    def test_record(self):
+        self._show([self.n1], self.n3)
+        self.assertEquals(
+            self._values([self.n1.alias, self.n2.alias], self.n3.alias),
+            {self.n1.alias: FlowGraph(
+                    self.n1, self.n3, ignore_balances=True).max_flow()})
+
+    def test_precompute(self):
+        n4 = Node.objects.create(alias=4)
+        self._show([self.n1], self.n3)
+        self._show([self.n1], n4)
+        Reputation.objects.filter(asker=self.n3.alias).update(value=D('0'))
+        self.assertEquals(Reputation.objects.precompute(
+                [self.n3.alias, n4.alias]), 1)
+        # Only pairs that were shown are stored.
+        self.assertEquals(
+            self._values([self.n1.alias, self.n2.alias], self.n3.alias),
+            {self.n1.alias: FlowGraph(
+                    self.n1, self.n3, ignore_balances=True).max_flow()})
+
+    def test_replace(self):
+        self._show([self.n1], self.n3)
+        self._set_limit(self.cl23, D('1'))
+        Reputation.objects.precompute([self.n3.alias])
+        self.assertEquals(self._values([self.n1.alias], self.n3.alias),
+                          {self.n1.alias: D('1')})
+
+    def test_dependencies(self):
+        self._show([self.n1], self.n3)
+        Reputation.objects.precompute([self.n3.alias])
+        _, dependencies = Reputation.objects.get_many(
+            [self.n1.alias], self.n3.alias)[self.n1.alias]
+        self.assertEquals(
+            dependencies, flow.get_node_versions(dependencies, True))
+        self.failUnless(self.n2.alias in dependencies)
+
+    def test_stale(self):
+        "Stored reputations aren't used once their dependencies change."
+        from cc.ripple import api
+        n1, n3 = ProfileStandIn(self.n1.alias), ProfileStandIn(self.n3.alias)
+        self._show([self.n1], self.n3)
+        Reputation.objects.precompute([self.n3.alias])
+        Reputation.objects.filter(target=self.n1.alias).update(value=D('2'))
+        self.assertEquals(api.credit_reputation(n1, n3), D('2'))
+        self._set_limit(self.cl23, D('1'))
+        self.assertEquals(api.credit_reputation(n1, n3), D('1'))
+        # Now cached.
+        self.assertEquals(api.credit_reputation_many([n1], n3),
+                          {self.n1.alias: D('1')})
+
+class ProfileStandIn(object):
+    "Just the profile ID, which is all cc.ripple.api uses of profiles."
+    def __init__(self, id):
+        self.id = id
+
+class FlowStatsTest(SimpleMultiHopTest):
+    def test_counters(self):
+        stats.reset_counters()
+        with self.settings(FLOW_STATS=True):
+            self._payment(self.n1, self.n3, 2, succeed=True)
+            self._payment(self.n1, self.n3, 10, succeed=False)
+            FlowGraph(self.n1, self.n3).max_flow()
+        counters = stats.get_counters()
+        self.assertEquals(counters['min_cost_flow']['count'], 2)
+        self.assertEquals(counters['min_cost_flow']['failed'], 1)
+        self.failUnless(counters['min_cost_flow']['augmentations'] >= 1)
+        self.assertEquals(counters['max_flow']['count'], 1)
+        self.failUnless(counters['get_graph']['count'] >= 3)
+        self.failUnless(counters['get_graph']['cache_hit'] >= 2)
+
+    def test_disabled(self):
+        stats.reset_counters()
+        with self.settings(FLOW_STATS=False):
+            FlowGraph(self.n1, self.n3).max_flow()
+        self.assertEquals(stats.get_counters()['max_flow']['count'], 0)
+
+class RetryTest(SimpleMultiHopTest):
+    def setUp(self):
+        super(RetryTest, self).setUp()
+        self._set_limit(self.cl32, D('10'))
+        self.a13 = Account.objects.create_account(self.n1, self.n3)
+        self._set_limit(
+            CreditLine.objects.get(account=self.a13, node=self.n1), D('10'))
+
+    def _make_cache_stale(self):
+        "Pay 3 from n1 to n2, but leave the cached graph as before."
+        stale_graph = get_graph(self.n1).copy()
+        self._payment(self.n1, self.n2, 3, succeed=True)
+        flow.set_cached_graph(stale_graph, ignore_balances=False)
+
+    def test_retry(self):
+        self._make_cache_stale()
+        # Only 2 left on direct route, so 2 must go through n3.
+        self._payment(self.n1, self.n2, 4, succeed=True)
+        self.assertEquals(self.a12.balance, D('-5'))
+        self.assertEquals(self.a23.balance, D('2'))
+
+    def test_no_retries(self):
+        self._make_cache_stale()
+        with self.settings(PAYMENT_MAX_RETRIES=0):
+            self._payment(self.n1, self.n2, 4, succeed=False)
+        self.assertEquals(self.a12.balance, D('-3'))
+
+@override_settings(FLOW_GRAPH_JOURNAL=True)
+class PaymentWorkerTest(SimpleMultiHopTest):
+    def _edges(self, graph):
+        return sorted(graph.edges(keys=True, data=True))
+
+    def test_run_once(self):
+        worker = PaymentWorker()
+        payment = Payment.objects.create(
+            payer=self.n1, recipient=self.n3, amount=D('3'))
+        self.assertEquals(list(Payment.objects.queued()), [payment])
+        self.assertEquals(worker.run_once(), 1)
+        self.reload()
+        self.assertEquals(Payment.objects.get(pk=payment.id).status,
+                          'completed')
+        self.assertEquals(self.a12.balance, D('-3'))
+        self.assertEquals(list(Payment.objects.queued()), [])
+        self.assertEquals(self._edges(worker.session.graph),
+                          self._edges(build_graph(False)))
+
+    def test_journalled_changes(self):
+        worker = PaymentWorker()
+        self._set_limit(self.cl12, D('2'))
+        worker.run_once()
+        self.assertEquals(self._edges(worker.session.graph),
+                          self._edges(build_graph(False)))
+
+    def test_session_matches_fresh_solve(self):
+        "Routing through the worker's session resets it between payments."
+        worker = PaymentWorker()
+        for amount in (D('3'), D('1'), D('2')):
+            Payment.objects.create(
+                payer=self.n1, recipient=self.n3, amount=amount)
+            worker.run_once()
+            session = flow.SolverSession(build_graph(False))
+            self.assertEquals(
+                sorted(worker.session.solver.R.edges(keys=True, data=True)),
+                sorted(session.solver.R.edges(keys=True, data=True)))
+            self.assertEquals(worker.session.solver.potential,
+                              session.solver.potential)
+
+    def test_payer_not_in_graph(self):
+        worker = PaymentWorker()
+        n4 = Node.objects.create(alias=4)
+        payment = Payment.objects.create(
+            payer=n4, recipient=self.n3, amount=D('1'))
+        with self.settings(PAYMENT_MAX_HOPS=2):
+            self.assertEquals(worker.run_once(), 1)
+        self.assertEquals(Payment.objects.get(pk=payment.id).status, 'failed')
+
+    def test_session_payer_not_in_graph(self):
+        session = flow.SolverSession(build_graph(False))
+        n4 = Node.objects.create(alias=4)
+        for max_hops in (None, 2):
+            with self.settings(PAYMENT_MAX_HOPS=max_hops):
+                self.assertRaises(flow.NoRoutesError, session.min_cost_flow,
+                                  n4, self.n3, D('1'))
+
+    def test_claim(self):
+        payment = Payment.objects.create(
+            payer=self.n1, recipient=self.n3, amount=D('3'))
+        self.failUnless(Payment.objects.claim(payment))
+        self.failIf(Payment.objects.claim(payment))
+
+    def test_direct_payment(self):
+        "Direct payments reach the worker's session through the journal."
+        worker = PaymentWorker()
+        Payment.objects.create(
+            payer=self.n1, recipient=self.n2, amount=D('3')).as_entry()
+        self.assertNotEquals(self._edges(worker.session.graph),
+                             self._edges(build_graph(False)))
+        worker.run_once()
+        self.assertEquals(self._edges(worker.session.graph),
+                          self._edges(build_graph(False)))
+
+    @override_settings(FLOW_GRAPH_JOURNAL=False)
+    def test_requires_journal(self):
+        self.assertRaises(ImproperlyConfigured, PaymentWorker)
+
+class MaxHopsPaymentTest(SimpleMultiHopTest):
+    def test_max_hops(self):
+        with self.settings(PAYMENT_MAX_HOPS=1):
+            self._payment(self.n1, self.n3, 1, succeed=False)
+            self._payment(self.n1, self.n2, 1, succeed=True)
+        with self.settings(PAYMENT_MAX_HOPS=2):
+            self._payment(self.n1, self.n3, 1, succeed=True)
+
+class MaxFlowsTest(SimpleMultiHopTest):
+    def test_max_flows(self):
+        self._payment(self.n1, self.n3, 2, succeed=True)
+        payers = [self.n1, self.n2, self.n3]
+        for ignore_balances in (False, True):
+            correct = [FlowGraph(payer, self.n3, ignore_balances).max_flow()
+                       for payer in payers]
+            self.assertEquals(
+                max_flows(payers, self.n3, ignore_balances), correct)
+            self.assertEquals(
+                max_flows(payers, self.n3, ignore_balances, processes=2),
+                correct)
+
+class ComponentIndexTest(RippleTest):
+    def setUp(self):
+        self.nodes = [Node.objects.create(alias=i) for i in range(1, 6)]
+        n1, n2, n3, n4, n5 = self.nodes
+        Account.objects.create_account(n1, n2)
+        Account.objects.create_account(n3, n4)
+
+    def _edges(self, graph):
+        return sorted(graph.edges(keys=True, data=True))
+
+    def test_components(self):
+        n1, n2, n3, n4, n5 = self.nodes
+        self.assertEquals(sorted(get_graph(n1).nodes()), [1, 2])
+        self.assertEquals(sorted(get_graph(n4).nodes()), [3, 4])
+        self.assertEquals(get_graph(n5).nodes(), [5])
+        index = get_cached_component_index(False)
+        self.assertEquals(index[1], index[2])
+        self.assertNotEquals(index[1], index[3])
+
+    def test_merge(self):
+        n1, n2, n3, n4, n5 = self.nodes
+        for ignore_balances in (False, True):
+            get_graph(n1, ignore_balances)  # Build cache.
+        Account.objects.create_account(n2, n3)
+        Account.objects.create_account(n5, n1)
+        for ignore_balances in (False, True):
+            self.assertEquals(
+                sorted(get_graph(n4, ignore_balances).nodes()),
+                [1, 2, 3, 4, 5])
+            self.assertEquals(
+                len(set(get_cached_component_index(
+                            ignore_balances).values())), 1)
+            self.assertEquals(self._edges(get_cached_graph(ignore_balances)),
+                              self._edges(build_graph(ignore_balances)))
+
+    def test_delete(self):
+        n1, n2, n3, n4, n5 = self.nodes
+        for ignore_balances in (False, True):
+            get_graph(n1, ignore_balances)  # Build cache.
+        n3.delete()
+        for ignore_balances in (False, True):
+            self.assertEquals(get_graph(n4, ignore_balances).edges(), [])
+            self.assertEquals(self._edges(get_cached_graph(ignore_balances)),
+                              self._edges(build_graph(ignore_balances)))
+
+    def test_shards(self):
+        n1, n2, n3, n4, n5 = self.nodes
+        shard_size = flow.COMPONENT_INDEX_SHARD_SIZE
+        flow.COMPONENT_INDEX_SHARD_SIZE = 2
+        try:
+            get_graph(n1)  # Build cache.
+            Account.objects.create_account(n2, n3)
+        finally:
+            flow.COMPONENT_INDEX_SHARD_SIZE = shard_size
+        self.assertEquals(cache.get(flow.component_index_cache_key(False)), 3)
+        component_ids = [flow.get_cached_component_id(node.alias, False)
+                         for node in self.nodes]
+        self.assertEquals(len(set(component_ids[:4])), 1)
+        self.assertEquals(component_ids[4], 5)
+        cache.delete(flow.component_index_shard_cache_key(False, 1))
+        self.assertEquals(flow.get_cached_component_id(1, False), None)
+        self.assertEquals(get_cached_component_index(False), None)
+        self.assertEquals(sorted(get_graph(n1).nodes()), [1, 2, 3, 4])
+
+@override_settings(FLOW_GRAPH_JOURNAL=True)
+class JournalTest(SimpleMultiHopTest):
+    def _edges(self, graph):
+        return sorted(graph.edges(keys=True, data=True))
+
+    def test_journal(self):
+        apply_journal()  # Builds cached graphs.
+        graph = get_graph(self.n1)
+        self.assertEquals(journal_lag(graph), 0)
+        self._payment(self.n1, self.n3, 2, succeed=True)
+        self._set_limit(self.cl23, D('3'))
+        # Not applied yet.
+        graph = get_graph(self.n1)
+        self.assertEquals(journal_lag(graph), 5)
+        self.assertNotEquals(self._edges(graph),
+                             self._edges(build_graph(False)))
+        self.assertEquals(apply_journal(), 5)
+        self.assertEquals(journal_lag(graph), 5)
+        for ignore_balances in (False, True):
+            graph = get_graph(self.n1, ignore_balances)
+            self.assertEquals(journal_lag(graph), 0)
+            self.assertEquals(self._edges(graph),
+                              self._edges(build_graph(ignore_balances)))
+        self.assertEquals(apply_journal(), 0)
+
+    def test_no_creditlines(self):
+        "Nodes with no credit lines don't cost a rebuild."
+        apply_journal()
+        node = Node.objects.create(alias=99)
+        with self.assertNumQueries(1, using='ripple'):
+            graph = get_graph(node)
+        self.assertEquals(graph.nodes(), [99])
+        self.assertEquals(graph.number_of_edges(), 0)
+        self.assertEquals(cache.get(flow.rebuild_cache_key(False)), None)
+
+    def test_component_evicted(self):
+        "The applier rebuilds a component get_graph found missing."
+        apply_journal()
+        component_id = flow.get_cached_component_id(self.n1.alias, False)
+        cache.delete(flow.component_cache_key(False, component_id))
+        self.assertEquals(self._edges(get_graph(self.n1)),
+                          self._edges(build_graph(False)))
+        self.assertEquals(cache.get(flow.rebuild_cache_key(False)), True)
+        apply_journal()
+        self.assertEquals(cache.get(flow.rebuild_cache_key(False)), None)
+        with self.assertNumQueries(0, using='ripple'):
+            graph = get_graph(self.n1)
+        self.assertEquals(self._edges(graph), self._edges(build_graph(False)))
+
+    def test_late_commit(self):
+        "Entries with lower ids than ones already applied still get applied."
+        apply_journal()
+        self._set_limit(self.cl23, D('3'))
+        late = CreditLineChange.objects.latest('pk')
+        late.delete()
+        self._set_limit(self.cl12, D('4'))
+        self.assertEquals(apply_journal(), 1)
+        CreditLineChange.objects.create(
+            id=late.id, creditline_id=late.creditline_id)
+        self.assertEquals(apply_journal(), 1)
+        self.assertEquals(self._edges(get_graph(self.n1)),
+                          self._edges(build_graph(False)))
+
+    def test_delete(self):
+        apply_journal()
+        self.cl23.delete()
+        self.assertEquals(CreditLineChange.objects.filter(
+                node_alias__isnull=False).count(), 2)
+        apply_journal()
+        for ignore_balances in (False, True):
+            self.assertEquals(
+                self._edges(get_cached_graph(ignore_balances)),
+                self._edges(build_graph(ignore_balances)))
+
+    def test_not_cached(self):
+        "Web processes don't write the cached graphs."
+        get_graph(self.n1)
+        self.assertEquals(get_cached_component_index(False), None)
+
+class SnapshotTest(SimpleMultiHopTest):
+    def setUp(self):
+        super(SnapshotTest, self).setUp()
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        super(SnapshotTest, self).tearDown()
+
+    def _edges(self, graph):
+        return sorted(graph.edges(keys=True, data=True))
+
+    def test_snapshot(self):
+        self._payment(self.n1, self.n3, 2, succeed=True)
+        with self.settings(FLOW_GRAPH_SNAPSHOT_DIR=self.directory):
+            self.assertEquals(get_snapshot('payment_graph'), None)
+            flow.write_graph_snapshots()
+            for ignore_balances in (False, True):
+                snapshot = get_snapshot(flow.cache_key(ignore_balances))
+                self.assertEquals(snapshot.version, 1)
+                for payer, recipient in ((1, 3), (3, 1), (2, 1)):
+                    pruned = prune_graph(build_graph(ignore_balances),
+                                         payer, recipient)
+                    self.assertEquals(
+                        self._edges(snapshot.subgraph(payer, recipient)),
+                        self._edges(pruned))
+                self.assertEquals(snapshot.subgraph(4, 1), None)
+            self.assertEquals(
+                FlowGraph(self.n1, self.n3).max_flow(), D('3'))
+
+    def test_max_flow(self):
+        "Max flows on the snapshot arrays match the networkx ones."
+        self._payment(self.n1, self.n3, 2, succeed=True)
+        self._set_limit(self.cl32, None)
+        with self.settings(FLOW_GRAPH_SNAPSHOT_DIR=self.directory):
+            flow.write_graph_snapshots()
+            for ignore_balances in (False, True):
+                snapshot = get_snapshot(flow.cache_key(ignore_balances))
+                graph = build_graph(ignore_balances)
+                for payer, recipient in ((1, 3), (3, 1), (2, 1), (4, 1)):
+                    for max_hops in (None, 1):
+                        self.assertEquals(
+                            flow.pruned_max_flow_amount(
+                                snapshot, payer, recipient, max_hops),
+                            flow.pruned_max_flow_amount(
+                                graph, payer, recipient, max_hops))
+
+    def test_swap(self):
+        with self.settings(FLOW_GRAPH_SNAPSHOT_DIR=self.directory):
+            path = snapshot_path('payment_graph')
+            write_snapshot(CompactGraph.from_graph(build_graph(False)), path)
+            snapshot = get_snapshot('payment_graph')
+            self.assertEquals(get_snapshot('payment_graph'), snapshot)
+            self._set_limit(self.cl12, D('1'))
+            write_snapshot(CompactGraph.from_graph(build_graph(False)), path)
+            new_snapshot = get_snapshot('payment_graph')
+            self.assertEquals(new_snapshot.version, 2)
+            self.assertEquals(
+                new_snapshot.subgraph(1, 2)[1][2][0]['capacity'], 100)
+
+    def test_stale(self):
+        with self.settings(FLOW_GRAPH_SNAPSHOT_DIR=self.directory):
+            self.assertEquals(flow.write_graph_snapshots(), 2)
+            self.assertEquals(flow.write_graph_snapshots(), 0)
+            self.failIf(flow.fresh_snapshot(False) is None)
+            self._set_limit(self.cl12, D('1'))
+            self.assertEquals(flow.fresh_snapshot(False), None)
+            self.assertEquals(FlowGraph(self.n1, self.n3).max_flow(), D('1'))
+            self.assertEquals(flow.write_graph_snapshots(), 2)
+            self.assertEquals(
+                flow.fresh_snapshot(False).subgraph(1, 2)[1][2][0]['capacity'],
+                100)
+
+    def test_cache_cleared(self):
+        "Snapshots look stale once the counters they were stamped with go."
+        with self.settings(FLOW_GRAPH_SNAPSHOT_DIR=self.directory):
+            self.assertEquals(flow.write_graph_snapshots(), 2)
+            cache.clear()
+            self.assertEquals(flow.fresh_snapshot(False), None)
+            self._set_limit(self.cl12, D('1'))
+            self.assertEquals(FlowGraph(self.n1, self.n3).max_flow(), D('1'))
+            self.assertEquals(flow.write_graph_snapshots(), 2)
+            self.assertEquals(
+                flow.fresh_snapshot(False).subgraph(1, 2)[1][2][0]['capacity'],
+                100)
+
+    def test_journal_cache_cleared(self):
+        with self.settings(FLOW_GRAPH_SNAPSHOT_DIR=self.directory,
+                           FLOW_GRAPH_JOURNAL=True):
+            apply_journal()
+            self.failIf(flow.fresh_snapshot(False) is None)
+            cache.clear()
+            self.assertEquals(flow.fresh_snapshot(False), None)
+            apply_journal()
+            self.failIf(flow.fresh_snapshot(False) is None)
+
+    def test_journal(self):
+        "The journal applier keeps snapshots up to date."
+        with self.settings(FLOW_GRAPH_SNAPSHOT_DIR=self.directory,
+                           FLOW_GRAPH_JOURNAL=True):
+            apply_journal()
+            snapshot = flow.fresh_snapshot(False)
+            self._set_limit(self.cl12, D('1'))
+            self.assertEquals(flow.fresh_snapshot(False), snapshot)
+            apply_journal()
+            snapshot = flow.fresh_snapshot(False)
+            self.assertEquals(snapshot.seq, flow.get_journal_seq())
+            self.assertEquals(snapshot.subgraph(1, 2)[1][2][0]['capacity'],
+                              100)
+
+class PruneGraphTest(TestCase):
+    def setUp(self):
+        self.graph = nx.MultiDiGraph()
+        self.graph.add_edges_from([
+                (1, 2, {'capacity': 5}),
+                (2, 3, {}),  # Infinite capacity.
+                (3, 4, {'capacity': 5}),
+                (1, 5, {'capacity': 5}),  # Dead end.
+                (6, 1, {'capacity': 5}),  # Can't be reached from 1.
+                (2, 7, {'capacity': 0}),  # No capacity.
+                (7, 4, {'capacity': 5}),
+                (1, 8, {'capacity': 5}),  # Longer route.
+                (8, 9, {'capacity': 5}),
+                (9, 10, {'capacity': 5}),
+                (10, 4, {'capacity': 5}),
+                ])
+
+    def test_prune(self):
+        pruned = prune_graph(self.graph, 1, 4)
+        self.assertEquals(sorted(pruned.nodes()), [1, 2, 3, 4, 8, 9, 10])
+        self.assertEquals(pruned.number_of_edges(), 7)
+
+    def test_max_hops(self):
+        pruned = prune_graph(self.graph, 1, 4, max_hops=3)
+        self.assertEquals(sorted(pruned.nodes()), [1, 2, 3, 4])
+        pruned = prune_graph(self.graph, 1, 4, max_hops=2)
+        self.assertEquals(pruned.nodes(), [1])
+
+    def test_unreachable(self):
+        pruned = prune_graph(self.graph, 1, 6)
+        self.assertEquals(pruned.nodes(), [1])
+
+    def test_missing_payer(self):
+        self.assertEquals(prune_graph(self.graph, 11, 4).nodes(), [])
+
+class CompactGraphTest(SimpleMultiHopTest):
+    def _edges(self, graph):
+        return sorted(graph.edges(keys=True, data=True))
+
+    def test_from_graph(self):
+        self._payment(self.n1, self.n3, 2, succeed=True)
+        for ignore_balances in (False, True):
+            graph = build_graph(ignore_balances)
+            compact = CompactGraph.from_graph(graph)
+            self.assertEquals(len(compact), graph.number_of_edges())
+            self.assertEquals(
+                self._edges(compact.to_graph()), self._edges(graph))
+
+    def test_from_orm(self):
+        self._payment(self.n1, self.n3, 2, succeed=True)
+        for ignore_balances in (False, True):
+            compact = build_compact_graph(ignore_balances)
+            self.assertEquals(self._edges(compact.to_graph()),
+                              self._edges(build_graph(ignore_balances)))
+
+    def test_adjacency(self):
+        compact = CompactGraph.from_graph(build_graph(False))
+        n2 = compact.node_index[self.n2.alias]
+        out_heads = sorted(compact.nodes[compact.head[e]]
+                           for e in compact.out_edges(n2))
+        self.assertEquals(out_heads, [self.n1.alias, self.n3.alias])
+        in_tails = sorted(compact.nodes[compact.tail[e]]
+                          for e in compact.in_edge_indices(n2))
+        self.assertEquals(in_tails, [self.n1.alias, self.n3.alias])
+        for e in compact.out_edges(compact.node_index[self.n3.alias]):
+            # n3 extends no credit to n2.
+            self.assertEquals(compact.edge_capacity(e), 0)
+
+class BulkGraphTest(SimpleMultiHopTest):
+    def _orm_edges(self, ignore_balances):
+        edges = []
+        for creditline in CreditLine.objects.all():
+            chunks = flow.creditline_chunks(creditline, ignore_balances)
+            for key, (capacity, weight) in enumerate(chunks):
+                edges.append((creditline.node.alias, creditline.partner.alias,
+                              key, capacity, weight, creditline.id))
+        return sorted(edges)
+
+    def test_matches_orm(self):
+        self._payment(self.n1, self.n3, D('2.5'), succeed=True)
+        self._set_limit(self.cl32, None)
+        for ignore_balances in (False, True):
+            self.assertEquals(
+                sorted(flow.iter_creditline_edges(ignore_balances)),
+                self._orm_edges(ignore_balances))
+
+    def test_load_creditlines(self):
+        with self.assertNumQueries(2, using='ripple'):
+            creditline, = flow.load_creditlines(
+                CreditLine.objects.filter(pk=self.cl12.id))
+        with self.assertNumQueries(0, using='ripple'):
+            self.assertEquals(
+                (creditline.node.alias, creditline.partner.alias,
+                 creditline.balance), (1, 2, D('0')))
+        with self.assertNumQueries(1, using='ripple'):
+            creditlines = flow.load_creditlines(
+                CreditLine.objects.filter(account=self.a12))
+        with self.assertNumQueries(0, using='ripple'):
+            self.assertEquals(sorted(
+                    (cl.node.alias, cl.partner.alias) for cl in creditlines),
+                              [(1, 2), (2, 1)])
+
+    def test_cached_update_queries(self):
+        "Updating cached graphs loads all credit lines in one query."
+        for ignore_balances in (False, True):
+            get_graph(self.n1, ignore_balances)
+        self._payment(self.n1, self.n3, 3, succeed=True)
+        creditlines = list(CreditLine.objects.all())
+        with self.assertNumQueries(1, using='ripple'):
+            flow.update_creditlines_in_cached_graphs(creditlines)
+        self.assertEquals(
+            sorted(get_cached_graph(False).edges(keys=True, data=True)),
+            sorted(build_graph(False).edges(keys=True, data=True)))
+
+    def test_matches_incremental_updates(self):
+        get_graph(self.n1, ignore_balances=False)
+        self._payment(self.n1, self.n3, 3, succeed=True)
+        self._payment(self.n3, self.n2, 1, succeed=True)
+        self.assertEquals(
+            sorted(get_cached_graph(False).edges(keys=True, data=True)),
+            sorted(build_graph(False).edges(keys=True, data=True)))
+
 class RandomMultiHopPaymentTest(RippleTest):
     multi_db = True
 
@@ -161,7 +1047,20 @@ class RandomMultiHopPaymentTest(RippleTest):
             self._pay_between_aliases(payer_alias, recipient_alias, amount)
     
         
+@override_settings(PAYMENT_FLOW_BACKEND='capacity_scaling')
+class CapacityScalingPaymentTest(SimpleMultiHopPaymentTest):
+    pass
+
+@override_settings(PAYMENT_FLOW_BACKEND='network_simplex')
+class NetworkSimplexPaymentTest(SimpleMultiHopPaymentTest):
+    pass
+
 class MinCostFlowTest(TestCase):
+    method = 'bellman_ford'
+
+    def min_cost_flow(self, G):
+        return min_cost_flow(G, method=self.method)
+
     def test_one_edge(self):
         G = nx.DiGraph()
         nodes = [(1, {'demand': -1}),
@@ -174,7 +1073,7 @@ class MinCostFlowTest(TestCase):
         G.add_nodes_from(nodes)
         G.add_edges_from(edges)
 
-        cost, flow_dict = min_cost_flow(G)
+        cost, flow_dict = self.min_cost_flow(G)
         self.assertEquals(cost, 3)
         self.assertEquals(flow_dict, {1: {2: {0: 1}}, 2: {}})
 
@@ -186,7 +1085,7 @@ class MinCostFlowTest(TestCase):
         G.add_edge('a', 'c', weight=6, capacity=10)
         G.add_edge('b', 'd', weight=1, capacity=9)
         G.add_edge('c', 'd', weight=2, capacity=5)
-        cost, flow_dict = min_cost_flow(G)
+        cost, flow_dict = self.min_cost_flow(G)
         soln = {'a': {'b': {0: 4}, 'c': {0: 1}},
                 'b': {'d': {0: 4}},
                 'c': {'d': {0: 1}},
@@ -204,7 +1103,7 @@ class MinCostFlowTest(TestCase):
         G.add_edge('b', 'd', weight = 1)
         G.add_edge('d', 'c', weight = -2)
         G.add_edge('d', 't', weight = 1, capacity = 3)
-        self.assertRaises(nx.NetworkXUnbounded, min_cost_flow, G)
+        self.assertRaises(nx.NetworkXUnbounded, self.min_cost_flow, G)
 
     def test_sum_demands_not_zero(self):
         G = nx.DiGraph()
@@ -216,7 +1115,7 @@ class MinCostFlowTest(TestCase):
         G.add_edge('b', 'd', weight = 1)
         G.add_edge('c', 'd', weight = -2)
         G.add_edge('d', 't', weight = 1, capacity = 3)
-        self.assertRaises(nx.NetworkXUnfeasible, min_cost_flow, G)
+        self.assertRaises(nx.NetworkXUnfeasible, self.min_cost_flow, G)
 
     def test_no_flow_satisfying_demands(self):
         G = nx.DiGraph()
@@ -255,7 +1154,7 @@ class MinCostFlowTest(TestCase):
         G.add_edge('g', 'd', weight = 12)
         G.add_edge('f', 'g', weight = -1)
         G.add_edge('h', 'g', weight = -10)
-        flowCost, H = min_cost_flow(G)
+        flowCost, H = self.min_cost_flow(G)
         soln = {'a': {'c': {0: 0}},
                 'b': {'a': {0: 0}, 'r': {0: 2}},
                 'c': {'d': {0: 3}},
@@ -284,7 +1183,7 @@ class MinCostFlowTest(TestCase):
                           (3, 5, {'capacity': 5, 'weight': 3}),
                           (4, 5, {'weight': 2}),
                           (5, 3, {'capacity': 4, 'weight': 1})])
-        flowCost, H = min_cost_flow(G)
+        flowCost, H = self.min_cost_flow(G)
         soln = {1: {2: {0:12}, 3: {0:8}},
                 2: {3: {0:8}, 4: {0:4}, 5: {0:0}},
                 3: {4: {0:11}, 5: {0:5}},
@@ -306,7 +1205,7 @@ class MinCostFlowTest(TestCase):
                  ]
         G.add_nodes_from(nodes)
         G.add_edges_from(edges)
-        flow_cost, flow_dict = min_cost_flow(G)
+        flow_cost, flow_dict = self.min_cost_flow(G)
         soln = {1: {2: {0: 0}},
                 2: {1: {0: 0}, 3: {0: 4}},
                 3: {2: {0: 0}}}
@@ -323,7 +1222,7 @@ class MinCostFlowTest(TestCase):
                  ]
         G.add_nodes_from(nodes)
         G.add_edges_from(edges)
-        flow_cost, flow_dict = min_cost_flow(G)
+        flow_cost, flow_dict = self.min_cost_flow(G)
         soln = {1: {2: {0: 1, 1: 1}},
                 2: {}}
         self.assertEquals(flow_dict, soln)
@@ -350,7 +1249,7 @@ class MinCostFlowTest(TestCase):
 
         cost, flow_dict, exception = None, None, None
         try:
-            cost, flow_dict = min_cost_flow(G)
+            cost, flow_dict = self.min_cost_flow(G)
         except nx.NetworkXException as e:
             exception = e
 
@@ -363,4 +1262,308 @@ class MinCostFlowTest(TestCase):
         else:
             self.assertEquals(cost, cost2)
             self.assertEquals(exception, None)
-        
+
+class DijkstraMinCostFlowTest(MinCostFlowTest):
+    method = 'dijkstra'
+
+    def test_methods_agree(self):
+        random.seed(3)
+        for i in range(20):
+            G = nx.MultiDiGraph()
+            G.add_edges_from(generate_edges(range(1, 15), 60, min_weight=-3))
+            source, target = random.sample(G.nodes(), 2)
+            amount = random.randint(1, 10)
+            G.node[source]['demand'] = -amount
+            G.node[target]['demand'] = amount
+            results = []
+            for method in ('bellman_ford', 'dijkstra'):
+                try:
+                    results.append(min_cost_flow(G, method=method)[0])
+                except nx.NetworkXException as e:
+                    results.append(type(e))
+            self.assertEquals(results[0], results[1])
+
+    def test_unknown_method(self):
+        G = nx.MultiDiGraph()
+        G.add_edge(1, 2, capacity=1, weight=1)
+        self.assertRaises(ValueError, min_cost_flow, G, method='foo')
+
+class CapacityScalingMinCostFlowTest(MinCostFlowTest):
+    def min_cost_flow(self, G):
+        return capacity_scaling_min_cost_flow(G)
+
+    def test_large_amount(self):
+        G = nx.MultiDiGraph()
+        G.add_node(1, demand=-1000000)
+        G.add_node(3, demand=1000000)
+        G.add_edge(1, 2, capacity=999999, weight=1)
+        G.add_edge(1, 2, capacity=5, weight=0)
+        G.add_edge(1, 3, capacity=2, weight=5)
+        G.add_edge(2, 3, weight=1)
+        cost, flow_dict = self.min_cost_flow(G)
+        self.assertEquals(flow_dict[1][2], {0: 999995, 1: 5})
+        self.assertEquals(flow_dict[1][3], {0: 0})
+        self.assertEquals(cost, 999995 * 2 + 5)
+
+class SolverBackendTest(TestCase):
+    def test_backends_agree(self):
+        random.seed(5)
+        for i in range(20):
+            G = nx.MultiDiGraph()
+            G.add_edges_from(generate_edges(range(1, 12), 40))
+            source, target = random.sample(G.nodes(), 2)
+            amount = random.randint(1, 20)
+            G.node[source]['demand'] = -amount
+            G.node[target]['demand'] = amount
+            results = set()
+            for name, solve in solvers.BACKENDS.items():
+                try:
+                    results.add(solve(G)[0])
+                except nx.NetworkXUnfeasible:
+                    results.add(None)
+            self.assertEquals(len(results), 1)
+
+    def test_sparse(self):
+        """
+        Sparse results are nonzero flows making up a min cost flow.  Ties
+        between equally cheap flows are broken differently from one solve
+        to the next, so the flows themselves aren't compared.
+        """
+        random.seed(7)
+        for i in range(20):
+            G = nx.MultiDiGraph()
+            G.add_edges_from(generate_edges(range(1, 12), 40))
+            source, target = random.sample(G.nodes(), 2)
+            G.node[source]['demand'] = -5
+            G.node[target]['demand'] = 5
+            for solve in (min_cost_flow, capacity_scaling_min_cost_flow):
+                try:
+                    cost, _ = solve(G)
+                except nx.NetworkXUnfeasible:
+                    continue
+                sparse_cost, edge_flows = solve(G, sparse=True)
+                self.assertEquals(sparse_cost, cost)
+                inflow = dict((node, 0) for node in G)
+                flow_cost = 0
+                for (u, v, key), edge_flow in edge_flows.iteritems():
+                    data = G[u][v][key]
+                    self.failUnless(
+                        0 < edge_flow <= data.get('capacity', edge_flow))
+                    flow_cost += edge_flow * data['weight']
+                    inflow[u] -= edge_flow
+                    inflow[v] += edge_flow
+                self.assertEquals(flow_cost, cost)
+                self.assertEquals(inflow, dict(
+                        (node, G.node[node].get('demand', 0)) for node in G))
+
+    def test_get_backend(self):
+        self.assertEquals(solvers.get_backend('network_simplex'),
+                          solvers.network_simplex)
+        with self.settings(PAYMENT_FLOW_BACKEND='capacity_scaling'):
+            self.assertEquals(solvers.get_backend(),
+                              solvers.capacity_scaling)
+        self.assertRaises(ValueError, solvers.get_backend, 'foo')
+
+class MinCostFlowSessionTest(TestCase):
+    def _solve(self, G, source, target, amount):
+        H = G.copy()
+        H.node[source]['demand'] = -amount
+        H.node[target]['demand'] = amount
+        try:
+            return min_cost_flow(H, method='dijkstra', sparse=True)[0]
+        except nx.NetworkXUnfeasible:
+            return None
+
+    def test_agrees_with_min_cost_flow(self):
+        random.seed(11)
+        for i in range(10):
+            G = nx.MultiDiGraph()
+            G.add_edges_from(generate_edges(range(1, 15), 50))
+            session = MinCostFlowSession(G)
+            for j in range(5):
+                source, target = random.sample(G.nodes(), 2)
+                amount = random.randint(1, 20)
+                try:
+                    cost = session.solve(source, target, amount)[0]
+                except (nx.NetworkXNoPath, nx.NetworkXUnfeasible):
+                    cost = None
+                self.assertEquals(cost,
+                                  self._solve(G, source, target, amount))
+
+    def test_update_edges(self):
+        G = nx.MultiDiGraph()
+        G.add_edge(1, 2, capacity=5, weight=1)
+        G.add_edge(2, 3, capacity=5, weight=1)
+        session = MinCostFlowSession(G)
+        self.assertEquals(session.solve(1, 3, 5), (10, {(1, 2, 0): 5,
+                                                        (2, 3, 0): 5}))
+        self.assertRaises(nx.NetworkXUnfeasible, session.solve, 1, 3, 6)
+        G.add_edge(1, 3, weight=3)
+        G.add_edge(3, 4, capacity=1, weight=0)
+        G[1][2][0]['capacity'] = 0
+        session.update_edges([(1, 3), (3, 4), (1, 2)])
+        self.assertEquals(session.solve(1, 4, 1), (3, {(1, 3, 0): 1,
+                                                       (3, 4, 0): 1}))
+        self.assertRaises(nx.NetworkXNoPath, session.solve, 1, 2, 1)
+
+class MaxFlowTest(TestCase):
+    def test_multi(self):
+        G = nx.MultiDiGraph()
+        G.add_edge(1, 2, capacity=3)
+        G.add_edge(1, 2, capacity=4)
+        G.add_edge(2, 3, capacity=5)
+        G.add_edge(1, 3, capacity=1)
+        G.add_edge(3, 1, capacity=8)
+        self.assertEquals(max_flow(G, 1, 3), 6)
+        self.assertEquals(max_flow(G, 3, 2), 7)
+
+    def test_infinite(self):
+        G = nx.MultiDiGraph()
+        G.add_edge(1, 2)
+        G.add_edge(2, 3, capacity=2)
+        G.add_edge(2, 3, capacity=3)
+        self.assertEquals(max_flow(G, 1, 3), 5)
+        G.add_edge(2, 3)
+        self.assertRaises(nx.NetworkXUnbounded, max_flow, G, 1, 3)
+
+    def test_no_path(self):
+        G = nx.MultiDiGraph()
+        G.add_edge(1, 2, capacity=3)
+        G.add_edge(3, 2, capacity=3)
+        self.assertEquals(max_flow(G, 1, 3), 0)
+
+    def test_random(self):
+        random.seed(7)
+        for i in range(20):
+            G = nx.MultiDiGraph()
+            G.add_edges_from(generate_edges(range(1, 20), 80))
+            source, target = random.sample(G.nodes(), 2)
+            self.assertEquals(max_flow(G, source, target),
+                              nx.max_flow(unmulti(G), source, target))
+
+    def test_cut(self):
+        G = nx.MultiDiGraph()
+        G.add_edge(1, 2, capacity=3)
+        G.add_edge(2, 3, capacity=1)
+        G.add_edge(1, 4, capacity=1)
+        G.add_edge(4, 3, capacity=5)
+        G.add_edge(3, 5, capacity=5)
+        flow, source_side, flow_nodes = max_flow_cut(G, 1, 3)
+        self.assertEquals(flow, 2)
+        self.assertEquals(source_side, set([1, 2]))
+        self.assertEquals(flow_nodes, set([1, 2, 4]))
+
+class CompactMaxFlowTest(TestCase):
+    def _max_flow(self, G, source, sink, nodes=None):
+        compact = CompactGraph.from_graph(G)
+        index = compact.node_index
+        if nodes is not None:
+            nodes = set(index[node] for node in nodes)
+        return compact_max_flow(compact, index[source], index[sink], nodes)
+
+    def test_multi(self):
+        G = nx.MultiDiGraph()
+        G.add_edge(1, 2, capacity=3, weight=0)
+        G.add_edge(1, 2, capacity=4, weight=0)
+        G.add_edge(2, 3, capacity=5, weight=0)
+        G.add_edge(1, 3, capacity=1, weight=0)
+        G.add_edge(3, 1, capacity=8, weight=0)
+        self.assertEquals(self._max_flow(G, 1, 3), 6)
+        self.assertEquals(self._max_flow(G, 3, 2), 7)
+        self.assertEquals(self._max_flow(G, 1, 3, nodes=[1, 3]), 1)
+
+    def test_infinite(self):
+        G = nx.MultiDiGraph()
+        G.add_edge(1, 2, weight=0)
+        G.add_edge(2, 3, capacity=2, weight=0)
+        G.add_edge(2, 3, capacity=3, weight=0)
+        self.assertEquals(self._max_flow(G, 1, 3), 5)
+        G.add_edge(2, 3, weight=0)
+        self.assertRaises(nx.NetworkXUnbounded, self._max_flow, G, 1, 3)
+
+    def test_random(self):
+        random.seed(7)
+        for i in range(20):
+            G = nx.MultiDiGraph()
+            G.add_edges_from(generate_edges(range(1, 20), 80))
+            source, target = random.sample(G.nodes(), 2)
+            self.assertEquals(self._max_flow(G, source, target),
+                              max_flow(G, source, target))
+
+class MaxFlowDependenciesTest(TestCase):
+    def test_random(self):
+        "Changing credit lines of other nodes doesn't change max flow."
+        random.seed(5)
+        for i in range(20):
+            G = nx.MultiDiGraph()
+            G.add_edges_from(generate_edges(range(1, 20), 60))
+            source, target = random.sample(G.nodes(), 2)
+            amount, dependencies = flow.max_flow_dependencies(
+                G, source, target)
+            for u, v, data in G.edges_iter(data=True):
+                if u not in dependencies:
+                    data['capacity'] = random.choice([0, 100])
+            self.assertEquals(
+                flow.max_flow_dependencies(G, source, target)[0], amount)
+
+class BenchmarkTest(TestCase):
+    def test_generate_creditlines(self):
+        random.seed(3)
+        rows = generate_creditlines(2000)
+        ids = [row[0] for row in rows]
+        self.assertEquals(len(ids), len(set(ids)))
+        self.assertTrue(any(row[4] is None for row in rows))
+        self.assertTrue(any(row[3] != 0 for row in rows))
+        for creditline_id, src, dest, balance, limit in rows:
+            self.assertNotEquals(src, dest)
+            if limit is not None:
+                self.assertTrue(balance >= -limit)
+
+    def test_run(self):
+        backends = ['successive_shortest_path', 'capacity_scaling']
+        cache.clear()
+        results = benchmark.run(sizes=[300], pairs=3, backends=backends)
+        result = results['300']
+        self.assertEquals(result['cache_ok'], 1)
+        # The live cached graph is left alone, and the benchmark's removed.
+        self.assertEquals(get_cached_component_index(False), None)
+        self.assertEquals(get_cached_component_index(False, get_cache(
+                    'default', KEY_PREFIX=benchmark.CACHE_KEY_PREFIX)), None)
+        self.assertTrue(result['pairs'] > 0)
+        for backend in backends:
+            self.assertTrue('min_cost_flow_%s_ms' % backend in result)
+        self.assertEquals(benchmark.compare(results, results), [])
+
+    def test_compare(self):
+        baseline = {'1000': {'max_flow_ms': 100, 'build_graph_ms': 100,
+                             'edges': 10},
+                    '10000': {'max_flow_ms': 1000}}
+        results = {'1000': {'max_flow_ms': 200, 'build_graph_ms': 110,
+                            'edges': 20}}
+        self.assertEquals(benchmark.compare(results, baseline),
+                          [('1000', 'max_flow_ms', 100, 200)])
+        del results['1000']['build_graph_ms']
+        self.assertEquals(
+            benchmark.compare(results, baseline, tolerance=1),
+            [('1000', 'build_graph_ms', 100, None)])
+
+class NodeVersionTest(SimpleMultiHopTest):
+    def test_bump(self):
+        get_graph(self.n1, ignore_balances=True)
+        aliases = [self.n1.alias, self.n2.alias]
+        versions = flow.get_node_versions(aliases, ignore_balances=True)
+        self._set_limit(self.cl12, D('3'))
+        new_versions = flow.get_node_versions(aliases, ignore_balances=True)
+        self.assertNotEquals(new_versions[self.n1.alias],
+                             versions[self.n1.alias])
+        self.assertEquals(new_versions[self.n2.alias],
+                          versions[self.n2.alias])
+
+    def test_balance_change(self):
+        "Payments don't change reputation graph node versions."
+        get_graph(self.n1, ignore_balances=True)
+        aliases = [self.n1.alias, self.n2.alias]
+        versions = flow.get_node_versions(aliases, ignore_balances=True)
+        self._payment(self.n1, self.n3, 1, succeed=True)
+        self.assertEquals(
+            flow.get_node_versions(aliases, ignore_balances=True), versions)
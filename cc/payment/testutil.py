@@ -23,3 +23,65 @@ def generate_edges(nodes, n_edges, max_cap=10, min_weight=0, max_weight=10,
                         'weight': random.randint(min_weight, max_weight)}))
     return edges
 
+
+def generate_creditlines(n_creditlines, community_size=100, p_outside=0.05,
+                         p_preferential=0.8, p_unlimited=0.02, p_balance=0.5,
+                         max_limit=1000, scale=100):
+    """
+    Generates a mutual credit network shaped like a real one, as
+    (creditline_id, src, dest, balance, limit) rows like the ones
+    CREDITLINE_EDGES_SQL returns, with balance and limit scaled by scale,
+    and limit None for no limit.  Credit lines come in account pairs, so
+    about n_creditlines are generated.
+
+    Nodes are integer aliases, in communities of community_size nodes with
+    about six credit lines per node.  A fraction p_outside of accounts are
+    with a partner in another community.  Partners are mostly picked in
+    proportion to how many accounts they already have, so a few nodes
+    end up with many accounts.  A fraction p_unlimited of credit lines have
+    no limit, and a fraction p_balance of accounts have a nonzero balance
+    within their limits.
+    """
+    n_accounts = max(1, n_creditlines // 2)
+    n_nodes = max(2, n_accounts // 3)
+    community_size = min(community_size, n_nodes)
+    n_communities = -(-n_nodes // community_size)  # Rounded up.
+    # Each community's nodes once, plus once more per account they have,
+    # for preferential picks.
+    endpoints = [range(c * community_size, (c + 1) * community_size)
+                 for c in xrange(n_communities)]
+    pairs = set()
+    rows = []
+    creditline_id = 1
+    for i in xrange(n_accounts):
+        u = random.randrange(n_communities * community_size)
+        community = u // community_size
+        if n_communities > 1 and random.random() < p_outside:
+            community = ((community + random.randint(1, n_communities - 1))
+                         % n_communities)
+        for attempt in xrange(10):
+            if random.random() < p_preferential:
+                v = random.choice(endpoints[community])
+            else:
+                v = (community * community_size +
+                     random.randrange(community_size))
+            if v != u and (u, v) not in pairs:
+                break
+        else:
+            continue
+        pairs.add((u, v))
+        pairs.add((v, u))
+        endpoints[u // community_size].append(u)
+        endpoints[community].append(v)
+        limits = [None if random.random() < p_unlimited
+                  else random.randint(0, max_limit) * scale
+                  for side in (u, v)]
+        balance = 0
+        if random.random() < p_balance:
+            low, high = [max_limit * scale if limit is None else limit
+                         for limit in limits]
+            balance = random.randint(-low, high)
+        rows.append((creditline_id, u + 1, v + 1, balance, limits[0]))
+        rows.append((creditline_id + 1, v + 1, u + 1, -balance, limits[1]))
+        creditline_id += 2
+    return rows
@@ -0,0 +1,58 @@
+"""
+Worker that performs queued routed payments.
+
+With the PAYMENT_QUEUE setting on, cc.ripple.api.pay only records routed
+payments as pending, and a single bin/process_payments.py process performs
+them one at a time, over a payment flow graph it keeps in memory.  Since
+payments are routed and posted serially in one place, they never collide
+with each other, and all flow graph updates come from that process.  The
+graph is kept prepared in a SolverSession, so routing a payment doesn't
+copy or revalidate it.
+
+The worker also applies the credit line change journal to the cached graphs,
+so it needs FLOW_GRAPH_JOURNAL on, and replaces bin/update_cached_graphs.py.
+Balance changes from direct (unrouted) payments, which web requests still
+post themselves, reach its session through the journal too.
+"""
+
+import logging
+
+from django.core.exceptions import ImproperlyConfigured
+from django.db import transaction
+
+from cc.payment.flow import (
+    SolverSession, build_graph, apply_journal, using_journal)
+from cc.payment.models import Payment
+
+logger = logging.getLogger('cc.payment.worker')
+
+class PaymentWorker(object):
+    def __init__(self):
+        if not using_journal():
+            # Without the journal, credit line changes made elsewhere would
+            # never reach the session.
+            raise ImproperlyConfigured(
+                "The payment worker requires FLOW_GRAPH_JOURNAL.")
+        self.session = SolverSession(build_graph(ignore_balances=False))
+
+    def run_once(self, batch_size=100, journal_batch_size=1000):
+        """
+        Applies journalled credit line changes, then performs up to
+        batch_size queued payments, oldest first.  Returns the number of
+        payments performed.
+
+        A payment that fails with an unexpected error is left marked
+        failed, and the error is logged, so it doesn't stop the worker.
+        """
+        apply_journal(journal_batch_size, session=self.session)
+        count = 0
+        for payment in Payment.objects.queued()[:batch_size]:
+            if Payment.objects.claim(payment):
+                try:
+                    payment.attempt(session=self.session)
+                except Exception:
+                    logger.exception("Error performing payment %s.",
+                                     payment.id)
+                    transaction.rollback_unless_managed(using='ripple')
+                count += 1
+        return count
@@ -68,6 +68,7 @@ class AcknowledgementForm(forms.Form):
 	label=_("Testimonial"),
 	required=False,
 	widget=forms.Textarea)
+    quote = forms.CharField(required=False, widget=forms.HiddenInput)
     
     ERRORS = {
         'max_ripple': _("This is higher than the maximum possible routed "
@@ -76,6 +77,7 @@ class AcknowledgementForm(forms.Form):
     
     def __init__(self, *args, **kwargs):
         self.max_ripple = kwargs.pop('max_ripple')
+        self.payment_quote = kwargs.pop('payment_quote', None)
         super(AcknowledgementForm, self).__init__(*args, **kwargs)
         if self.max_ripple == 0:
             del self.fields['ripple']
@@ -93,7 +95,8 @@ class AcknowledgementForm(forms.Form):
         data = self.cleaned_data
         routed = data.get('ripple') == ROUTED
         obj = ripple.pay(
-            payer, recipient, data['amount'], data['memo'], routed=routed)
+            payer, recipient, data['amount'], data['memo'], routed=routed,
+            quote=self.payment_quote)
         # Create feed item
         FeedItem.create_feed_items(
             sender=ripple.RipplePayment, instance=obj, created=True)
@@ -5,9 +5,34 @@ import cc.ripple.api as ripple
 
 register = template.Library()
 
-@register.simple_tag
-def reputation(profile, asker):
-    return profile.reputation(asker)
+# Context variable holding reputations preloaded by load_reputations.
+REPUTATIONS_CONTEXT_VAR = '_reputations'
+
+@register.simple_tag(takes_context=True)
+def reputation(context, profile, asker):
+    reputations = context.get(REPUTATIONS_CONTEXT_VAR, {})
+    try:
+        return reputations[(profile.id, asker.id)]
+    except KeyError:
+        return profile.reputation(asker)
+
+@register.simple_tag(takes_context=True)
+def load_reputations(context, profiles, asker):
+    """
+    Computes reputations of many profiles from asker's point of view in one
+    batch, so later reputation tags for those profiles don't compute them
+    one by one.  Use before looping over a list of profiles.
+
+    Example:
+    {% load_reputations profiles request.profile %}
+    """
+    profiles = list(profiles)
+    reputations = context.get(REPUTATIONS_CONTEXT_VAR, {})
+    for profile_id, val in ripple.credit_reputation_many(
+            profiles, asker).items():
+        reputations[(profile_id, asker.id)] = val
+    context[REPUTATIONS_CONTEXT_VAR] = reputations
+    return ''
 
 @register.tag
 def load_user_account(parser, token):
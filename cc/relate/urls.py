@@ -22,4 +22,6 @@ urlpatterns = patterns(
         name='acknowledgements'),
     url(r'^acknowledgements/(\d+)/$', 'view_acknowledgement',
         name='view_acknowledgement'),
+    url(r'^acknowledgements/(\d+)/status/$', 'acknowledgement_status',
+        name='acknowledgement_status'),
 )
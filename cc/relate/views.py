@@ -1,6 +1,8 @@
+import json
+
 from django.contrib.auth.decorators import login_required
 from django.shortcuts import get_object_or_404
-from django.http import HttpResponseRedirect, Http404
+from django.http import HttpResponse, HttpResponseRedirect, Http404
 from django.db.models import Q
 from django.contrib import messages
 
@@ -91,11 +93,18 @@ def acknowledge_user(request, recipient_username):
     recipient = get_object_or_404(Profile, user__username=recipient_username)
     if recipient == request.profile:
         raise Http404
-    # TODO: Don't recompute max_amount on form submit?  Cache, or put in form
-    # as hidden field?
-    max_amount = ripple.max_payment(request.profile, recipient)
+    # Reuse the max amount quoted when the form was shown, if the flow
+    # graph hasn't changed since.
+    quote = None
+    if request.method == 'POST':
+        quote = ripple.get_quote(
+            request.profile, recipient, request.POST.get('quote'))
+    if quote is None:
+        quote = ripple.quote_payment(request.profile, recipient)
+    max_amount = quote.max_amount
     if request.method == 'POST':
-        form = AcknowledgementForm(request.POST, max_ripple=max_amount)
+        form = AcknowledgementForm(request.POST, max_ripple=max_amount,
+                                   payment_quote=quote)
         if form.is_valid():
             acknowledgement = form.send_acknowledgement(
                 request.profile, recipient)
@@ -103,7 +112,9 @@ def acknowledge_user(request, recipient_username):
             messages.info(request, MESSAGES['acknowledgement_sent'])
             return HttpResponseRedirect(acknowledgement.get_absolute_url())
     else:
-        form = AcknowledgementForm(max_ripple=max_amount, initial=request.GET)
+        initial = request.GET.copy()
+        initial['quote'] = quote.token
+        form = AcknowledgementForm(max_ripple=max_amount, initial=initial)
     can_ripple = max_amount > 0
     profile = recipient  # For profile_base.html.
     return locals()
@@ -123,7 +134,9 @@ def view_acknowledgement(request, payment_id):
     except ripple.RipplePayment.DoesNotExist:
         raise Http404
     entries = payment.entries_for_user(request.profile)
-    if not entries:
+    if not entries and not (
+            payment.status == 'pending' and
+            request.profile in (payment.payer, payment.recipient)):
         raise Http404  # Non-participants don't get to see anything.
     sent_entries = []
     received_entries = []
@@ -133,3 +146,18 @@ def view_acknowledgement(request, payment_id):
         else:
             received_entries.append(entry)
     return locals()
+
+@login_required
+def acknowledgement_status(request, payment_id):
+    """
+    Returns JSON {"status": "pending" | "completed" | "failed"}, for polling
+    queued acknowledgements.  Only payer and recipient can see it.
+    """
+    try:
+        payment = ripple.get_payment(payment_id)
+    except ripple.RipplePayment.DoesNotExist:
+        raise Http404
+    if request.profile not in (payment.payer, payment.recipient):
+        raise Http404
+    return HttpResponse(json.dumps({'status': payment.status}),
+                        mimetype='application/json')
@@ -5,17 +5,20 @@
 # TODO: Don't use 'user' when I really mean 'profile' (here and everywhere).
 # TODO: Test transaction handling here, think more deeply about it.
 
+from datetime import datetime
+import uuid
+
+from django.conf import settings
 from django.core.exceptions import ObjectDoesNotExist
 from django.core.cache import cache
 from django.db import models, transaction
 
-from cc.account.models import CreditLine, Account, Node
-from cc.payment.flow import FlowGraph, PaymentError
-from cc.payment.models import Payment
+from cc.account.models import CreditLine, Account, Node, NodeBalance
+from cc.payment.flow import (
+    FlowGraph, PaymentError, max_flows, graph_version, get_node_versions)
+from cc.payment.models import Payment, Reputation
 from cc.general.util import cache_on_object
 
-REPUTATION_VERSION_KEY = 'credit_reputation_version'
-
 class UserAccount(object):
     "Wrapper around CreditLine."
     def __init__(self, creditline, user):
@@ -156,7 +159,7 @@ class RipplePayment(object):
 
     def __getattr__(self, name):
         "Proxy attribute lookups to self.payment."
-        if name in ('id', 'amount', 'memo'):
+        if name in ('id', 'amount', 'memo', 'status'):
             return getattr(self.payment, name)
         raise AttributeError("%s does not have attribute '%s'." % (
                 self.__class__, name))
@@ -225,6 +228,29 @@ class RipplePayment(object):
     def get_all(cls):
         return (cls(pmt) for pmt in Payment.objects.iterator())
 
+class PaymentQuote(object):
+    """
+    Max routed payment amount from payer to recipient, and optionally a
+    pre-solved route for a given amount, stored in the cache under a
+    short-lived token.  Only valid while the flow graph version is
+    unchanged.
+    """
+    def __init__(self, payer, recipient, graph_version, max_amount,
+                 amount=None, route=None):
+        self.token = uuid.uuid4().hex
+        self.payer_id = payer.alias
+        self.recipient_id = recipient.alias
+        self.graph_version = graph_version
+        self.max_amount = max_amount
+        self.amount = amount
+        self.route = route
+
+    def route_for(self, amount):
+        "Pre-solved route for amount, or None."
+        if self.route is not None and amount == self.amount:
+            return self.route
+        return None
+
 def get_nodes(profile1, profile2):
     node1, _ = Node.objects.get_or_create(alias=profile1.id)
     node2, _ = Node.objects.get_or_create(alias=profile2.id)
@@ -264,8 +290,6 @@ def update_credit_limit(endorsement):
         node__alias=endorsement.recipient_id, account=account)
     creditline.limit = endorsement.weight
     creditline.save()
-    
-    _invalidate_reputation_cache()
 
 @accept_profiles
 def get_or_create_account_from_profiles(node1, node2):
@@ -277,20 +301,102 @@ def max_payment(payer, recipient):
     return flow_graph.max_flow()
 
 @accept_profiles
-def pay(payer, recipient, amount, memo, routed):
+def quote_payment(payer, recipient, amount=None):
+    """
+    Returns a PaymentQuote with the max routed payment amount, and if amount
+    is given and payable, the route for it.  Pass the quote's token back to
+    get_quote to reuse it.
+    """
+    # Take graph version before computing, so changes during are caught.
+    version = graph_version()
+    flow_graph = FlowGraph(payer, recipient)
+    quote = PaymentQuote(
+        payer, recipient, version, flow_graph.max_flow(), amount)
+    if amount is not None and amount <= quote.max_amount:
+        try:
+            quote.route = flow_graph.min_cost_flow(amount)
+        except PaymentError:
+            pass
+    cache.set(_quote_cache_key(quote.token), quote,
+              getattr(settings, 'PAYMENT_QUOTE_TIMEOUT', 300))
+    return quote
+
+@accept_profiles
+def get_quote(payer, recipient, token):
+    """
+    Returns the PaymentQuote for token, or None if it has expired, the flow
+    graph has changed since, or it was for a different payer or recipient.
+    """
+    if not token:
+        return None
+    quote = cache.get(_quote_cache_key(token))
+    if (quote is None or quote.payer_id != payer.alias or
+            quote.recipient_id != recipient.alias or
+            quote.graph_version != graph_version()):
+        return None
+    return quote
+
+@accept_profiles
+def pay(payer, recipient, amount, memo, routed, quote=None):
     """
     Performs payment.  Routed=False just creates an entry on account between
     payer and recipient, and creates the account with limits=0 if it does not
     already exist.
+
+    If a quote from get_quote is given with a route for amount, that route is
+    used instead of computing one.
+
+    If the PAYMENT_QUEUE setting is on, routed payments are only queued as
+    pending, to be performed by bin/process_payments.py.  Use
+    payment_status to see when they are done.
     """
+    if routed and getattr(settings, 'PAYMENT_QUEUE', False):
+        payment = Payment.objects.create(
+            payer=payer, recipient=recipient, amount=amount, memo=memo)
+        return RipplePayment(payment)
+    # Set attempt date right away so the payment worker won't take it.
     payment = Payment.objects.create(
-        payer=payer, recipient=recipient, amount=amount, memo=memo)
+        payer=payer, recipient=recipient, amount=amount, memo=memo,
+        last_attempted_at=datetime.now())
     if routed:
-        payment.attempt()
+        payment.attempt(flow_links=quote and quote.route_for(amount))
     else:
         payment.as_entry()
     return RipplePayment(payment)
 
+def pay_many(payer, payments, memo):
+    """
+    Performs routed payments from payer profile to several recipients at
+    once, such as an organization paying its members.  payments is a list of
+    (recipient profile, amount), with distinct recipients other than payer.
+    Returns a list of RipplePayments in the same order.
+
+    All payments are routed with one min cost flow solve, and posted in one
+    transaction, so either all of them complete or all fail.  They are
+    performed right away, even with the PAYMENT_QUEUE setting on.  If payer
+    can't pay all recipients at once, the payments are saved as failed and
+    InsufficientMultiCreditError is raised; its max_amounts is a dict of
+    recipient profile ID: max amount payer could pay that recipient alone.
+    """
+    if not payments:
+        return []
+    recipient_ids = [recipient.id for recipient, _ in payments]
+    if len(set(recipient_ids)) != len(recipient_ids) or (
+            payer.id in recipient_ids):
+        raise ValueError("Recipients must be distinct, and not the payer.")
+    payer_node, _ = Node.objects.get_or_create(alias=payer.id)
+    nodes = dict((node.alias, node) for node in _get_nodes_many(
+            [recipient for recipient, _ in payments]))
+    # Set attempt date right away so the payment worker won't take them.
+    now = datetime.now()
+    payment_objs = [
+        Payment.objects.create(
+            payer=payer_node, recipient=nodes[recipient.id], amount=amount,
+            memo=memo, last_attempted_at=now)
+        for recipient, amount in payments]
+    Payment.objects.attempt_many(payment_objs)
+    return [RipplePayment(payment) for payment in payment_objs]
+
 def get_payment(payment_id):
     try:
         payment = Payment.objects.get(pk=payment_id)
@@ -298,24 +404,81 @@ def get_payment(payment_id):
         raise RipplePayment.DoesNotExist
     return RipplePayment(payment)
 
-@accept_profiles
+def payment_status(payment_id):
+    """
+    Returns 'pending', 'completed' or 'failed' for payment, without loading
+    anything else.
+    """
+    try:
+        return Payment.objects.values_list(
+            'status', flat=True).get(pk=payment_id)
+    except Payment.DoesNotExist:
+        raise RipplePayment.DoesNotExist
+
 def credit_reputation(target, asker):
-    version = _reputation_cache_version()
-    key = 'credit_reputation(%s,%s)' % (repr(target), repr(asker))
-    val = cache.get(key, version=version)
-    if val is None:
-        flow_graph = FlowGraph(target, asker, ignore_balances=True)
-        val = flow_graph.max_flow()
-        cache.set(key, val, None, version=version)
-    return val
+    return credit_reputation_many([target], asker)[target.id]
+
+def credit_reputation_many(targets, asker, processes=None):
+    """
+    Returns dict of target profile ID: credit reputation from asker's point
+    of view, for many target profiles at once.  Reputations precomputed by
+    bin/precompute_reputations.py are used first.  Values already cached are
+    reused, the rest are computed from one load of the reputation graph
+    (across a pool of processes if given) and cached in one go.
+
+    Each precomputed or cached value records the nodes whose credit lines
+    it depends on (see cc.payment.flow.max_flow_dependencies), with their
+    versions, and is only reused while none of those nodes' credit lines
+    have changed.
+    """
+    asker_node, _ = Node.objects.get_or_create(alias=asker.id)
+    target_nodes = _get_nodes_many(targets)
+    stored = Reputation.objects.get_many(
+        [node.alias for node in target_nodes], asker_node.alias)
+    keys = dict((_reputation_cache_key(node, asker_node), node)
+                for node in target_nodes if node.alias not in stored)
+    entries = cache.get_many(keys.keys())
+    versions = _dependency_versions(stored.values() + entries.values(), {})
+    reputations = dict((alias, val)
+                       for alias, (val, dependencies) in stored.iteritems()
+                       if _up_to_date(dependencies, versions))
+    # Look for newer values of stale stored ones in the cache.
+    stale_keys = dict((_reputation_cache_key(node, asker_node), node)
+                      for node in target_nodes if node.alias in stored and
+                      node.alias not in reputations)
+    if stale_keys:
+        keys.update(stale_keys)
+        stale_entries = cache.get_many(stale_keys.keys())
+        versions = _dependency_versions(stale_entries.values(), versions)
+        entries.update(stale_entries)
+    for key, (val, dependencies) in entries.items():
+        if _up_to_date(dependencies, versions):
+            reputations[keys.pop(key).alias] = val
+    if keys:
+        reputations.update(_compute_reputations(keys, asker_node, processes))
+    return reputations
+
+def precompute_reputations(askers, processes=None):
+    """
+    Recomputes the stored reputations asker profiles have been shown, so
+    their profile page views don't compute any.  Returns the number of
+    reputations stored.
+    """
+    return Reputation.objects.precompute(
+        [asker.id for asker in askers], processes)
 
 def overall_balance(profile):
-    node, _ = Node.objects.get_or_create(alias=profile.id)
-    return node.overall_balance()
+    return balances_many([profile])[profile.id][0]
 
 def trusted_balance(profile):
-    node, _ = Node.objects.get_or_create(alias=profile.id)
-    return node.trusted_balance()
+    return balances_many([profile])[profile.id][1]
+
+def balances_many(profiles):
+    """
+    Returns dict of profile ID: (overall balance, trusted balance) for many
+    profiles, read from stored node balances in one query.
+    """
+    return NodeBalance.objects.get_many([profile.id for profile in profiles])
 
 def delete_node(profile):
     try:
@@ -326,10 +489,60 @@ def delete_node(profile):
 
 ##### Helpers #####
 
-def _reputation_cache_version():
-    return cache.get(REPUTATION_VERSION_KEY, 1)
+def _get_nodes_many(profiles):
+    "Get or create nodes for many profiles."
+    aliases = set(profile.id for profile in profiles)
+    nodes = list(Node.objects.filter(alias__in=aliases))
+    for alias in aliases - set(node.alias for node in nodes):
+        nodes.append(Node.objects.create(alias=alias))
+    return nodes
 
-def _invalidate_reputation_cache():
-    cache.add(REPUTATION_VERSION_KEY, 1)
-    cache.incr(REPUTATION_VERSION_KEY)
+def _dependency_versions(values, versions):
+    """
+    Returns versions, a dict of node alias: version, updated with the
+    current versions of the dependencies of (value, dependencies) values
+    not already in it.
+    """
+    versions = dict(versions)
+    versions.update(get_node_versions(
+            set(alias for _, dependencies in values
+                for alias in dependencies if alias not in versions),
+            ignore_balances=True))
+    return versions
+
+def _up_to_date(dependencies, versions):
+    return all(versions.get(alias) == version
+               for alias, version in dependencies.iteritems())
+
+def _quote_cache_key(token):
+    return 'payment_quote(%s)' % token
+
+def _compute_reputations(keys, asker, processes=None):
+    """
+    Computes, caches and stores reputations for dict of cache key: target
+    node.  Returns dict of target alias: reputation.
+    """
+    # Values computed while the graph changes may be stale, so aren't cached.
+    graph_version_before = graph_version()
+    missing = keys.items()
+    results = max_flows([node for key, node in missing], asker,
+                        ignore_balances=True, processes=processes,
+                        dependencies=True)
+    versions = get_node_versions(
+        set(alias for _, dependencies in results for alias in dependencies),
+        ignore_balances=True)
+    values = dict(
+        (node.alias, (val, dict((alias, versions[alias])
+                                for alias in dependencies)))
+        for (key, node), (val, dependencies) in zip(missing, results))
+    if graph_version() == graph_version_before:
+        cache.set_many(dict((key, values[node.alias])
+                            for key, node in missing), None)
+        # Stored too, so bin/precompute_reputations.py keeps the pairs
+        # that are shown up to date.
+        Reputation.objects.record(asker.alias, values)
+    return dict((alias, val) for alias, (val, _) in values.iteritems())
+
+def _reputation_cache_key(target, asker):
+    return 'reputation(%s,%s)' % (repr(target), repr(asker))
     
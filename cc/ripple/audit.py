@@ -1,12 +1,72 @@
 """
 Auditing functions.
+
+The *_check functions check accounts and payments one at a time through the
+ORM.  With bulk=True, they instead use account_mismatches and
+payment_mismatches, which check everything with a single grouped query each,
+for auditing the whole database.
+
+incremental_mismatches only checks what changed since its last run, so it
+can be run every few minutes as a continuous integrity monitor.
 """
+from datetime import datetime, timedelta
 from decimal import Decimal as D
 
-from django.db.models import Sum
+from django.conf import settings
+from django.db import connections, transaction
+from django.db.models import Sum, Max
 
 from cc.account.models import Account
-from cc.payment.models import Payment, Entry
+from cc.payment.models import Payment, Entry, AuditWatermark, AuditedBalance
+
+# Accounts whose balance isn't the sum of their entries.
+ACCOUNT_MISMATCHES_SQL = """
+select ac.id, ac.balance, coalesce(sum(e.amount), 0)
+from account_account as ac
+left join payment_entry as e on e.account_id = ac.id
+group by ac.id, ac.balance
+having ac.balance != coalesce(sum(e.amount), 0)
+order by ac.id
+"""
+
+# Each node's net amount from the entries of completed payments, where it
+# isn't -amount for the payer, amount for the recipient, or zero for
+# intermediaries.
+PAYMENT_MISMATCHES_TEMPLATE = """
+select p.id, cl.node_id, p.payer_id, p.recipient_id,
+	sum(e.amount * cl.bal_mult)
+from payment_payment as p
+join payment_entry as e on e.payment_id = p.id
+join account_creditline as cl on cl.account_id = e.account_id
+where p.status = 'completed'%s
+group by p.id, cl.node_id, p.payer_id, p.recipient_id, p.amount
+having sum(e.amount * cl.bal_mult) != case
+	when cl.node_id = p.payer_id then -p.amount
+	when cl.node_id = p.recipient_id then p.amount
+	else 0 end
+order by p.id, cl.node_id
+"""
+PAYMENT_MISMATCHES_SQL = PAYMENT_MISMATCHES_TEMPLATE % ''
+# Only payments with entries in an ID range, or attempted since a date.
+NEW_PAYMENT_MISMATCHES_SQL = PAYMENT_MISMATCHES_TEMPLATE % """
+and (p.id in (select payment_id from payment_entry where id > %s and id <= %s)
+	or p.last_attempted_at >= %s)"""
+
+# Accounts with entries in an ID range, a balance other than the audited
+# one, or no audited balance yet, with their audited balance plus the sum
+# of entries in the range.
+CHANGED_ACCOUNTS_SQL = """
+select ac.id, ac.balance, coalesce(ab.balance, 0) + coalesce(sum(e.amount), 0)
+from account_account as ac
+left join payment_auditedbalance as ab on ab.account_id = ac.id
+left join payment_entry as e
+	on e.account_id = ac.id and e.id > %s and e.id <= %s
+where ab.id is null or ac.balance != ab.balance or e.id is not null
+group by ac.id, ac.balance, ab.balance
+order by ac.id
+"""
+
+ENTRY_WATERMARK = 'entry'
 
 class AuditError(Exception):
     pass
@@ -24,11 +84,26 @@ def account_check(account):
                 account, account.balance, entry_sum))
     return True
 
-def all_accounts_check():
+def all_accounts_check(bulk=False):
+    if bulk:
+        for error in account_mismatches():
+            raise error
+        return True
     for account in Account.objects.all():
         account_check(account)
     return True
 
+def account_mismatches(chunk_size=1000):
+    """
+    Generates an AuditError for each account whose balance isn't the sum of
+    its entries, as they are read from a single grouped query.
+    """
+    for account_id, balance, entry_sum in _iter_rows(
+            ACCOUNT_MISMATCHES_SQL, chunk_size):
+        yield AuditError(
+            "Account %s out of balance: balance is %s; entry sum is %s" % (
+                account_id, balance, entry_sum))
+
 def payment_check(payment):
     """
     Verify that payer and recipient payment entries sum to payment amount,
@@ -58,7 +133,104 @@ def payment_check(payment):
                     payment)
     return True
 
-def all_payments_check():
+def all_payments_check(bulk=False):
+    if bulk:
+        for error in payment_mismatches():
+            raise error
+        return True
     for payment in Payment.objects.filter(status='completed'):
         payment_check(payment)
     return True
+
+def payment_mismatches(chunk_size=1000, sql=PAYMENT_MISMATCHES_SQL,
+                       params=()):
+    """
+    Generates an AuditError for each node of a completed payment whose
+    entries don't add up as payment_check requires, as they are read from
+    a single query grouping entries joined to credit lines.
+    """
+    for payment_id, node_id, payer_id, recipient_id, node_sum in _iter_rows(
+            sql, chunk_size, params):
+        if node_id == payer_id:
+            problem = "payer did not pay correct amount"
+        elif node_id == recipient_id:
+            problem = "recipient did not receive correct amount"
+        else:
+            problem = "intermediary's entry amounts do not sum to zero"
+        yield AuditError("Payment %s: %s (node %s: %s)." % (
+                payment_id, problem, node_id, node_sum))
+
+def incremental_mismatches(chunk_size=1000):
+    """
+    Generates an AuditError for each mismatch in what changed since the
+    last run, like account_mismatches and payment_mismatches do for
+    everything.  Progress is saved once the generator is exhausted.
+
+    Completed payments with entries newer than the entry watermark are
+    checked.  Queued payments complete long after they are created, so
+    payments are picked by entry ID rather than payment ID.  A payment's
+    entries can commit after entries with higher IDs have been audited, so
+    payments attempted within the last AUDIT_RECHECK_WINDOW are checked
+    again too; that must be longer than any payment transaction.
+
+    Each account with newer entries, or a balance other than its audited
+    balance, is checked against its audited balance plus its newer entries.  If that
+    doesn't match, the account is recounted in full before reporting it.
+    Entries committed out of ID order then cause no false alarms.
+    """
+    recheck_since = datetime.now() - getattr(
+        settings, 'AUDIT_RECHECK_WINDOW', timedelta(minutes=10))
+    watermark = get_watermark(ENTRY_WATERMARK)
+    new_watermark = Entry.objects.aggregate(Max('id'))['id__max'] or watermark
+    for error in payment_mismatches(
+            chunk_size, NEW_PAYMENT_MISMATCHES_SQL,
+            (watermark, new_watermark, recheck_since)):
+        yield error
+    audited_balances = {}
+    for account_id, balance, expected in _iter_rows(
+            CHANGED_ACCOUNTS_SQL, chunk_size, (watermark, new_watermark)):
+        if balance != expected:
+            expected = (Entry.objects.filter(account=account_id).aggregate(
+                    Sum('amount'))['amount__sum'] or D('0'))
+        if balance != expected:
+            yield AuditError(
+                "Account %s out of balance: balance is %s; "
+                "entry sum is %s" % (account_id, balance, expected))
+        audited_balances[account_id] = expected
+    _save_progress(new_watermark, audited_balances)
+
+def get_watermark(name):
+    "Returns the last ID checked by the incremental audit, or 0."
+    values = AuditWatermark.objects.filter(name=name).values_list(
+        'value', flat=True)
+    return values[0] if values else 0
+
+@transaction.commit_on_success(using='ripple')
+def _save_progress(entry_watermark, audited_balances):
+    """
+    Stores the entry watermark, and dict of account ID: entry sum as
+    audited balances.
+    """
+    for account_id, balance in audited_balances.iteritems():
+        if not AuditedBalance.objects.filter(account=account_id).update(
+                balance=balance):
+            AuditedBalance.objects.create(
+                account_id=account_id, balance=balance)
+    if not AuditWatermark.objects.filter(name=ENTRY_WATERMARK).update(
+            value=entry_watermark):
+        AuditWatermark.objects.create(
+            name=ENTRY_WATERMARK, value=entry_watermark)
+
+def _iter_rows(sql, chunk_size, params=()):
+    """
+    Generates the rows of ripple database query sql with params,
+    chunk_size at a time.
+    """
+    cursor = connections['ripple'].cursor()
+    cursor.execute(sql, params)
+    while True:
+        rows = cursor.fetchmany(chunk_size)
+        if not rows:
+            break
+        for row in rows:
+            yield row
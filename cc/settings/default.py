@@ -212,6 +212,49 @@ ENDORSEMENT_BONUS = 5
 
 FEED_ITEMS_PER_PAGE = 20
 
+# Min cost flow solver for routed payments; see cc.payment.solvers.BACKENDS.
+PAYMENT_FLOW_BACKEND = 'successive_shortest_path'
+
+# Longest route, in credit lines, considered for payments and reputation.
+PAYMENT_MAX_HOPS = None
+
+# Times to reroute a payment whose route collides with another payment
+# changing the same account balances.
+PAYMENT_MAX_RETRIES = 3
+
+# Seconds a payment quote stays valid, if the flow graph doesn't change.
+PAYMENT_QUOTE_TIMEOUT = 300
+
+# Queue routed payments for bin/process_payments.py instead of performing
+# them in the web request.  Requires FLOW_GRAPH_JOURNAL.
+PAYMENT_QUEUE = False
+
+# Profiles that have logged in within this many days get the reputations
+# they have been shown recomputed by bin/precompute_reputations.py.
+REPUTATION_PRECOMPUTE_DAYS = 30
+
+# Log flow engine measurements and keep counters of them; see
+# cc.payment.stats.  Computations slower than FLOW_STATS_SLOW_MS are logged
+# as warnings.  Costs several cache round trips per flow computation.
+FLOW_STATS = False
+FLOW_STATS_SLOW_MS = 1000
+
+# Journal credit line changes instead of updating cached flow graphs in the
+# web process.  Requires bin/update_cached_graphs.py to be running, which is
+# then the only process writing the cached graphs.
+FLOW_GRAPH_JOURNAL = False
+
+# Directory for memory-mapped flow graph snapshots shared by all processes on
+# this machine, kept up to date by the journal applier or
+# bin/write_graph_snapshots.py.  Stale snapshots aren't used.  None to
+# disable.
+FLOW_GRAPH_SNAPSHOT_DIR = None
+
+# Payments attempted within this long are checked again by each incremental
+# audit, in case their entries committed after newer ones were audited.
+# Must be longer than any payment transaction.
+AUDIT_RECHECK_WINDOW = timedelta(minutes=10)
+
 DATABASE_ROUTERS = ('cc.ripple.router.RippleRouter',)
 
 # Testing.